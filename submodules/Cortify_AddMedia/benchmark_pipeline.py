@@ -0,0 +1,393 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+from create_JSON_playlist import build_cover_index, collect_metadata, process_files
+from create_triggers import (PARAMS, SAMPLE_RATE, FilePaths, add_silence, add_triggers_to_audio_streaming,
+                             add_triggers_to_video, encode_audio_with_triggers, generate_new_trigger_signal,
+                             generate_trigger_signal_from_txt, load_audio)
+
+"""
+Benchmarks the stages of the AddMedia pipeline on synthetic media generated locally (WAV, MP3 and MP4 fixtures of
+several lengths), and saves the wall time, CPU time and peak memory of each stage to a JSON file.
+
+Comparing the results with the ones of a previous run (--baseline) flags the stages that got slower, so regressions
+can be caught before ingesting a new batch of stimuli:
+
+    python benchmark_pipeline.py --lengths 30 600 --output bench.json --baseline previous_bench.json
+
+Peak memory is the largest amount of memory allocated by Python and NumPy during the stage (tracemalloc). The memory
+used by ffmpeg subprocesses is not included.
+"""
+
+# Lengths of the fixtures, in seconds (30 s, 10 min, 3 h)
+FIXTURE_LENGTHS = (30, 600, 10800)
+
+# Formats of the fixtures
+FIXTURE_FORMATS = ('.wav', '.mp3', '.mp4')
+
+# Version of the layout of the results file
+RESULTS_VERSION = 1
+
+# Number of time samples generated at once when writing the audio fixtures
+FIXTURE_BLOCK_SIZE = 1 << 20
+
+# A stage is reported as a regression if it is this many times slower than in the baseline
+REGRESSION_TOLERANCE = 1.25
+
+# Tags written to the fixtures
+FIXTURE_METADATA = {'title': 'Benchmark', 'artist': 'Cortify', 'album': 'Benchmark fixtures', 'genre': 'Podcast'}
+
+
+def get_fixture_name(length, extension):
+    """
+    Returns the file name of a fixture.
+
+    :param length: (int) Length of the fixture in seconds.
+    :param extension: (str) Extension of the fixture ('.wav', '.mp3' or '.mp4').
+
+    :return: (str) The file name, e.g. 'bench_600s.mp3'.
+    """
+
+    return f"bench_{length}s{extension}"
+
+
+def write_audio_fixture(path, length, sample_rate=SAMPLE_RATE, seed=0):
+    """
+    Writes a stereo noise file block by block, so that long fixtures are never fully held in memory.
+
+    :param path: (str) Path to the fixture (the format is taken from the extension).
+    :param length: (int) Length in seconds.
+    :param sample_rate: (int) Sample rate in Hz.
+    :param seed: (int) Seed of the noise.
+    """
+
+    rng = np.random.default_rng(seed)
+    num_samples = int(length * sample_rate)
+
+    with sf.SoundFile(path, 'w', samplerate=sample_rate, channels=2) as fixture:
+        for block_start in range(0, num_samples, FIXTURE_BLOCK_SIZE):
+            block_size = min(FIXTURE_BLOCK_SIZE, num_samples - block_start)
+            fixture.write(rng.uniform(-0.1, 0.1, (block_size, 2)).astype(np.float32))
+
+
+def write_video_fixture(path, length, sample_rate=SAMPLE_RATE):
+    """
+    Writes a small H.264/AAC video (test pattern and a sine tone) with ffmpeg.
+
+    :param path: (str) Path to the fixture.
+    :param length: (int) Length in seconds.
+    :param sample_rate: (int) Sample rate of the audio in Hz.
+    """
+
+    ffmpeg_args = ['ffmpeg', '-y', '-v', 'error',
+                   '-f', 'lavfi', '-i', f'testsrc2=size=320x240:rate=25:duration={length}',
+                   '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate={sample_rate}:duration={length}',
+                   '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                   '-c:a', 'aac', '-ac', '2']
+    for key, value in FIXTURE_METADATA.items():
+        ffmpeg_args += ['-metadata', f'{key}={value}']
+    subprocess.run(ffmpeg_args + ['-shortest', path], check=True)
+
+
+def create_fixtures(fixtures_dir, lengths, formats=FIXTURE_FORMATS):
+    """
+    Creates the fixtures that don't exist yet (they are kept between runs, the long ones take a while to encode).
+
+    :param fixtures_dir: (str) Directory of the fixtures.
+    :param lengths: (list) Lengths of the fixtures in seconds.
+    :param formats: (tuple) Formats of the fixtures.
+
+    :return: (dict) Path to each fixture, keyed by (length, extension).
+    """
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+
+    fixtures = {}
+    for length in lengths:
+        for extension in formats:
+            path = os.path.join(fixtures_dir, get_fixture_name(length, extension))
+            if not os.path.isfile(path):
+                print("Creating fixture", path)
+                if extension == '.mp4':
+                    write_video_fixture(path, length)
+                else:
+                    write_audio_fixture(path, length)
+            fixtures[(length, extension)] = path
+
+    return fixtures
+
+
+def measure(results, stage, fixture, func, *args, verbose=False, **kwargs):
+    """
+    Runs a stage and records its wall time, CPU time and peak memory. A failing stage is recorded with its error.
+
+    :param results: (list) The results, the measurement of the stage is appended to it.
+    :param stage: (str) Name of the stage.
+    :param fixture: (str) Name of the fixture the stage runs on.
+    :param func: (callable) The stage.
+    :param verbose: (bool) If False, what the stage prints is hidden.
+    :param args, kwargs: Arguments of the stage.
+
+    :return: The value returned by the stage, None if it failed.
+    """
+
+    gc.collect()
+    tracemalloc.start()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+    value, error = None, None
+    try:
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            value = func(*args, **kwargs)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    wall_time, cpu_time = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results.append({"stage": stage,
+                    "fixture": fixture,
+                    "wall_time_s": wall_time,
+                    "cpu_time_s": cpu_time,
+                    "peak_memory_mb": peak_memory / 2 ** 20,
+                    "error": error})
+
+    status = f"FAILED ({error})" if error else f"{wall_time:8.3f} s  {peak_memory / 2 ** 20:9.1f} MB"
+    print(f"  {stage:36} {fixture:18} {status}")
+    return value
+
+
+def benchmark_audio(results, fixture_path, work_dir, verbose=False):
+    """
+    Benchmarks the audio stages on one fixture: decoding, adding the silence, generating the trigger signal (new and
+    from the saved positions), adding the triggers to the decoded audio and encoding it with its tags (the path of the
+    batch and pipelined runs), and the streaming entry point, which does all of it block by block.
+
+    :param results: (list) The results, the measurements are appended to it.
+    :param fixture_path: (str) Path to the audio fixture.
+    :param work_dir: (str) Directory for the files written by the stages.
+    :param verbose: (bool) If False, what the stages print is hidden.
+    """
+
+    fixture = os.path.basename(fixture_path)
+    file_name, extension = os.path.splitext(fixture)
+
+    # One folder per fixture, the fixtures of the same length have the same name
+    fixture_dir = os.path.join(work_dir, file_name + extension.replace('.', '_'))
+    file_paths = FilePaths(source_media_path=os.path.dirname(fixture_path),
+                           stim_with_trigs_path=os.path.join(fixture_dir, 'stimuli_with_triggers'),
+                           trigger_pos_path=os.path.join(fixture_dir, 'triggers'))
+    os.makedirs(file_paths.stim_with_trigs_path, exist_ok=True)
+    os.makedirs(file_paths.trigger_pos_path, exist_ok=True)
+
+    audio = measure(results, 'load_audio', fixture, load_audio, fixture_path, SAMPLE_RATE, verbose=verbose)
+    if audio is None:
+        return
+
+    audio_with_silence = measure(results, 'add_silence', fixture, add_silence, audio, SAMPLE_RATE, verbose=verbose)
+    num_samples = len(audio_with_silence)
+    del audio_with_silence
+
+    trigger_signal = measure(results, 'generate_new_trigger_signal', fixture, generate_new_trigger_signal,
+                             file_name, num_samples, SAMPLE_RATE, file_paths.trigger_pos_path, PARAMS, seed=0,
+                             verbose=verbose)
+    del trigger_signal
+
+    trigger_signal = measure(results, 'generate_trigger_signal_from_txt', fixture, generate_trigger_signal_from_txt,
+                             file_name, num_samples, SAMPLE_RATE, file_paths.trigger_pos_path,
+                             PARAMS.trigger_amplitude, verbose=verbose)
+    del trigger_signal
+
+    # Both entry points reuse the trigger positions saved above, like a rebuild of the stimuli
+    measure(results, 'encode_audio_with_triggers', fixture, encode_audio_with_triggers, file_name, audio, file_paths,
+            SAMPLE_RATE, FIXTURE_METADATA, use_existing_txt_file=True, verbose=verbose)
+    del audio
+
+    measure(results, 'add_triggers_to_audio_streaming', fixture, add_triggers_to_audio_streaming, file_name,
+            extension, file_paths, SAMPLE_RATE, FIXTURE_METADATA, use_existing_txt_file=True, verbose=verbose)
+
+
+def benchmark_video(results, fixture_path, work_dir, verbose=False):
+    """
+    Benchmarks `add_triggers_to_video` on one video fixture.
+
+    :param results: (list) The results, the measurement is appended to it.
+    :param fixture_path: (str) Path to the video fixture.
+    :param work_dir: (str) Directory for the files written by the stage.
+    :param verbose: (bool) If False, what the stage prints is hidden.
+    """
+
+    file_paths = FilePaths(source_media_path=os.path.dirname(fixture_path),
+                           stim_with_trigs_path=os.path.join(work_dir, 'stimuli_with_triggers'),
+                           trigger_pos_path=os.path.join(work_dir, 'triggers'))
+    video_thumbnails_path = os.path.join(work_dir, 'Video thumbnails')
+    for path in (file_paths.stim_with_trigs_path, file_paths.trigger_pos_path, video_thumbnails_path):
+        os.makedirs(path, exist_ok=True)
+
+    file_name, extension = os.path.splitext(os.path.basename(fixture_path))
+    measure(results, 'add_triggers_to_video', os.path.basename(fixture_path), add_triggers_to_video, file_name,
+            extension, file_paths, SAMPLE_RATE, video_thumbnails_path, use_existing_txt_file=False, verbose=verbose)
+
+
+def benchmark_playlist(results, fixtures, work_dir, verbose=False):
+    """
+    Benchmarks the playlist stages: `collect_metadata` on each fixture, and `process_files` on a media directory
+    with all the fixtures, reading one file at a time and then one per CPU (at least two).
+
+    :param results: (list) The results, the measurements are appended to it.
+    :param fixtures: (dict) Path to each fixture, keyed by (length, extension).
+    :param work_dir: (str) Directory for the media directory and the priority file.
+    :param verbose: (bool) If False, what the stages print is hidden.
+    """
+
+    media_path = os.path.join(work_dir, 'media')
+    stim_type_dir = os.path.join(media_path, 'Benchmark')
+    cover_path = os.path.join(work_dir, 'images')
+    os.makedirs(stim_type_dir, exist_ok=True)
+
+    # Link the fixtures in the media directory instead of copying them
+    for fixture_path in fixtures.values():
+        link_path = os.path.join(stim_type_dir, os.path.basename(fixture_path))
+        if not os.path.lexists(link_path):
+            try:
+                os.link(fixture_path, link_path)
+            except OSError:
+                os.symlink(os.path.abspath(fixture_path), link_path)
+
+    cover_index = build_cover_index(cover_path)
+    for fixture_path in fixtures.values():
+        measure(results, 'collect_metadata', os.path.basename(fixture_path), collect_metadata,
+                os.path.join(stim_type_dir, os.path.basename(fixture_path)), 'Benchmark', cover_index, None,
+                verbose=verbose)
+
+    # Priority files as CSV, so the benchmark doesn't need pandas
+    priority_file = os.path.join(work_dir, 'priorities.csv')
+    with open(priority_file, 'w', encoding='utf-8', newline='') as f:
+        f.write('filename\n' + ''.join(os.path.basename(path) + '\n' for path in list(fixtures.values())[:1]))
+
+    measure(results, 'process_files', f"{len(fixtures)} files", process_files, media_path, cover_path,
+            list(FIXTURE_FORMATS), priority_file, verbose=verbose)
+    measure(results, 'process_files (threaded)', f"{len(fixtures)} files", process_files, media_path, cover_path,
+            list(FIXTURE_FORMATS), priority_file, max_workers=max(os.cpu_count() or 1, 2), verbose=verbose)
+
+
+def get_environment():
+    """
+    Describes the machine and the library versions, so that results from different setups aren't compared blindly.
+
+    :return: (dict) Python, platform, CPU count and library versions.
+    """
+
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "librosa": librosa.__version__,
+            "soundfile": sf.__version__,
+            "libsndfile": sf.__libsndfile_version__}
+
+
+def compare_with_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Lists the stages that got slower than in a previous run.
+
+    :param results: (dict) Results of this run.
+    :param baseline: (dict) Results of the previous run (same layout).
+    :param tolerance: (float) A stage is a regression if its wall time is more than `tolerance` times the baseline.
+
+    :return: (list) For each regression, a dict with the stage, the fixture, both wall times and their ratio.
+    """
+
+    baseline_times = {(r["stage"], r["fixture"]): r["wall_time_s"] for r in baseline["results"] if not r["error"]}
+
+    regressions = []
+    for result in results["results"]:
+        baseline_time = baseline_times.get((result["stage"], result["fixture"]))
+        if result["error"] or not baseline_time:
+            continue
+        ratio = result["wall_time_s"] / baseline_time
+        if ratio > tolerance:
+            regressions.append({"stage": result["stage"], "fixture": result["fixture"],
+                                "baseline_s": baseline_time, "wall_time_s": result["wall_time_s"], "ratio": ratio})
+
+    return regressions
+
+
+def run_benchmark(work_dir, lengths=FIXTURE_LENGTHS, verbose=False):
+    """
+    Creates the fixtures and benchmarks every stage on them.
+
+    :param work_dir: (str) Directory of the fixtures and of the files written by the stages.
+    :param lengths: (list) Lengths of the fixtures in seconds.
+    :param verbose: (bool) If False, what the stages print is hidden.
+
+    :return: (dict) The results: environment, sample rate, and the measurements of each stage and fixture.
+    """
+
+    fixtures = create_fixtures(os.path.join(work_dir, 'fixtures'), lengths)
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as output_dir:
+        for (length, extension), fixture_path in fixtures.items():
+            print(f"Fixture {os.path.basename(fixture_path)}:")
+            if extension == '.mp4':
+                benchmark_video(results, fixture_path, output_dir, verbose)
+            else:
+                benchmark_audio(results, fixture_path, output_dir, verbose)
+
+        print("Playlist:")
+        benchmark_playlist(results, fixtures, output_dir, verbose)
+
+    return {"version": RESULTS_VERSION,
+            "created": datetime.now().isoformat(timespec='seconds'),
+            "environment": get_environment(),
+            "sample_rate": SAMPLE_RATE,
+            "lengths_s": list(lengths),
+            "results": results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the AddMedia pipeline on synthetic media.")
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'cortify_benchmark'),
+                        help="directory of the fixtures (kept between runs) and of the temporary outputs")
+    parser.add_argument('--lengths', type=int, nargs='+', default=list(FIXTURE_LENGTHS),
+                        help="lengths of the fixtures in seconds (default: 30 600 10800)")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file the results are saved to")
+    parser.add_argument('--baseline', help="results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help="slowdown ratio above which a stage is reported as a regression")
+    parser.add_argument('--verbose', action='store_true', help="show what the stages print")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    benchmark_results = run_benchmark(args.work_dir, args.lengths, args.verbose)
+
+    with open(args.output, 'w') as f:
+        json.dump(benchmark_results, f, indent=4)
+    print("Saved results as", args.output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare_with_baseline(benchmark_results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression['stage']} on {regression['fixture']} took "
+                  f"{regression['wall_time_s']:.3f} s ({regression['ratio']:.2f}x the baseline)")
+        if regressions:
+            sys.exit(1)
+        print("No regression compared with", args.baseline)
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+
+"""
+Keeps track of the stimuli built by `create_triggers.py` in a JSON manifest ('Add_Triggers > build_manifest.json').
+
+For each source file, the manifest records the content hash of the source, the parameters used to build the stimulus,
+the version of the trigger pipeline, and the hash of the output. A stimulus only needs to be rebuilt when one of these
+changed.
+"""
+
+MANIFEST_FILENAME = 'build_manifest.json'
+
+# Rebuild reasons for which the saved trigger positions can't be reused
+SOURCE_CHANGED = "source file changed"
+PARAMS_CHANGED = "trigger parameters changed"
+
+
+def file_sha256(file_path, chunk_size=1 << 20):
+    """
+    Computes the SHA-256 hash of a file, reading it by chunks.
+
+    :param file_path: (str) Path to the file.
+    :param chunk_size: (int) Number of bytes read at once.
+
+    :return: (str) The hexadecimal digest.
+    """
+
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_fingerprint(file_path, previous_fingerprint=None):
+    """
+    Returns the size, modification time and content hash of a file.
+    The hash is only computed again if the size or the modification time differ from the previous fingerprint.
+
+    :param file_path: (str) Path to the file.
+    :param previous_fingerprint: (dict, optional) Fingerprint of the same file from a previous run.
+
+    :return: (dict) `size`, `mtime_ns` and `sha256` of the file.
+    """
+
+    stat = os.stat(file_path)
+    if (previous_fingerprint is not None
+            and previous_fingerprint.get('size') == stat.st_size
+            and previous_fingerprint.get('mtime_ns') == stat.st_mtime_ns):
+        return previous_fingerprint
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_sha256(file_path)}
+
+
+def load_manifest(manifest_path):
+    """
+    Loads the build manifest, or returns an empty one if it doesn't exist yet.
+
+    :param manifest_path: (str) Path to the manifest file.
+
+    :return: (dict) Build entries, keyed by source file name.
+    """
+
+    if not os.path.isfile(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    Saves the build manifest. The file is replaced in one step, so an interrupted run can't leave it half-written.
+
+    :param manifest: (dict) Build entries, keyed by source file name.
+    :param manifest_path: (str) Path to the manifest file.
+    """
+
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True, ensure_ascii=False)
+    os.replace(temp_path, manifest_path)
+
+
+def make_build_entry(source_fingerprint, output_file, build_params, tool_version, previous_entry=None,
+                     output_options=None):
+    """
+    Creates the manifest entry of a stimulus that was just built.
+
+    :param source_fingerprint: (dict) Fingerprint of the source file (see `file_fingerprint`).
+    :param output_file: (str) Path to the built stimulus.
+    :param build_params: (dict) Parameters used to build the stimulus (JSON-serializable).
+    :param tool_version: (str) Version of the trigger pipeline.
+    :param previous_entry: (dict, optional) Previous entry of the same source, to avoid hashing an unchanged output.
+    :param output_options: (dict, optional) Encoding options that change the output but not the trigger positions.
+
+    :return: (dict) The manifest entry.
+    """
+
+    previous_output = previous_entry.get('output') if previous_entry else None
+    if previous_output and previous_output.get('file') != os.path.basename(output_file):
+        previous_output = None
+
+    output_fingerprint = file_fingerprint(output_file, previous_output)
+
+    entry = {'source': source_fingerprint,
+             'output': dict(output_fingerprint, file=os.path.basename(output_file)),
+             'params': json.loads(json.dumps(build_params)),
+             'tool_version': tool_version}
+    if output_options is not None:
+        entry['output_options'] = json.loads(json.dumps(output_options))
+    return entry
+
+
+def rebuild_reason(entry, source_fingerprint, output_file, build_params, tool_version, output_options=None):
+    """
+    Tells whether a stimulus must be rebuilt, and why.
+
+    :param entry: (dict or None) Manifest entry of the source file.
+    :param source_fingerprint: (dict) Current fingerprint of the source file (see `file_fingerprint`).
+    :param output_file: (str) Path to the stimulus built from the source file.
+    :param build_params: (dict) Parameters the stimulus would be built with now.
+    :param tool_version: (str) Current version of the trigger pipeline.
+    :param output_options: (dict, optional) Encoding options the stimulus would be built with now. Options missing
+        from the entry (recorded before the option existed) are considered built with the current value.
+
+    :return: (str or None) Why the stimulus must be rebuilt, or None if it is up to date.
+    """
+
+    if entry is None:
+        return "new file" if not os.path.isfile(output_file) else "not in the build manifest"
+
+    if not os.path.isfile(output_file) or entry['output'].get('file') != os.path.basename(output_file):
+        return "output file is missing"
+
+    if entry['source']['sha256'] != source_fingerprint['sha256']:
+        return SOURCE_CHANGED
+
+    if entry['params'] != json.loads(json.dumps(build_params)):
+        return PARAMS_CHANGED
+
+    if entry['tool_version'] != tool_version:
+        return f"pipeline version changed ({entry['tool_version']} -> {tool_version})"
+
+    if output_options is not None:
+        output_options = json.loads(json.dumps(output_options))
+        if dict(output_options, **entry.get('output_options', {})) != output_options:
+            return "output options changed"
+
+    if file_fingerprint(output_file, entry['output'])['sha256'] != entry['output']['sha256']:
+        return "output file was modified"
+
+    return None
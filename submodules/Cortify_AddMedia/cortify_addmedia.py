@@ -0,0 +1,341 @@
+import argparse
+import os
+import subprocess
+import sys
+
+from processing_options import (DELAY_COMPENSATION_MODES, OUTPUT_FORMAT, OUTPUT_FORMATS, PLAYLIST_OUTPUTS,
+                                RESAMPLE_TYPE, RESAMPLE_TYPES, TRANSFER_MODES)
+
+"""
+Command-line entry point of the AddMedia tools:
+
+    python cortify_addmedia.py triggers --media-dir <Cortify_Media>      add triggers to the new media
+    python cortify_addmedia.py sort --media-dir <Cortify_Media>          sort the stimuli by genre
+    python cortify_addmedia.py playlist --media-dir <Cortify_Media>      build the playlist
+    python cortify_addmedia.py trigger-assets                             create the pause / new acquisition triggers
+    python cortify_addmedia.py thumbnails --media-dir <Cortify_Media>    create the video thumbnails
+    python cortify_addmedia.py verify --media-dir <Cortify_Media>        check the triggers of the stimuli
+    python cortify_addmedia.py convert-triggers --media-dir <Cortify_Media>  create the binary trigger files
+    python cortify_addmedia.py pipeline --media-dir <Cortify_Media>      triggers, sort and playlist in one run
+    python cortify_addmedia.py import-times                               measure the start-up cost of each command
+
+The Cortify_Media directory can also be given with the CORTIFY_MEDIA_DIR environment variable.
+
+Each command only imports the modules it runs, when it runs, so that the CLI starts quickly: librosa, matplotlib,
+moviepy and pandas are only imported by the code paths that need them (resampling, plots, videos that must be
+re-encoded, priority spreadsheets). Run `import-times` to see what each command costs to start. The choices of the
+options are checked when the arguments are parsed (see `processing_options.py`).
+"""
+
+MEDIA_DIR_ENV = 'CORTIFY_MEDIA_DIR'
+
+# Modules imported by each command, measured by `import-times`
+COMMAND_MODULES = {
+    'triggers': ('create_triggers',),
+    'sort': ('genre_categorizer',),
+    'playlist': ('create_JSON_playlist',),
+    'trigger-assets': ('create_pause_trigger', 'create_2ms_trigger_new_acq'),
+    'thumbnails': ('create_video_thumbnails',),
+    'verify': ('verify_triggers',),
+    'convert-triggers': ('trigger_format',),
+    'pipeline': ('ingest_pipeline',),
+}
+
+# Number of dependencies shown for each command by `import-times`
+SLOWEST_IMPORTS_SHOWN = 3
+
+# Default folder of the trigger assets (in the Cortify app)
+TRIGGER_ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'assets',
+                                  'trigger_new_acquisition_block')
+
+
+def run_triggers(args):
+    """
+    Runs `create_triggers.find_new_stim_and_add_triggers`.
+    """
+
+    from create_triggers import find_new_stim_and_add_triggers
+
+    find_new_stim_and_add_triggers(args.media_dir, accepted_formats=tuple(args.formats), plot=args.plot,
+                                   overwrite_existing_triggers=args.overwrite, n_workers=args.workers,
+                                   streaming=args.streaming, output_format=args.output_format,
+                                   delay_compensation=args.delay_compensation, res_type=args.resampler,
+                                   pipelined=args.pipelined, n_decoders=args.decoders, queue_size=args.queue_size)
+
+
+def run_sort(args):
+    """
+    Runs `genre_categorizer.sort_stim_with_triggers_to_genre_subfolders`.
+    """
+
+    from genre_categorizer import sort_stim_with_triggers_to_genre_subfolders
+
+    sort_stim_with_triggers_to_genre_subfolders(args.media_dir, overwrite=args.overwrite, mode=args.mode,
+                                                max_workers=args.workers)
+
+
+def run_playlist(args):
+    """
+    Runs `create_JSON_playlist.create_json_playlist`.
+    """
+
+    from create_JSON_playlist import create_json_playlist
+
+    create_json_playlist(args.media_dir, max_workers=args.workers, output=args.output,
+                         priority_file=args.priority_file)
+
+
+def run_trigger_assets(args):
+    """
+    Creates the pause and/or new acquisition trigger sounds.
+    """
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.only in (None, 'pause'):
+        from create_pause_trigger import create_pause_trigger
+        create_pause_trigger(args.output_dir)
+
+    if args.only in (None, 'new-acquisition'):
+        from create_2ms_trigger_new_acq import create_new_acquisition_trigger
+        create_new_acquisition_trigger(args.output_dir)
+
+
+def run_thumbnails(args):
+    """
+    Runs `create_video_thumbnails.create_video_thumbnails`.
+    """
+
+    from create_video_thumbnails import create_video_thumbnails
+
+    create_video_thumbnails(args.media_dir, overwrite=args.overwrite, max_workers=args.workers)
+
+
+def run_verify(args):
+    """
+    Runs `verify_triggers.verify_stimuli_folder`.
+    """
+
+    from verify_triggers import verify_stimuli_folder
+
+    verify_stimuli_folder(args.media_dir, n_workers=args.workers or os.cpu_count(), report_file=args.report)
+
+
+def run_convert_triggers(args):
+    """
+    Runs `trigger_format.convert_trigger_folder` on the triggers folder.
+    """
+
+    from trigger_format import convert_trigger_folder
+
+    convert_trigger_folder(os.path.join(args.media_dir, 'Add_Triggers', 'triggers'), sample_rate=args.sample_rate,
+                           overwrite=args.overwrite)
+
+
+def run_ingest_pipeline(args):
+    """
+    Runs `ingest_pipeline.run_ingest`.
+    """
+
+    from ingest_pipeline import run_ingest
+
+    run_ingest(args.media_dir, accepted_formats=tuple(args.formats), overwrite_existing_triggers=args.overwrite,
+               n_workers=args.workers, streaming=args.streaming, output_format=args.output_format,
+               delay_compensation=args.delay_compensation, res_type=args.resampler, pipelined=args.pipelined,
+               n_decoders=args.decoders, queue_size=args.queue_size, sort_mode=args.mode, playlist_output=args.output,
+               priority_file=args.priority_file, full=args.full)
+
+
+def measure_import_time(modules):
+    """
+    Imports modules in a new Python interpreter (so nothing is already imported) with `-X importtime`.
+
+    :param modules: (tuple) Names of the modules, imported from the folder of this file.
+
+    :return: (tuple) The total import time of the modules in seconds, and the import time of their direct
+        dependencies in seconds, keyed by module name.
+    """
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                                    os.environ.get('PYTHONPATH')])))
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {', '.join(modules)}"],
+                               capture_output=True, text=True, env=env)
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+
+    # Lines of `-X importtime`: 'import time: <self us> | <cumulative us> | <indentation><module>'. The imports
+    # done by a module are listed before it, one level of indentation deeper
+    total = 0.0
+    dependencies = {}
+    children = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        seconds = int(cumulative) / 1e6
+
+        if level == 1:
+            children[name] = seconds
+        elif level == 0:
+            if name in modules:
+                total += seconds
+                dependencies.update(children)
+            children = {}
+
+    return total, dependencies
+
+
+def run_import_times(args):
+    """
+    Prints the import time of the commands, and their slowest dependencies.
+    """
+
+    commands = args.commands or list(COMMAND_MODULES)
+    unknown = [command for command in commands if command not in COMMAND_MODULES]
+    if unknown:
+        raise SystemExit(f"Unknown command(s): {', '.join(unknown)}")
+
+    print(f"Import time of each command (new interpreter, {sys.executable}):")
+
+    for command in commands:
+        try:
+            total, dependencies = measure_import_time(COMMAND_MODULES[command])
+        except RuntimeError as e:
+            print(f"  {command:17} failed: {e}")
+            continue
+
+        slowest = sorted(dependencies.items(), key=lambda item: item[1], reverse=True)[:SLOWEST_IMPORTS_SHOWN]
+        print(f"  {command:17} {total:6.3f} s  (" + ', '.join(f"{name} {seconds:.3f} s"
+                                                      for name, seconds in slowest) + ")")
+
+
+def build_parser():
+    """
+    :return: (argparse.ArgumentParser) The parser of the command line, with one subcommand per tool.
+    """
+
+    media_dir_parser = argparse.ArgumentParser(add_help=False)
+    media_dir_parser.add_argument('--media-dir', default=os.environ.get(MEDIA_DIR_ENV),
+                                  help=f"path to the Cortify_Media directory (default: ${MEDIA_DIR_ENV})")
+
+    parser = argparse.ArgumentParser(prog='cortify_addmedia', description="Cortify AddMedia tools.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    triggers = subparsers.add_parser('triggers', parents=[media_dir_parser],
+                                     help="add triggers to the new or changed media of Add_Triggers > original_stimuli")
+    triggers.add_argument('--formats', nargs='+', default=['.wav', '.mp3', '.mp4'], help="extensions to process")
+    triggers.add_argument('--plot', action='store_true', help="plot the audio and the trigger signal of each file")
+    triggers.add_argument('--overwrite', action='store_true',
+                          help="rebuild every stimulus and draw new trigger positions (USE WITH CAUTION)")
+    triggers.add_argument('--workers', type=int, default=1, help="number of worker processes")
+    triggers.add_argument('--streaming', action='store_true', help="process the audio files block by block")
+    triggers.add_argument('--output-format', choices=OUTPUT_FORMATS, default=OUTPUT_FORMAT,
+                          help="'.mp3' (default), '.flac' or '.wav'")
+    triggers.add_argument('--delay-compensation', choices=DELAY_COMPENSATION_MODES, default='none',
+                          help="'none' (default), 'preshift' or 'timestamps'")
+    triggers.add_argument('--resampler', choices=RESAMPLE_TYPES, default=RESAMPLE_TYPE,
+                          help="'soxr_hq' (default), 'soxr_lq', 'polyphase' or 'kaiser_fast'")
+    triggers.add_argument('--pipelined', action='store_true',
+                          help="decode the next files while the previous ones are encoded")
+    triggers.add_argument('--decoders', type=int, default=1, help="number of decoder threads (with --pipelined)")
+    triggers.add_argument('--queue-size', type=int, default=2,
+                          help="number of decoded files waiting to be encoded (with --pipelined)")
+    triggers.set_defaults(func=run_triggers)
+
+    sort = subparsers.add_parser('sort', parents=[media_dir_parser],
+                                 help="sort the stimuli with triggers into the genre folders of Create_Playlists")
+    sort.add_argument('--mode', choices=TRANSFER_MODES, default='copy',
+                      help="'copy' (default), 'hardlink', 'reflink' or 'symlink'")
+    sort.add_argument('--overwrite', action='store_true', help="copy the files again even if they are identical")
+    sort.add_argument('--workers', type=int, default=1, help="number of files copied at the same time")
+    sort.set_defaults(func=run_sort)
+
+    playlist = subparsers.add_parser('playlist', parents=[media_dir_parser],
+                                     help="build the playlist of Create_Playlists > media")
+    playlist.add_argument('--workers', type=int, default=1, help="number of files read at the same time")
+    playlist.add_argument('--output', choices=PLAYLIST_OUTPUTS, default='single',
+                          help="metadata.json (default), one compact file per stimulus type, or both")
+    playlist.add_argument('--priority-file',
+                          help="priority files, .csv or spreadsheet (default: priorities.csv or priorities.xlsx "
+                               "in Create_Playlists)")
+    playlist.set_defaults(func=run_playlist)
+
+    trigger_assets = subparsers.add_parser('trigger-assets', help="create the pause and new acquisition triggers")
+    trigger_assets.add_argument('--output-dir', default=os.path.normpath(TRIGGER_ASSETS_DIR),
+                                help="folder of the trigger sounds (default: the assets of the app)")
+    trigger_assets.add_argument('--only', choices=('pause', 'new-acquisition'), help="create only one of them")
+    trigger_assets.set_defaults(func=run_trigger_assets)
+
+    thumbnails = subparsers.add_parser('thumbnails', parents=[media_dir_parser],
+                                       help="create the thumbnails of the videos of Create_Playlists")
+    thumbnails.add_argument('--overwrite', action='store_true', help="create the up-to-date thumbnails again")
+    thumbnails.add_argument('--workers', type=int, default=4, help="number of videos processed at the same time")
+    thumbnails.set_defaults(func=run_thumbnails)
+
+    verify = subparsers.add_parser('verify', parents=[media_dir_parser],
+                                   help="check the triggers of the stimuli against the saved positions")
+    verify.add_argument('--workers', type=int, help="number of files checked at the same time (default: CPUs)")
+    verify.add_argument('--report', default='trigger_verification.json', help="name of the JSON report")
+    verify.set_defaults(func=run_verify)
+
+    convert_triggers = subparsers.add_parser('convert-triggers', parents=[media_dir_parser],
+                                             help="create the binary trigger files of the text trigger files")
+    convert_triggers.add_argument('--sample-rate', type=int, default=44100, help="sample rate of the stimuli")
+    convert_triggers.add_argument('--overwrite', action='store_true', help="convert the up-to-date files again")
+    convert_triggers.set_defaults(func=run_convert_triggers)
+
+    pipeline = subparsers.add_parser('pipeline', parents=[media_dir_parser],
+                                     help="add the triggers, sort the new stimuli and build the playlist in one run")
+    pipeline.add_argument('--formats', nargs='+', default=['.wav', '.mp3', '.mp4'], help="extensions to process")
+    pipeline.add_argument('--overwrite', action='store_true',
+                          help="rebuild every stimulus and draw new trigger positions (USE WITH CAUTION)")
+    pipeline.add_argument('--workers', type=int, default=1, help="number of worker processes")
+    pipeline.add_argument('--streaming', action='store_true', help="process the audio files block by block")
+    pipeline.add_argument('--output-format', choices=OUTPUT_FORMATS, default=OUTPUT_FORMAT,
+                          help="'.mp3' (default), '.flac' or '.wav'")
+    pipeline.add_argument('--delay-compensation', choices=DELAY_COMPENSATION_MODES, default='none',
+                          help="'none' (default), 'preshift' or 'timestamps'")
+    pipeline.add_argument('--resampler', choices=RESAMPLE_TYPES, default=RESAMPLE_TYPE,
+                          help="'soxr_hq' (default), 'soxr_lq', 'polyphase' or 'kaiser_fast'")
+    pipeline.add_argument('--pipelined', action='store_true',
+                          help="decode the next files while the previous ones are encoded")
+    pipeline.add_argument('--decoders', type=int, default=1, help="number of decoder threads (with --pipelined)")
+    pipeline.add_argument('--queue-size', type=int, default=2,
+                          help="number of decoded files waiting to be encoded (with --pipelined)")
+    pipeline.add_argument('--mode', choices=TRANSFER_MODES, default='copy',
+                          help="'copy' (default), 'hardlink', 'reflink' or 'symlink'")
+    pipeline.add_argument('--output', choices=PLAYLIST_OUTPUTS, default='single',
+                          help="metadata.json (default), one compact file per stimulus type, or both")
+    pipeline.add_argument('--priority-file', help="priority files, .csv or spreadsheet")
+    pipeline.add_argument('--full', action='store_true',
+                          help="sort all the stimuli and build the playlist even if no stimulus changed")
+    pipeline.set_defaults(func=run_ingest_pipeline)
+
+    import_times = subparsers.add_parser('import-times', help="measure the import time of each command")
+    import_times.add_argument('commands', nargs='*', metavar='command',
+                              help=f"commands to measure, among {', '.join(COMMAND_MODULES)} (default: all)")
+    import_times.set_defaults(func=run_import_times)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Runs a command of the command line.
+
+    :param argv: (list, optional) The arguments, defaults to `sys.argv[1:]`.
+    """
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if hasattr(args, 'media_dir') and not args.media_dir:
+        parser.error(f"the Cortify_Media directory must be given with --media-dir or ${MEDIA_DIR_ENV}")
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,12 @@ Parameters for the sound file and the trigger are defined at the start of the co
 Author: nadège
 """
 
-import os.path as op
-import soundfile as sf
+import sys
+
 import numpy as np
 
+from create_pause_trigger import create_trigger_sound
+
 
 # Trigger parameters
 trigger_duration = 0.005  # in seconds
@@ -18,32 +20,24 @@ trigger_start_time = 0.05  # seconds into the file
 # Sound file parameters
 sound_duration = 0.5  # in seconds
 sample_rate = 44100  # in Hz,
-output_path = r"C:\Users\nadege\Projects\Cortify\assets\trigger_new_acquisition_block"
+sample_dtype = np.float32  # np.float32 or np.int16
 file_name = f"trigger_new_acquisition_block_{int(sound_duration*1000)}ms.wav"
 
 
-if __name__ == '__main__':
-
-    # Calculate the total number of samples for the sound duration
-    total_samples = int(sound_duration * sample_rate)
-
-    # Generate an array for the silent channel
-    silent_channel = np.zeros(total_samples)
+def create_new_acquisition_trigger(output_path):
+    """
+    Writes the new acquisition block trigger sound with the parameters defined at the start of the code.
 
-    # Generate an array for the click channel
-    click_channel = np.zeros(total_samples)
+    :param output_path: (str) Folder of the sound file.
 
-    # Calculate the start and end samples for the trigger
-    trigger_start_sample = int(trigger_start_time * sample_rate)
-    trigger_end_sample = trigger_start_sample + int(trigger_duration * sample_rate)
+    :return: (str) Path to the sound file.
+    """
 
-    # Set the trigger samples to the trigger amplitude
-    click_channel[trigger_start_sample:trigger_end_sample] = trigger_amplitude
+    return create_trigger_sound(output_path, file_name, trigger_duration, trigger_amplitude, trigger_start_time,
+                                sound_duration, sample_rate, sample_dtype)
 
-    # Combine the channels into a stereo sound
-    stereo_sound = np.array([silent_channel, click_channel]).T
 
-    # Write the sound to a .wav file
-    sf.write(op.join(output_path, file_name), stereo_sound, sample_rate)
+if __name__ == '__main__':
+    from cortify_addmedia import main
 
-    print('Created:', file_name, 'in', output_path)
+    main(['trigger-assets', '--only', 'new-acquisition'] + sys.argv[1:])
@@ -1,73 +1,103 @@
 import os
+import csv
 import glob
+import hashlib
 import json
-from moviepy.video.io.VideoFileClip import VideoFileClip
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from tinytag import TinyTag
-import pandas as pd
+
+from media_probe import probe_media, probe_media_files
+from processing_options import PLAYLIST_OUTPUTS
 
 """
 This script collects metadata from audio and video files stored in Create_Playlists,
 organizes the metadata by stimulus type, and saves it to a JSON file.
 """
 
+# Metadata read from the media files is cached between runs in this file (in 'Create_Playlists > metadata')
+METADATA_CACHE_FILENAME = 'metadata_cache.json'
+
+# Priority files looked for in 'Create_Playlists' when none is given, in this order
+PRIORITY_FILENAMES = ('priorities.csv', 'priorities.xlsx')
+
+# The priority files parsed from a spreadsheet are cached next to it, in '<spreadsheet name>' + this suffix
+PRIORITY_CACHE_SUFFIX = '.cache.json'
+
+# Directory of the sharded playlist (in 'Create_Playlists > metadata'), and name of its manifest
+SHARDED_PLAYLIST_DIRNAME = 'playlist'
+PLAYLIST_MANIFEST_FILENAME = 'manifest.json'
+
+# Version of the layout of the sharded playlist, bump it when the app must read it differently
+PLAYLIST_FORMAT_VERSION = 1
+
+# Directory of the cover images (in 'Cortify_Media > images') for each kind of media
+COVER_DIRS = {'audio': 'Album covers', 'video': 'Video thumbnails'}
+
 
 def get_video_duration(file_path):
     """
-    Extract duration from a video file.
+    Extract duration from a video file, without decoding it (see media_probe).
     Args:
         file_path: string, path to the video file
     Returns:
         duration: float, duration of the video file in seconds
     """
-    clip = VideoFileClip(file_path)
-    duration = clip.duration
-    clip.close()
-    return duration
+    return probe_media(file_path)["duration"]
 
 
-def get_cover_image(tag, cover_path, filename):
+def build_cover_index(cover_path):
     """
-    Search for the cover image in the specified directory.
+    Lists the cover images once, so that they can be looked up by name for every media file.
     Args:
-        tag: TinyTag object, contains metadata about the file
-        cover_path: string, path to the directory with cover images
+        cover_path: string, path to the directory with the 'Album covers' and 'Video thumbnails' directories
+    Returns:
+        cover_index: dict, for each cover directory, maps the lowercased image name (without extension) to the
+            image file name
+    """
+    cover_index = {}
+    for cover_dir in COVER_DIRS.values():
+        cover_index[cover_dir] = {}
+        cover_dir_path = os.path.join(cover_path, cover_dir)
+        if not os.path.isdir(cover_dir_path):
+            continue
+        for cover_file in sorted(os.listdir(cover_dir_path)):
+            cover_index[cover_dir].setdefault(os.path.splitext(cover_file)[0].lower(), cover_file)
+    return cover_index
+
+
+def get_cover_image(album, artist, covers, filename):
+    """
+    Search for the cover image matching the album, the artist or the name of the file (in this order).
+    Args:
+        album: string, album of the file (from its metadata)
+        artist: string, artist of the file (from its metadata)
+        covers: dict, lowercased image names mapped to the image file names (one directory of build_cover_index)
         filename: string, name of the file
     Returns:
         cover_file: string, name of the cover image file
     """
-    for cover_file in os.listdir(cover_path):
-        if tag.album and os.path.splitext(cover_file)[0].lower() == tag.album.lower():
-            return cover_file
-        elif tag.artist and os.path.splitext(cover_file)[0].lower() == tag.artist.lower():
-            return cover_file
-        elif os.path.splitext(cover_file)[0].lower() == filename[:-4].lower():
-            return cover_file
+    for name in (album, artist, os.path.splitext(filename)[0]):
+        if name and name.lower() in covers:
+            return covers[name.lower()]
     return None
 
 
-def collect_metadata(file, stim_type, cover_path, priority):
+def extract_file_metadata(file, probe=None):
     """
-    Collects and organizes metadata for a given file.
+    Reads the metadata stored in a media file (tags and stream information).
     Args:
         file: string, path to the media file
-        stim_type: string, type of the stimulus
-        cover_path: string, path to the directory with cover images
+        probe: dict, result of media_probe.probe_media for the file if it was already probed
     Returns:
-        metadata: dict, contains the metadata of the file
+        metadata: dict, contains the metadata read from the file
     """
     tag = TinyTag.get(file)
     ext = os.path.splitext(file)[-1]
-    filename = file.split('\\')[-1]
-
-    duration = get_video_duration(file) if ext == ".mp4" else tag.duration
-    cover = cover_path + ("/Video thumbnails/" if ext == ".mp4" else "/Album covers/")
-    album_cover = get_cover_image(tag, cover, filename)
 
     return {
-        "filename": filename,
-        "stim_type": stim_type,
         "format": ext,
-        "duration": duration,
+        "duration": (probe or probe_media(file))["duration"] if ext == ".mp4" else tag.duration,
         "artist": tag.artist,
         "album": tag.album,
         "title": tag.title,
@@ -76,79 +106,456 @@ def collect_metadata(file, stim_type, cover_path, priority):
         "audio_offset": tag.audio_offset,
         "filesize": tag.filesize,
         "samplerate": tag.samplerate,
+    }
+
+
+def collect_metadata(file, stim_type, cover_index, priority_rank, file_metadata=None):
+    """
+    Collects and organizes metadata for a given file.
+    Args:
+        file: string, path to the media file
+        stim_type: string, type of the stimulus
+        cover_index: dict, cover images of each cover directory (see build_cover_index)
+        priority_rank: int, rank of the file in the priority files (see load_priority_index), None if it isn't one
+        file_metadata: dict, metadata already read from the file (see extract_file_metadata), read from the file if None.
+            The bitrate and audio offset can be missing (metadata cached by the ingest pipeline, see
+            create_triggers.describe_stimulus)
+    Returns:
+        metadata: dict, contains the metadata of the file
+    """
+    if file_metadata is None:
+        file_metadata = extract_file_metadata(file)
+
+    ext = file_metadata["format"]
+    filename = file.split('\\')[-1]
+
+    covers = cover_index[COVER_DIRS["video" if ext == ".mp4" else "audio"]]
+    album_cover = get_cover_image(file_metadata["album"], file_metadata["artist"], covers, filename)
+
+    return {
+        "filename": filename,
+        "stim_type": stim_type,
+        "format": ext,
+        "duration": file_metadata["duration"],
+        "artist": file_metadata["artist"],
+        "album": file_metadata["album"],
+        "title": file_metadata["title"],
+        "channels": file_metadata["channels"],
+        "bitrate": file_metadata.get("bitrate"),
+        "audio_offset": file_metadata.get("audio_offset"),
+        "filesize": file_metadata["filesize"],
+        "samplerate": file_metadata["samplerate"],
         "album_cover": album_cover,
-        "priority": priority,
+        "priority": priority_rank is not None,
     }
 
+
+def load_metadata_cache(cache_path):
+    """
+    Loads the metadata cached by a previous run, or returns an empty cache if there is none.
+    Args:
+        cache_path: string, path to the cache file
+    Returns:
+        cache: dict, cached entries keyed by media file path
+    """
+    if cache_path is None or not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_metadata_cache(cache, cache_path):
+    """
+    Saves the metadata cache.
+    Args:
+        cache: dict, cached entries keyed by media file path
+        cache_path: string, path to the cache file
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(temp_path, cache_path)
+
+
+def is_cached(file, cache):
+    """
+    Tells whether the cached metadata of a media file is still valid (same size and modification time).
+    Args:
+        file: string, path to the media file
+        cache: dict, metadata cached by the previous run
+    Returns:
+        (bool): whether the cache entry of the file can be used
+    """
+    stat = os.stat(file)
+    entry = cache.get(file)
+    return entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+
+def get_file_metadata(file, cache, updated_cache, file_metadata=None):
+    """
+    Returns the metadata of a media file, from the cache if the file didn't change (same size and modification time),
+    or read from the file otherwise.
+    Args:
+        file: string, path to the media file
+        cache: dict, metadata cached by the previous run
+        updated_cache: dict, cache for the next run, the entry of the file is added to it
+        file_metadata: dict, metadata already read from the file if it isn't cached (see read_files_metadata)
+    Returns:
+        file_metadata: dict, metadata read from the file (see extract_file_metadata)
+        from_cache: bool, whether the metadata came from the cache
+    """
+    from_cache = is_cached(file, cache)
+
+    if from_cache:
+        entry = cache[file]
+    else:
+        stat = os.stat(file)
+        if file_metadata is None:
+            file_metadata = extract_file_metadata(file)
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "metadata": file_metadata}
+
+    updated_cache[file] = entry
+    return entry["metadata"], from_cache
+
+
 def get_priority_files_from_excel(excel_file):
+    """
+    Reads the priority files from the 'filename' column of a spreadsheet (pandas and openpyxl are only imported here).
+    Args:
+        excel_file: string, path to the spreadsheet
+    Returns:
+        priority_files: list, file names in the order of the spreadsheet
+    """
+    import pandas as pd
+
     df = pd.read_excel(excel_file)  # Charge le fichier Excel
     priority_files = df['filename'].tolist()  # Obtient la liste des fichiers prioritaires
     return priority_files
 
-def process_files(filepath, cover_path, extensions, excel_file):
+
+def get_priority_files_from_csv(csv_file):
+    """
+    Reads the priority files from the 'filename' column of a CSV file (a lightweight alternative to the spreadsheet).
+    Args:
+        csv_file: string, path to the CSV file
+    Returns:
+        priority_files: list, file names in the order of the file
+    """
+    with open(csv_file, 'r', encoding='utf-8-sig', newline='') as f:
+        return [row['filename'] for row in csv.DictReader(f)]
+
+
+def load_priority_index(priority_file):
+    """
+    Loads the priority files as an index of their rank (their order in the file), so that looking up a media file
+    is a dict lookup.
+
+    CSV files are read directly. Spreadsheets are parsed once and the result is cached next to them
+    ('<name>.xlsx' + PRIORITY_CACHE_SUFFIX), until the spreadsheet is modified (size or modification time).
+    Args:
+        priority_file: string, path to the priority file ('.csv', or a spreadsheet with pandas), None for no priority
+            files
+    Returns:
+        priority_index: dict, rank (from 0) of each priority file keyed by file name
+    """
+    if priority_file is None:
+        return {}
+
+    if priority_file.lower().endswith('.csv'):
+        priority_files = get_priority_files_from_csv(priority_file)
+
+    else:
+        stat = os.stat(priority_file)
+        source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        cache_path = priority_file + PRIORITY_CACHE_SUFFIX
+
+        cache = None
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring the priority cache {cache_path}: {e}")
+
+        if cache is not None and cache.get("source") == source:
+            priority_files = cache["priority_files"]
+        else:
+            priority_files = [file for file in get_priority_files_from_excel(priority_file) if isinstance(file, str)]
+            try:
+                temp_path = cache_path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"source": source, "priority_files": priority_files}, f, ensure_ascii=False)
+                os.replace(temp_path, cache_path)
+            except OSError as e:
+                print(f"Could not cache the priority files in {cache_path}: {e}")
+
+    priority_index = {}
+    for file in priority_files:
+        if file and file.strip():
+            priority_index.setdefault(file.strip(), len(priority_index))
+    return priority_index
+
+
+def list_media_files(filepath, extensions):
+    """
+    Lists the media files of each stimulus type directory, in a stable (sorted) order.
+    Args:
+        filepath: string, path to the directory with media files
+        extensions: list, list of file extensions to look for
+    Returns:
+        media_files: dict, paths to the media files keyed by stimulus type
+    """
+    media_files = {}
+    for stim_type in sorted(os.listdir(filepath)):
+        stim_type_dir = os.path.join(filepath, stim_type)
+        if os.path.isdir(stim_type_dir):
+            media_files[stim_type] = [file for ext in extensions
+                                      for file in sorted(glob.glob(os.path.join(stim_type_dir, f'*{ext}')))]
+    return media_files
+
+
+def read_files_metadata(files, max_workers=1):
+    """
+    Reads the metadata of several media files (see extract_file_metadata). Videos are probed in one batch.
+    Reading is mostly blocking file I/O, so with max_workers > 1 the files are read concurrently on a thread pool.
+    Args:
+        files: list, paths to the media files
+        max_workers: int, number of files read at the same time
+    Returns:
+        files_metadata: dict, metadata of each file keyed by path
+    """
+    probes = probe_media_files([file for file in files if file.endswith(".mp4")])
+
+    def read_file_metadata(file):
+        return extract_file_metadata(file, probes.get(file))
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(files, executor.map(read_file_metadata, files)))
+
+    return {file: read_file_metadata(file) for file in files}
+
+
+def process_files(filepath, cover_path, extensions, excel_file, cache_path=None, max_workers=1):
     """
     Iterates over all files in the specified directory and organizes them by metadata.
+    If a cache file is given, the metadata of files that didn't change since the previous run is taken from it,
+    only new or changed files are read, and deleted files are removed from the cache.
     Args:
         filepath: string, path to the directory with media files
         cover_path: string, path to the directory with cover images
         extensions: list, list of file extensions to look for
-        excel_file : path to the excel_file with the priority_files
+        excel_file : path to the file with the priority files, a spreadsheet or a CSV file (see load_priority_index)
+        cache_path: string, path to the metadata cache file (no cache if None)
+        max_workers: int, number of files read at the same time (the output doesn't depend on it)
     Returns:
         metadata_dict: dict, contains all the metadata organized by stimulus type
     """
 
     print("Parsing directory:", filepath)
 
-    priority_files = get_priority_files_from_excel(excel_file)
-    print(priority_files)
+    priority_index = load_priority_index(excel_file)
+    print(f"{len(priority_index)} priority file(s)")
+
+    cache = load_metadata_cache(cache_path)
+    updated_cache = {}
+    num_read_files = 0
+
+    cover_index = build_cover_index(cover_path)
+    missing_covers = []
+
+    media_files = list_media_files(filepath, extensions)
+
+    # Read all the new or changed files first
+    files_metadata = read_files_metadata([file for files in media_files.values() for file in files
+                                          if not is_cached(file, cache)], max_workers)
 
     metadata_dict = {}
-    for stim_type in os.listdir(filepath):
-        stim_type_dir = os.path.join(filepath, stim_type)
-        if os.path.isdir(stim_type_dir):
-            print(stim_type)
-            metadata_list = []
-            for ext in extensions:
-                for file in glob.glob(os.path.join(stim_type_dir, f'*{ext}')):
-                    print("  -", file.split('\\')[-1])
-                    priority = os.path.basename(file) in priority_files
-                    metadata = collect_metadata(file, stim_type, cover_path, priority)
-                    metadata_list.append(metadata)
-
-            sorted_metadata = sorted(metadata_list, key=lambda x: (
-                x["artist"] or "", x["album"] or "", x["filename"]
-            ))
-
-            metadata_dict[stim_type] = {metadata["filename"]: metadata for metadata in sorted_metadata}
+    for stim_type, files in media_files.items():
+        print(stim_type)
+        metadata_list = []
+        for file in files:
+            print("  -", file.split('\\')[-1])
+            priority_rank = priority_index.get(os.path.basename(file))
+            file_metadata, from_cache = get_file_metadata(file, cache, updated_cache, files_metadata.get(file))
+            num_read_files += not from_cache
+            metadata = collect_metadata(file, stim_type, cover_index, priority_rank, file_metadata)
+            if metadata["album_cover"] is None:
+                missing_covers.append(os.path.join(stim_type, metadata["filename"]))
+            metadata_list.append(metadata)
+
+        sorted_metadata = sorted(metadata_list, key=lambda x: (
+            x["artist"] or "", x["album"] or "", x["filename"]
+        ))
+
+        metadata_dict[stim_type] = {metadata["filename"]: metadata for metadata in sorted_metadata}
     print('metadat_dict :', metadata_dict)
+
+    if missing_covers:
+        print(f"No cover image found for {len(missing_covers)} file(s):")
+        for file in missing_covers:
+            print("  -", file)
+
+    if cache_path is not None:
+        save_metadata_cache(updated_cache, cache_path)
+        print(f"Metadata read from {num_read_files} new or changed file(s), "
+              f"{len(updated_cache) - num_read_files} taken from the cache, "
+              f"{len(set(cache) - set(updated_cache))} deleted file(s) removed from the cache.")
+
     return metadata_dict
 
 
-def save_to_json(metadata, filepath, filename):
+def order_for_display(entries, priority_index=None):
+    """
+    Orders the entries of a stimulus type for display: priority files first, in the order of the priority files, the
+    others after, in the order of process_files (artist, album, filename). The rank isn't written in the entries, so
+    the schema of the playlist doesn't change.
+    Args:
+        entries: dict, metadata of the files of a stimulus type keyed by filename
+        priority_index: dict, rank of each priority file keyed by file name (see load_priority_index). Without it, the
+            priority files keep the order of process_files
+    Returns:
+        ordered_entries: dict, the same entries in display order
+    """
+    priority_index = priority_index or {}
+    return {filename: entries[filename] for filename in
+            sorted(entries, key=lambda name: (not entries[name]["priority"], priority_index.get(name, 0)))}
+
+
+def write_file_atomically(path, data):
+    """
+    Writes a file under a temporary name and renames it once complete, so that the app never reads a partial file.
+    Args:
+        path: string, path to the file
+        data: bytes, content of the file
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def save_sharded_playlist(metadata, filepath, priority_index=None):
+    """
+    Saves the playlist as one compact JSON file per stimulus type ('<stim_type>.json', entries in display order, see
+    order_for_display), plus a small manifest, in the 'playlist' subfolder of filepath. The app can read the manifest
+    and only the shard of the selected stimulus type, without sorting it.
+
+    The manifest contains the format version, the number of files of each shard (and how many are priority files),
+    the SHA-256 of each shard, and a version hash of the whole playlist that changes whenever a shard changes.
+    The shards are written before the manifest, and the shards of stimulus types that no longer exist are removed.
+    Args:
+        metadata (dict): metadata organized by stimulus type (see process_files)
+        filepath (str, path): folder the 'playlist' subfolder is created in
+        priority_index (dict): rank of each priority file, orders the priority files (see order_for_display)
+    Returns:
+        manifest: dict, the saved manifest
+    """
+    shard_dir = os.path.join(filepath, SHARDED_PLAYLIST_DIRNAME)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    shards = {}
+    for stim_type, entries in metadata.items():
+        ordered_entries = order_for_display(entries, priority_index)
+        data = json.dumps(ordered_entries, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        shard_file = f"{stim_type}.json"
+        write_file_atomically(os.path.join(shard_dir, shard_file), data)
+        shards[stim_type] = {"file": shard_file,
+                             "count": len(ordered_entries),
+                             "priority_count": sum(entry["priority"] for entry in ordered_entries.values()),
+                             "sha256": hashlib.sha256(data).hexdigest()}
+
+    version = hashlib.sha256(json.dumps(shards, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    manifest = {"format_version": PLAYLIST_FORMAT_VERSION,
+                "version": version,
+                "count": sum(shard["count"] for shard in shards.values()),
+                "shards": shards}
+    write_file_atomically(os.path.join(shard_dir, PLAYLIST_MANIFEST_FILENAME),
+                          json.dumps(manifest, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    # Remove the shards of the stimulus types that no longer exist
+    shard_files = {shard["file"] for shard in shards.values()}
+    for file in os.listdir(shard_dir):
+        if file.endswith('.json') and file != PLAYLIST_MANIFEST_FILENAME and file not in shard_files:
+            os.remove(os.path.join(shard_dir, file))
+
+    print(f"Saved sharded playlist ({len(shards)} shard(s), version {version}) in", shard_dir)
+    return manifest
+
+
+def save_to_json(metadata, filepath, filename, output='single', priority_index=None):
     """
     Saves the given metadata dictionary to a JSON file.
     Args:
         metadata (dict): dict, dictionary containing the metadata
         filepath (str, path) : folder to save the JSON file in
-        filename (str):
+        filename (str): name of the single JSON file
+        output (str): 'single' (one indented JSON file), 'sharded' (see save_sharded_playlist) or 'both'
+            (see PLAYLIST_OUTPUTS)
+        priority_index (dict): rank of each priority file, orders the priority files of the shards (see
+            order_for_display)
+    """
+    if output not in PLAYLIST_OUTPUTS:
+        raise ValueError(f"Unknown playlist output '{output}', expected one of {PLAYLIST_OUTPUTS}")
+
+    if output in ('single', 'both'):
+        json_path = os.path.join(filepath, filename)
+        with open(json_path, 'w') as f:
+            json.dump(metadata, f, indent=4)
+        print("Saved playlist as", json_path)
+
+    if output in ('sharded', 'both'):
+        save_sharded_playlist(metadata, filepath, priority_index)
+
+
+def find_priority_file(cortify_media_path):
     """
-    json_path = os.path.join(filepath, filename)
-    with open(json_path, 'w') as f:
-        json.dump(metadata, f, indent=4)
-    print("Saved playlist as", json_path)
+    Looks for the priority files in 'Cortify_Media > Create_Playlists' (see PRIORITY_FILENAMES).
+    Args:
+        cortify_media_path: string, path to the 'Cortify_Media' directory
+    Returns:
+        priority_file: string, path to the first priority file found, None if there is none
+    """
+    for priority_filename in PRIORITY_FILENAMES:
+        priority_file = os.path.join(cortify_media_path, 'Create_Playlists', priority_filename)
+        if os.path.isfile(priority_file):
+            return priority_file
+    return None
 
 
-def create_json_playlist(cortify_media_path):
+def create_json_playlist(cortify_media_path, max_workers=1, output='single', priority_file=None):
+    """
+    Builds the playlist of the media in 'Cortify_Media > Create_Playlists > media' and saves it in
+    'Create_Playlists > metadata'.
+    Args:
+        cortify_media_path: string, path to the 'Cortify_Media' directory
+        max_workers: int, number of files read at the same time
+        output: string, 'single' (metadata.json), 'sharded' (one compact file per stimulus type) or 'both'
+        priority_file: string, path to the priority files (spreadsheet or CSV, see load_priority_index). Defaults to
+            'priorities.csv' or 'priorities.xlsx' in 'Create_Playlists' (see find_priority_file)
+    """
     filepath = os.path.join(cortify_media_path, 'Create_Playlists', 'media')
     cover_path = os.path.join(cortify_media_path, 'images')
-    extensions = ['.wav', '.mp3', '.mp4']
-    excel_file = r"C:\Users\nadege\Desktop\camille\priorities.xlsx"
+    extensions = ['.wav', '.mp3', '.flac', '.mp4']
+
+    if priority_file is None:
+        priority_file = find_priority_file(cortify_media_path)
+        if priority_file is None:
+            print("No priority file found in Create_Playlists, no file is marked as priority.")
 
-    metadata = process_files(filepath, cover_path, extensions, excel_file)
-    save_to_json(metadata, os.path.join(cortify_media_path, 'Create_Playlists', 'metadata'), 'metadata.json')
+    metadata_path = os.path.join(cortify_media_path, 'Create_Playlists', 'metadata')
+    cache_path = os.path.join(metadata_path, METADATA_CACHE_FILENAME)
+
+    metadata = process_files(filepath, cover_path, extensions, priority_file, cache_path, max_workers)
+    # The spreadsheet is parsed once, the ranks come from its cache here (see load_priority_index)
+    priority_index = load_priority_index(priority_file) if output != 'single' else None
+    save_to_json(metadata, metadata_path, 'metadata.json', output, priority_index)
     #print('metadata_dict :', metadata)
 
 
 
 if __name__ == '__main__':
-    create_json_playlist(r"C:\Users\nadege\Data\CORTIFY\Cortify_Media")
+    from cortify_addmedia import main
+
+    main(['playlist'] + sys.argv[1:])
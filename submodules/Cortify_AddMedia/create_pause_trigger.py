@@ -6,6 +6,8 @@ Author: nadège
 """
 
 import os.path as op
+import sys
+
 import soundfile as sf
 import numpy as np
 
@@ -18,31 +20,65 @@ trigger_start_time = 0.05  # seconds into the file
 # Sound file parameters
 sound_duration = 0.5  # in seconds
 sample_rate = 44100  # in Hz,
-output_path = r"C:\Users\nadege\Projects\Cortify\assets\trigger_new_acquisition_block"
+sample_dtype = np.float32  # np.float32 or np.int16
 file_name = f"trigger_pause_{int(sound_duration*1000)}ms.wav"
 
 
-# Calculate the total number of samples for the sound duration
-total_samples = int(sound_duration * sample_rate)
+def create_trigger_sound(output_path, file_name, trigger_duration, trigger_amplitude=1.0, trigger_start_time=0.05,
+                         sound_duration=0.5, sample_rate=44100, sample_dtype=np.float32):
+    """
+    Writes a stereo sound file with silence on the first channel and a single trigger on the second channel.
+
+    :param output_path: (str) Folder of the sound file.
+    :param file_name: (str) Name of the sound file (.wav).
+    :param trigger_duration: (float) Duration of the trigger in seconds.
+    :param trigger_amplitude: (float) Amplitude of the trigger, 0 to 1.
+    :param trigger_start_time: (float) Start of the trigger in seconds.
+    :param sound_duration: (float) Duration of the sound in seconds.
+    :param sample_rate: (int) Sample rate in Hz.
+    :param sample_dtype: (numpy.dtype) np.float32 or np.int16.
+
+    :return: (str) Path to the sound file.
+    """
+
+    # Calculate the total number of samples for the sound duration
+    total_samples = int(sound_duration * sample_rate)
+
+    # Allocate the stereo sound once: silent first channel, click on the second channel
+    stereo_sound = np.zeros((total_samples, 2), dtype=sample_dtype)
+
+    # Calculate the start and end samples for the trigger
+    trigger_start_sample = int(trigger_start_time * sample_rate)
+    trigger_end_sample = trigger_start_sample + int(trigger_duration * sample_rate)
+
+    # Set the trigger samples to the trigger amplitude (on the int16 scale if needed)
+    if np.issubdtype(sample_dtype, np.integer):
+        stereo_sound[trigger_start_sample:trigger_end_sample, 1] = round(trigger_amplitude * np.iinfo(sample_dtype).max)
+    else:
+        stereo_sound[trigger_start_sample:trigger_end_sample, 1] = trigger_amplitude
+
+    # Write the sound to a .wav file
+    sound_file = op.join(output_path, file_name)
+    sf.write(sound_file, stereo_sound, sample_rate)
+
+    print('Created:', file_name, 'in', output_path)
+    return sound_file
 
-# Generate an array for the silent channel
-silent_channel = np.zeros(total_samples)
 
-# Generate an array for the click channel
-click_channel = np.zeros(total_samples)
+def create_pause_trigger(output_path):
+    """
+    Writes the pause trigger sound with the parameters defined at the start of the code.
 
-# Calculate the start and end samples for the trigger
-trigger_start_sample = int(trigger_start_time * sample_rate)
-trigger_end_sample = trigger_start_sample + int(trigger_duration * sample_rate)
+    :param output_path: (str) Folder of the sound file.
 
-# Set the trigger samples to the trigger amplitude
-click_channel[trigger_start_sample:trigger_end_sample] = trigger_amplitude
+    :return: (str) Path to the sound file.
+    """
 
-# Combine the channels into a stereo sound
-stereo_sound = np.array([silent_channel, click_channel]).T
+    return create_trigger_sound(output_path, file_name, trigger_duration, trigger_amplitude, trigger_start_time,
+                                sound_duration, sample_rate, sample_dtype)
 
-# Write the sound to a .wav file
-sf.write(op.join(output_path, file_name), stereo_sound, sample_rate)
 
-print('Created:', file_name, 'in', output_path)
+if __name__ == '__main__':
+    from cortify_addmedia import main
 
+    main(['trigger-assets', '--only', 'pause'] + sys.argv[1:])
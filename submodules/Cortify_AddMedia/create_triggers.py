@@ -1,22 +1,39 @@
+import glob
+import json
 import os
-import random
 import subprocess
-from glob import glob
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from collections import namedtuple
+from functools import partial
 
-import eyed3
-import librosa
-import matplotlib.pyplot as plt
 import numpy as np
 import soundfile as sf
-import taglib
-from moviepy.audio import AudioClip
+from build_manifest import (MANIFEST_FILENAME, PARAMS_CHANGED, SOURCE_CHANGED, file_fingerprint, load_manifest,
+                            make_build_entry, rebuild_reason, save_manifest)
+from create_video_thumbnails import create_thumbnails
+from media_probe import read_lame_encoder_delay, read_mp4_video_config
+from media_tags import ffmpeg_metadata_args, read_source_tags, set_encode_tags, write_tags_in_place
+from processing_options import (DELAY_COMPENSATION_MODES, LOSSLESS_FORMATS, OUTPUT_FORMAT, OUTPUT_FORMATS,
+                                RESAMPLE_TYPE, RESAMPLE_TYPES)
+from stage_profiler import StageProfiler, profile_stage
+from trigger_format import (TRIGGER_FILE_SUFFIX, load_trigger_file, positions_to_pulse_bounds, read_text_positions,
+                            save_trigger_file, sort_pulse_bounds)
 
-from moviepy.video.VideoClip import ColorClip
-from moviepy.video.compositing.concatenate import concatenate_videoclips
-from moviepy.video.io.VideoFileClip import VideoFileClip
+# librosa (resampling), matplotlib (plots) and moviepy (videos that can't be stream-copied) are slow to import, they
+# are only imported by the functions that use them
 
 
+# Version of the trigger pipeline, recorded in the build manifest.
+# Bump it when a change alters the generated stimuli, so they get rebuilt on the next run.
+PIPELINE_VERSION = '1.2'
+
+# Sample rate of the generated stimuli
+SAMPLE_RATE = 44100
+
 # Decide how much silence to append to the start of stim files
 # (to account for delay when launching a new acquisition block on the hospital acquisition system - trigger 201)
 SILENCE_DURATION = 3.0  # seconds
@@ -32,6 +49,83 @@ PARAMS = TriggerParams(
     initial_trigger_pos=[SILENCE_DURATION, SILENCE_DURATION + .2, SILENCE_DURATION + .4]
 )
 
+# Number of time samples read and written at once when streaming audio files
+STREAM_BLOCK_SIZE = 65536
+
+# Encoder delays measured for each format and sample rate are cached in this file (in the triggers folder)
+ENCODER_DELAY_CACHE_FILENAME = 'encoder_delays.json'
+
+# How the encoder delay is measured, recorded in the delay cache and the build manifest: the priming samples written in
+# the LAME header plus the delay of the MP3 decoder, i.e. the delay heard with a decoder that isn't gapless (libsndfile's
+# decoder is gapless and strips them, so decoding the stimulus back with it measures no delay)
+ENCODER_DELAY_METHOD = 'lame header + decoder delay'
+
+# Delay in time samples added by the MP3 decoder (synthesis filterbank), on top of the encoder delay
+MP3_DECODER_DELAY = 529
+
+# Stimuli are written under a temporary name ending with this suffix (before the extension) and renamed once complete,
+# so that an interrupted run never leaves a truncated stimulus that looks finished
+PARTIAL_OUTPUT_SUFFIX = '.part'
+
+# Stage timings of each processed file are appended to this JSON-lines file (in 'Add_Triggers')
+PROFILE_LOG_FILENAME = 'stage_timings.jsonl'
+
+# Sample type of the audio buffers (np.float32 or np.int16). The stimuli are saved as 16-bit audio,
+# so float64 buffers only cost memory.
+SAMPLE_DTYPE = np.float32
+
+# Video codecs for which a black lead-in can be encoded with matching parameters and joined to the source video
+# without re-encoding it (ffprobe codec name: ffmpeg encoder)
+LEAD_IN_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+
+# ffprobe profile names to encoder profile names
+LEAD_IN_PROFILES = {'constrained baseline': 'baseline', 'baseline': 'baseline', 'main': 'main', 'high': 'high',
+                    'high 10': 'high10', 'high 4:2:2': 'high422', 'high 4:4:4 predictive': 'high444',
+                    'main 10': 'main10'}
+
+# Paths used when processing a media file (defined at module level so it can be sent to worker processes)
+FilePaths = namedtuple("FilePaths", ["source_media_path", "stim_with_trigs_path", "trigger_pos_path"])
+
+# Outcome of processing one media file in a batch, with the description of the stimulus (see `describe_stimulus`, None
+# if it failed)
+MediaJobResult = namedtuple("MediaJobResult", ["file_name", "wall_time", "error", "stimulus"], defaults=(None,))
+
+
+def get_sample_value(value: float, dtype=SAMPLE_DTYPE):
+    """
+    Converts a sample value between -1 and 1 to the scale of the given sample type (e.g. 1 is 32767 for int16).
+
+    :param value: (float) The sample value, between -1 and 1.
+    :param dtype: (numpy.dtype) The sample type.
+
+    :return: The value on the scale of the sample type.
+    """
+
+    if np.issubdtype(dtype, np.integer):
+        return int(round(value * np.iinfo(dtype).max))
+    return value
+
+
+def write_samples(destination: np.ndarray, audio: np.ndarray):
+    """
+    Writes audio samples (floats between -1 and 1) into a preallocated buffer, converting them to its sample type.
+    Integer conversion is done by blocks, so it doesn't need a full-length temporary copy of the audio.
+
+    :param destination: (numpy.ndarray) The buffer (or column of a buffer) to fill, as long as the audio.
+    :param audio: (numpy.ndarray) The audio samples.
+    """
+
+    if not np.issubdtype(destination.dtype, np.integer):
+        destination[:] = audio
+        return
+
+    dtype_info = np.iinfo(destination.dtype)
+    for block_start in range(0, len(audio), STREAM_BLOCK_SIZE):
+        block = audio[block_start:block_start + STREAM_BLOCK_SIZE] * float(dtype_info.max)
+        np.rint(block, out=block)
+        np.clip(block, dtype_info.min, dtype_info.max, out=block)
+        destination[block_start:block_start + STREAM_BLOCK_SIZE] = block
+
 
 def add_silence(audio: np.ndarray, sample_rate: int, silence_duration: float = SILENCE_DURATION):
     """
@@ -43,15 +137,126 @@ def add_silence(audio: np.ndarray, sample_rate: int, silence_duration: float = S
         Defaults to 3 seconds to account for delay when launching a new acquisition block on the hospital acquisition
         system (trigger 201).
 
-    :return: (numpy.ndarray) The audio with added silence.
+    :return: (numpy.ndarray) The audio with added silence (same sample type as the input audio).
     """
 
-    silence = np.zeros(int(silence_duration * sample_rate))
+    silence = np.zeros(int(silence_duration * sample_rate), dtype=audio.dtype)
     return np.concatenate((silence, audio))
 
 
+def generate_new_trigger_positions(file_name: str, num_samples: int, sample_rate: int, trigger_pos_path: str,
+                                   trigger_params: TriggerParams, seed=None):
+    """
+    Draws new trigger positions for a signal of a given duration and sample rate, and saves them to a text file.
+    Three triggers spaced by 200 ms mark the start of the audio (end of the 3 sec of added silence), then the rest of
+    the trigger events are spaced randomly throughout the signal, and a last trigger ends the signal.
+    The trigger positions are saved in seconds (in decimal format) to a text file in the 'triggers' folder, and in
+    time samples to a binary file next to it (see `trigger_format.py`). The saved positions are the time samples of
+    the pulses divided by the sample rate, so recreating the signal from the text file gives exactly the same pulses.
+
+    All the random spacings are drawn at once and accumulated into trigger onsets, so the cost doesn't depend on a
+    Python loop over the triggers.
+
+    :param file_name: name of the stim file (without extension)
+    :param num_samples: The duration of the trigger signal in time samples.
+    :param sample_rate: (int) The sample rate of the trigger signal in Hz.
+    :param trigger_pos_path: (str) The path to the output triggers folder.
+    :param trigger_params: (TriggerParams) Parameters related to the trigger configuration
+        (see `generate_new_trigger_signal`).
+    :param seed: (int, numpy.random.Generator, optional) Seed or generator for the random trigger spacings.
+        The same seed always gives the same trigger positions. Defaults to None (fresh entropy).
+
+    :return: (tuple) The trigger positions in seconds (numpy.ndarray of shape (n, 2), onset and offset of the pulses),
+        and the pulses in time samples (numpy.ndarray of shape (n, 2), first sample and end sample (excluded)).
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Compute trigger duration in number of samples
+    trigger_duration_samples = int(trigger_params.trigger_duration * sample_rate)
+
+    # Position of the 3 initial triggers
+    initial_onsets = np.asarray(trigger_params.initial_trigger_pos, dtype=float)
+    last_initial_end = int(initial_onsets[-1] * sample_rate) + trigger_duration_samples
+
+    # Draw enough random spacings to go past the end of the file, even if they are all at the minimum spacing
+    min_step = trigger_params.min_trigger_spacing + trigger_params.trigger_duration
+    max_num_triggers = int(np.ceil((num_samples / sample_rate - initial_onsets[-1]) / min_step)) + 1
+    spacings = rng.uniform(trigger_params.min_trigger_spacing, trigger_params.max_trigger_spacing,
+                           max(max_num_triggers, 0)) + trigger_params.trigger_duration
+    random_onsets = initial_onsets[-1] + np.cumsum(spacings)
+    random_ends = (random_onsets * sample_rate).astype(np.int64) + trigger_duration_samples
+
+    # A new trigger is added as long as the previous one ends before 1 second from the end of the file
+    previous_ends = np.concatenate(([last_initial_end], random_ends[:-1]))
+    num_random_triggers = np.searchsorted(previous_ends, num_samples - 1 * sample_rate)
+    random_onsets = random_onsets[:num_random_triggers]
+
+    trigger_onsets = np.concatenate((initial_onsets, random_onsets))
+
+    # Pulses in time samples. The last random trigger can start after the start of the end trigger (its spacing can
+    # be longer than the last second), or even after the end of the file: it is dropped, so that the pulses stay
+    # sorted and within the file
+    start_indices = (trigger_onsets * sample_rate).astype(np.int64)
+    end_trigger_start = num_samples - trigger_duration_samples
+    start_indices = start_indices[start_indices < end_trigger_start]
+
+    # End with a trigger
+    start_indices = np.append(start_indices, end_trigger_start)
+    pulse_bounds = np.column_stack((start_indices, start_indices + trigger_duration_samples))
+
+    # Same positions in seconds
+    trigger_positions = pulse_bounds / sample_rate
+
+    # Get output file path
+    trigger_output_file = os.path.join(trigger_pos_path, file_name + '_trigger.txt')
+
+    # Save the trigger positions (text for humans, binary with the exact time samples)
+    np.savetxt(trigger_output_file, trigger_positions, delimiter=',', fmt='%0.6f')
+    save_trigger_file(os.path.join(trigger_pos_path, file_name + TRIGGER_FILE_SUFFIX), pulse_bounds, sample_rate,
+                      trigger_params)
+    print(f"Trigger positions saved to file: {trigger_output_file}")
+
+    return trigger_positions, pulse_bounds
+
+
+def render_trigger_pulses(pulse_bounds: np.ndarray, num_samples: int, trigger_amplitude=1, block_start: int = 0,
+                          out: np.ndarray = None, dtype=SAMPLE_DTYPE):
+    """
+    Renders trigger pulses into a signal, or into one block of a longer signal.
+
+    Only the pulses overlapping the block are rendered, and they are all written with a single index operation.
+
+    :param pulse_bounds: (numpy.ndarray) Pulses in time samples, shape (n, 2): first sample and end sample (excluded),
+        sorted by onset (see `trigger_format.sort_pulse_bounds`). Pulses after the end of the signal are ignored.
+    :param num_samples: (int) Length of the rendered block in time samples.
+    :param trigger_amplitude: (float) Amplitude of each trigger event, between 0 and 1.
+    :param block_start: (int) Index of the first sample of the block in the full signal. Defaults to 0.
+    :param out: (numpy.ndarray, optional) Zero-filled buffer of `num_samples` samples to render the pulses into,
+        e.g. the trigger column of the output buffer. A new one is created if None.
+    :param dtype: (numpy.dtype) Sample type of the new buffer if `out` is None. Defaults to `SAMPLE_DTYPE`.
+
+    :return: (numpy.ndarray) The block of trigger signal as a 1D NumPy array.
+    """
+
+    # Pulses are sorted, keep the ones overlapping the block
+    first_pulse = np.searchsorted(pulse_bounds[:, 1], block_start, side='right')
+    last_pulse = np.searchsorted(pulse_bounds[:, 0], block_start + num_samples, side='left')
+    starts = np.clip(pulse_bounds[first_pulse:last_pulse, 0] - block_start, 0, num_samples)
+    ends = np.clip(pulse_bounds[first_pulse:last_pulse, 1] - block_start, 0, num_samples)
+
+    # Index of every sample covered by a pulse
+    lengths = ends - starts
+    pulse_indices = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    trigger_signal = np.zeros(num_samples, dtype=dtype) if out is None else out
+    trigger_signal[pulse_indices] = get_sample_value(trigger_amplitude, trigger_signal.dtype)
+
+    return trigger_signal
+
+
 def generate_new_trigger_signal(file_name: str, num_samples: int, sample_rate: int, trigger_pos_path: str,
-                                trigger_params: TriggerParams):
+                                trigger_params: TriggerParams, seed=None, out: np.ndarray = None, dtype=SAMPLE_DTYPE):
     """
     Creates a trigger signal of a given duration and sample rate.
     Three triggers spaced by 200 ms mark the start of the audio (end of the 3 sec of added silence), then the rest of
@@ -69,87 +274,77 @@ def generate_new_trigger_signal(file_name: str, num_samples: int, sample_rate: i
         `max_trigger_spacing` (float) Maximum spacing between trigger events in seconds.
         `trigger_amplitude`: (float) Amplitude of each trigger event, between 0 and 1.
         `initial_trigger_pos`: (list) Position of the first triggers (tag to mark the start of each file)
+    :param seed: (int, numpy.random.Generator, optional) Seed or generator for the random trigger spacings.
+        The same seed always gives the same trigger positions. Defaults to None (fresh entropy).
+    :param out: (numpy.ndarray, optional) Zero-filled buffer of `num_samples` samples to write the signal into.
+    :param dtype: (numpy.dtype) Sample type of the signal if `out` is None. Defaults to `SAMPLE_DTYPE`.
 
     :return: (numpy.ndarray) The trigger signal as a 1D NumPy array of zeros and ones,
       with ones representing the trigger events.
     """
 
-    # Compute trigger duration in number of samples
-    trigger_duration_samples = int(trigger_params.trigger_duration * sample_rate)
-
-    # Initialize the trigger arrays with zeros
-    trigger_signal = np.zeros(num_samples)
-    trigger_positions = np.zeros((int(num_samples / trigger_duration_samples), 2))
-
-    # Add the 3 initial triggers
-    for i, trigger_position in enumerate(trigger_params.initial_trigger_pos):
-        start_index = int(trigger_position * sample_rate)
-        end_index = start_index + trigger_duration_samples
-
-        trigger_positions[i, 0] = trigger_position
-        trigger_signal[start_index:end_index] = trigger_params.trigger_amplitude
-        trigger_positions[i, 1] = trigger_position + trigger_params.trigger_duration
+    _, pulse_bounds = generate_new_trigger_positions(file_name, num_samples, sample_rate, trigger_pos_path,
+                                                     trigger_params, seed)
 
-    # Add the rest of the triggers, randomly spaced throughout the file
-    while end_index < num_samples - 1 * sample_rate:  # run until 1 second from end
+    return render_trigger_pulses(pulse_bounds, num_samples, trigger_params.trigger_amplitude, out=out, dtype=dtype)
 
-        trigger_position += random.uniform(trigger_params.min_trigger_spacing,
-                                           trigger_params.max_trigger_spacing) + trigger_params.trigger_duration
 
-        start_index = int(trigger_position * sample_rate)
-        end_index = start_index + trigger_duration_samples
-
-        trigger_positions[i, 0] = trigger_position
-        trigger_signal[start_index:end_index] = trigger_params.trigger_amplitude
-        trigger_positions[i, 1] = trigger_position + trigger_params.trigger_duration
-
-        i += 1
+def generate_trigger_signal_from_txt(file_name, audio_num_samples, audio_sampling_rate,
+                                   trigger_pos_path, trigger_amplitude=1, out=None, dtype=SAMPLE_DTYPE):
+    """
+    Recreates a trigger signal from the saved trigger positions. The pulses are the same time samples as in the
+    signal they were generated with (see `generate_new_trigger_signal`), and they are all rendered in one pass.
+
+    :param file_name: (str) Name of the stim file (without extension).
+    :param audio_num_samples: (int) The duration of the trigger signal in time samples.
+    :param audio_sampling_rate: (int) The sample rate of the trigger signal in Hz.
+    :param trigger_pos_path: (str) Path to the directory containing the trigger position files.
+    :param trigger_amplitude: (float) Amplitude of each trigger event, between 0 and 1.
+    :param out: (numpy.ndarray, optional) Zero-filled buffer of `audio_num_samples` samples to write the signal into.
+    :param dtype: (numpy.dtype) Sample type of the signal if `out` is None. Defaults to `SAMPLE_DTYPE`.
+
+    :return: (numpy.ndarray) The trigger signal as a 1D NumPy array.
+    """
 
-    # End with a trigger
-    trigger_signal[-trigger_duration_samples:] = trigger_params.trigger_amplitude
+    # Load the saved trigger pulses (binary file if there is an up-to-date one, text file otherwise)
+    pulse_bounds = read_trigger_pulse_bounds(file_name, audio_sampling_rate, trigger_pos_path)
 
-    trigger_positions[i, 0] = (num_samples - trigger_duration_samples) / sample_rate
-    trigger_positions[i, 1] = num_samples / sample_rate
+    return render_trigger_pulses(pulse_bounds, audio_num_samples, trigger_amplitude, out=out, dtype=dtype)
 
-    # Remove trailing zeros from the trigger positions array
-    trigger_positions = trigger_positions[~np.all(trigger_positions == 0, axis=1)]
 
-    # Get output file path
-    trigger_output_file = os.path.join(trigger_pos_path, file_name + '_trigger.txt')
+def read_trigger_pulse_bounds(file_name, audio_sampling_rate, trigger_pos_path):
+    """
+    Reads the saved trigger pulses in time samples.
 
-    # Save the trigger positions
-    np.savetxt(trigger_output_file, trigger_positions, delimiter=',', fmt='%0.6f')
-    print(f"Trigger positions saved to file: {trigger_output_file}")
+    The binary trigger file (see `trigger_format.py`) is memory-mapped if it exists, is at least as recent as the text
+    file and has the same sample rate. Otherwise the positions of the text file are converted to time samples (see
+    `trigger_format.positions_to_pulse_bounds`).
 
-    return trigger_signal
+    The pulses are sorted by onset (see `trigger_format.sort_pulse_bounds`), as `render_trigger_pulses` expects them.
 
+    :param file_name: (str) Name of the stim file (without extension).
+    :param audio_sampling_rate: (int) The sample rate of the audio in Hz.
+    :param trigger_pos_path: (str) Path to the directory containing trigger position .txt files.
 
-def generate_trigger_signal_from_txt(file_name, audio_num_samples, audio_sampling_rate,
-                                   trigger_pos_path, trigger_amplitude=1):
+    :return: (numpy.ndarray) Pulses in time samples, shape (n, 2): first sample and end sample (excluded), sorted by
+        onset.
+    """
 
-    # Get output file path
     trigger_pos_file = os.path.join(trigger_pos_path, file_name + '_trigger.txt')
+    trigger_file = os.path.join(trigger_pos_path, file_name + TRIGGER_FILE_SUFFIX)
 
-    # load the trigger timings from the text file
-    with open(trigger_pos_file, 'r') as f:
-        trigger_positions = [line.strip().split(',') for line in f]
+    if os.path.isfile(trigger_file) and (not os.path.isfile(trigger_pos_file)
+                                         or os.path.getmtime(trigger_file) >= os.path.getmtime(trigger_pos_file)):
+        header, pulse_bounds = load_trigger_file(trigger_file)
+        if header["sample_rate"] == audio_sampling_rate:
+            return sort_pulse_bounds(pulse_bounds)
 
-    # convert the trigger timings to a numpy array
-    trigger_positions = np.array(trigger_positions, dtype=float) * audio_sampling_rate
-
-    # Init trigger signal
-    trigger_signal = np.zeros(audio_num_samples)
-
-    # Add triggers
-    for trigger_onset, trigger_offset in np.round(trigger_positions):
-        trigger_signal[int(trigger_onset):int(trigger_offset + 1)] = trigger_amplitude
-
-    return trigger_signal
+    return positions_to_pulse_bounds(read_text_positions(trigger_pos_file), audio_sampling_rate)
 
 
 def create_trigger_signal(use_existing_txt_file: bool,
                           audio: np.ndarray, sample_rate: int,
-                          file_name: str, trigger_pos_path: str):
+                          file_name: str, trigger_pos_path: str, dtype=SAMPLE_DTYPE):
     """
     Generate or recreate a trigger signal for a given audio, and combine them.
 
@@ -157,34 +352,163 @@ def create_trigger_signal(use_existing_txt_file: bool,
     to recreate a trigger signal based on the `use_existing_txt_file` flag. The resulting
     signal is then combined with the provided audio.
 
+    The (n_samples, 2) output buffer is allocated once: the audio is written after the added silence in the first
+    column and the triggers are rendered in place in the second column.
+
     Parameters:
     :param use_existing_txt_file: (bool) If True, the function uses existing trigger positions saved in a .txt file.
     :param audio: (numpy.ndarray) The input audio signal.
     :param sample_rate: (int) The sample rate of the audio.
     :param file_name: (str) Name of the audio file (used to find the corresponding .txt file if necessary).
     :param trigger_pos_path: (str) Path to the directory containing trigger position .txt files.
+    :param dtype: (numpy.dtype) Sample type of the output (np.float32 or np.int16). Defaults to `SAMPLE_DTYPE`.
 
     :return: (numpy.ndarray) The combined audio with the trigger signal on a separate channel.
     """
 
-    # Add silence to the start of the audio
-    audio = add_silence(audio, sample_rate)
+    # Allocate the output once, with the silence at the start of the audio
+    num_silence_samples = int(SILENCE_DURATION * sample_rate)
+    audio_with_triggers = np.zeros((num_silence_samples + audio.shape[0], 2), dtype=dtype)
+    write_samples(audio_with_triggers[num_silence_samples:, 0], audio)
 
     if use_existing_txt_file:
         # Create trigger signal from existing trigger positions
-        trigger_signal = generate_trigger_signal_from_txt(file_name, audio.shape[0], sample_rate, trigger_pos_path)
+        generate_trigger_signal_from_txt(file_name, audio_with_triggers.shape[0], sample_rate, trigger_pos_path,
+                                         out=audio_with_triggers[:, 1])
     else:
         # Create new trigger signal and save positions to .txt
-        trigger_signal = generate_new_trigger_signal(file_name, audio.shape[0], sample_rate, trigger_pos_path, PARAMS)
-
-    # Combine audio and trigger signals
-    audio_with_triggers = np.column_stack((audio, trigger_signal))
+        generate_new_trigger_signal(file_name, audio_with_triggers.shape[0], sample_rate, trigger_pos_path, PARAMS,
+                                    out=audio_with_triggers[:, 1])
 
     return audio_with_triggers
 
 
+def measure_encoder_delay(output_format: str, sample_rate: int):
+    """
+    Measures the delay at the start of a file encoded in the given format, as played by a decoder that isn't gapless:
+    a short file is encoded, and the encoder delay written in its LAME header is added to the delay of the decoder
+    (see `ENCODER_DELAY_METHOD`).
+
+    :param output_format: (str) Extension of the format ('.mp3').
+    :param sample_rate: (int) Sample rate in Hz.
+
+    :return: (int) The delay in time samples (positive if the decoded signal comes later).
+
+    :raise ValueError: If the delay can't be read from the encoded file.
+    """
+
+    if output_format != '.mp3':
+        raise ValueError(f"The encoder delay of {output_format} files can't be measured")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        encoded_file = os.path.join(temp_dir, 'delay' + output_format)
+        sf.write(encoded_file, np.zeros((sample_rate, 2), dtype=np.float32), sample_rate)
+        lame_delay = read_lame_encoder_delay(encoded_file)
+
+    if lame_delay is None:
+        raise ValueError(f"No LAME header in the {output_format} files written by libsndfile")
+    return lame_delay[0] + MP3_DECODER_DELAY
+
+
+def get_encoder_delay(output_format: str, sample_rate: int, cache_dir: str):
+    """
+    Returns the encoder delay of a format, measured once and then read from a cache file.
+    Lossless formats have no delay. If the delay can't be measured, it is taken as 0 and measured again next time.
+
+    :param output_format: (str) Extension of the format ('.mp3', '.flac', '.wav').
+    :param sample_rate: (int) Sample rate in Hz.
+    :param cache_dir: (str) Directory of the cache file.
+
+    :return: (int) The delay in time samples (see `measure_encoder_delay`).
+    """
+
+    if output_format in LOSSLESS_FORMATS:
+        return 0
+
+    # The delay depends on the encoder and on how it's measured, so the libsndfile version and the method are part of
+    # the key
+    cache_file = os.path.join(cache_dir, ENCODER_DELAY_CACHE_FILENAME)
+    key = f"{output_format} {sample_rate} Hz, libsndfile {sf.__libsndfile_version__}, {ENCODER_DELAY_METHOD}"
+
+    delays = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            delays = json.load(f)
+
+    if key not in delays:
+        try:
+            delays[key] = measure_encoder_delay(output_format, sample_rate)
+        except ValueError as e:
+            print(f"Could not measure the encoder delay for {key} ({e}), no delay is compensated")
+            return 0
+        print(f"Measured encoder delay for {key}: {delays[key]} samples")
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(delays, f, indent=4)
+        os.replace(cache_file + '.tmp', cache_file)
+
+    return delays[key]
+
+
+def save_decoded_trigger_positions(file_name: str, trigger_pos_path: str, delay_seconds: float):
+    """
+    Saves the trigger positions as they are in the decoded stimulus (saved positions shifted by the encoder delay)
+    to a '_trigger_decoded.txt' file. The '_trigger.txt' file is left untouched, so the stimulus can still be
+    recreated from it.
+
+    :param file_name: (str) Name of the stim file (without extension).
+    :param trigger_pos_path: (str) Path to the triggers folder.
+    :param delay_seconds: (float) Encoder delay in seconds.
+    """
+
+    trigger_positions = np.loadtxt(os.path.join(trigger_pos_path, file_name + '_trigger.txt'), delimiter=',', ndmin=2)
+
+    decoded_trigger_file = os.path.join(trigger_pos_path, file_name + '_trigger_decoded.txt')
+    np.savetxt(decoded_trigger_file, trigger_positions + delay_seconds, delimiter=',', fmt='%0.6f')
+    print(f"Decoded trigger positions saved to file: {decoded_trigger_file}")
+
+
+def load_audio(source_file: str, sample_rate: int, res_type=RESAMPLE_TYPE):
+    """
+    Loads an audio file as mono float32 at the given sample rate, doing only the conversions the file needs: the
+    native sample rate and channel layout are read from the header first, a mono file at the right sample rate is
+    returned as it is decoded, a multichannel file is averaged to mono, and only a file at another sample rate is
+    resampled. Files that soundfile can't read are loaded with librosa.
+
+    :param source_file: (str) Path to the audio file.
+    :param sample_rate: (int) Sample rate of the returned audio in Hz.
+    :param res_type: (str) Resampler used if the file isn't at `sample_rate`, one of `RESAMPLE_TYPES`.
+
+    :return: (numpy.ndarray) The mono audio (float32).
+    """
+
+    try:
+        info = sf.info(source_file)
+    except RuntimeError:
+        import librosa
+
+        with profile_stage('decode_resample'):
+            return librosa.load(source_file, sr=sample_rate, res_type=res_type, dtype=np.float32)[0]
+
+    with profile_stage('decode'):
+        audio, _ = sf.read(source_file, dtype='float32')
+        if info.channels > 1:
+            audio = audio.mean(axis=1, dtype=np.float32)
+
+    if info.samplerate != sample_rate:
+        import librosa
+
+        with profile_stage('resample'):
+            print(f"Resampling {os.path.basename(source_file)} from {info.samplerate} Hz to {sample_rate} Hz "
+                  f"({res_type})")
+            audio = librosa.resample(audio, orig_sr=info.samplerate, target_sr=sample_rate, res_type=res_type)
+
+    return audio
+
+
 def add_triggers_to_audio(file_name: str, extension: str, file_paths: namedtuple,
-                          sample_rate, metadata: dict, use_existing_txt_file=True, plot=False):
+                          sample_rate, metadata: dict, use_existing_txt_file=True, plot=False, dtype=SAMPLE_DTYPE,
+                          output_format=OUTPUT_FORMAT, delay_compensation='none', res_type=RESAMPLE_TYPE,
+                          describe=False):
     """
     Process an audio file, add triggers and save it with metadata.
 
@@ -195,37 +519,479 @@ def add_triggers_to_audio(file_name: str, extension: str, file_paths: namedtuple
         `stimuli_file_path`: Path where the new stimulus file with triggers will be saved.
         `trigger_file_path`: Path to save the trigger positions.
     :param sample_rate: (int) Sample rate of the audio.
-    :param metadata: (dict) Metadata information.
+    :param metadata: (dict) Metadata information (tags written to the stimulus while it is encoded).
     :param use_existing_txt_file: (bool) If true and a .txt file exists in the output dir,
         use the saved positions to recreate the trigger signal
     :param plot: (bool) If True, plots the new audio data with triggers on ch 2.
+    :param dtype: (numpy.dtype) Sample type of the audio buffers (np.float32 or np.int16).
+    :param output_format: (str) Format of the stimulus, one of `OUTPUT_FORMATS`. Defaults to `OUTPUT_FORMAT`.
+    :param delay_compensation: (str) How the encoder delay is handled, one of `DELAY_COMPENSATION_MODES`.
+    :param res_type: (str) Resampler used if the file isn't at `sample_rate`, one of `RESAMPLE_TYPES`.
+    :param describe: (bool) If True, return the description of the stimulus.
+
+    :return: (dict) Description of the stimulus (see `describe_stimulus`), None if `describe` is False.
+    """
+
+    # Load audio (mono, resampled only if needed)
+    audio = load_audio(os.path.join(file_paths.source_media_path, file_name + extension), sample_rate, res_type)
+
+    return encode_audio_with_triggers(file_name, audio, file_paths, sample_rate, metadata, use_existing_txt_file,
+                                      plot, dtype, output_format, delay_compensation, describe)
+
+
+def remove_partial_outputs(stim_with_trigs_path):
+    """
+    Removes the partial stimuli left by an interrupted or failed run (see `PARTIAL_OUTPUT_SUFFIX`).
+
+    :param stim_with_trigs_path: (str) Path to the folder of the stimuli with triggers.
+
+    :return: (list) Paths to the removed files.
     """
 
-    # Load audio
-    audio, sr = librosa.load(os.path.join(file_paths.source_media_path, file_name + extension), sr=sample_rate)
+    removed = []
+    for partial_file in glob.glob(os.path.join(stim_with_trigs_path, '*' + PARTIAL_OUTPUT_SUFFIX + '.*')):
+        os.remove(partial_file)
+        removed.append(partial_file)
+    if removed:
+        print(f"Removed {len(removed)} partial stimulus file(s) left by an interrupted or failed run.")
+    return removed
+
+
+def remove_replaced_output(previous_entry, output_file):
+    """
+    Removes the stimulus recorded in the build manifest once it has been rebuilt under another name (e.g. the output
+    format changed), so that the old and the new stimulus aren't both sorted into the playlist.
+
+    :param previous_entry: (dict) Build manifest entry of the source file before the rebuild, None if there was none.
+    :param output_file: (str) Path to the new stimulus.
+
+    :return: (str) Path to the removed stimulus, None if nothing was removed.
+    """
+
+    previous_file = previous_entry.get('output', {}).get('file') if previous_entry else None
+    if not previous_file or previous_file == os.path.basename(output_file):
+        return None
+
+    previous_output = os.path.join(os.path.dirname(output_file), previous_file)
+    if not os.path.isfile(previous_output):
+        return None
+
+    os.remove(previous_output)
+    print("Removed the stimulus replaced by", os.path.basename(output_file) + ":", previous_file)
+    return previous_output
+
+
+def get_partial_output_path(output_path):
+    """
+    Returns the temporary path a stimulus is written to before being renamed to `output_path`.
+
+    :param output_path: (str) Final path of the stimulus.
+
+    :return: (str) The temporary path, e.g. 'song.part.mp3' for 'song.mp3' (same extension, so the format is the same).
+    """
+
+    root, extension = os.path.splitext(output_path)
+    return root + PARTIAL_OUTPUT_SUFFIX + extension
+
+
+def describe_stimulus(output_file, metadata, num_samples, sample_rate):
+    """
+    Describes a stimulus that was just written, from what the encoder already has in hand (its tags, number of samples
+    and sample rate, and its size on disk), so that the ingest pipeline can put it in the metadata cache of the
+    playlist without reading the stimulus again (see `ingest_pipeline.py`). The fields the encoder doesn't know
+    (bitrate, offset of the audio) are left out.
+
+    :param output_file: (str) Path to the stimulus.
+    :param metadata: (dict) Tags written to the stimulus.
+    :param num_samples: (int) Number of time samples of the audio of the stimulus.
+    :param sample_rate: (int) Sample rate of the audio.
+
+    :return: (dict) The playlist metadata of the stimulus (see `create_JSON_playlist.extract_file_metadata`) and the
+        genre of its tags, None if it can't be described (the playlist then reads the stimulus).
+    """
+
+    try:
+        return {"format": os.path.splitext(output_file)[-1],
+                "duration": num_samples / sample_rate,
+                "artist": metadata.get('artist'),
+                "album": metadata.get('album'),
+                "title": metadata.get('title'),
+                "channels": 2,
+                "filesize": os.path.getsize(output_file),
+                "samplerate": sample_rate,
+                "genre": metadata.get('genre')}
+    except Exception as e:
+        print(f"Could not describe {output_file}: {e}")
+        return None
+
+
+def encode_audio_with_triggers(file_name: str, audio: np.ndarray, file_paths: namedtuple, sample_rate,
+                               metadata: dict, use_existing_txt_file=True, plot=False, dtype=SAMPLE_DTYPE,
+                               output_format=OUTPUT_FORMAT, delay_compensation='none', describe=False):
+    """
+    Adds triggers to decoded audio and encodes the stimulus with its tags (the CPU-bound part of
+    `add_triggers_to_audio`, see `pipeline_orchestrator.py`).
+
+    :param file_name: (str) Name of the audio file (without extension).
+    :param audio: (numpy.ndarray) The decoded mono audio, at `sample_rate` (see `load_audio`).
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param sample_rate: (int) Sample rate of the audio.
+    :param metadata: (dict) Tags written to the stimulus while it is encoded.
+    :param use_existing_txt_file: (bool) If true and a .txt file exists in the output dir,
+        use the saved positions to recreate the trigger signal
+    :param plot: (bool) If True, plots the new audio data with triggers on ch 2.
+    :param dtype: (numpy.dtype) Sample type of the audio buffers (np.float32 or np.int16).
+    :param output_format: (str) Format of the stimulus, one of `OUTPUT_FORMATS`.
+    :param delay_compensation: (str) How the encoder delay is handled, one of `DELAY_COMPENSATION_MODES`.
+    :param describe: (bool) If True, return the description of the stimulus.
+
+    :return: (dict) Description of the stimulus (see `describe_stimulus`), None if `describe` is False.
+    """
 
     # Add triggers
-    audio_with_triggers = create_trigger_signal(use_existing_txt_file, audio, sample_rate,
-                                                file_name, file_paths.trigger_pos_path)
+    with profile_stage('triggers'):
+        audio_with_triggers = create_trigger_signal(use_existing_txt_file, audio, sample_rate,
+                                                    file_name, file_paths.trigger_pos_path, dtype)
 
     # Plot the stereo sound if requested
     if plot:
         plot_stereo_audio(audio_with_triggers.T, sample_rate, file_name)
 
-    # Save the audio with triggers as a mp3 file
-    output_abs_filepath = os.path.join(file_paths.stim_with_trigs_path, file_name + ".mp3")
-    sf.write(output_abs_filepath, audio_with_triggers, sample_rate)
+    with profile_stage('encode'):
+        encoder_delay = 0
+        if delay_compensation != 'none':
+            encoder_delay = get_encoder_delay(output_format, sample_rate, file_paths.trigger_pos_path)
+
+        # Shorten the start of the signal so that the decoded stimulus matches the saved positions
+        if delay_compensation == 'preshift':
+            if encoder_delay >= 0:
+                audio_with_triggers = audio_with_triggers[encoder_delay:]
+            else:
+                audio_with_triggers = np.concatenate((np.zeros((-encoder_delay, 2), dtype=audio_with_triggers.dtype),
+                                                      audio_with_triggers))
+
+        # Save the audio with triggers (mp3 by default), with its tags
+        output_abs_filepath = os.path.join(file_paths.stim_with_trigs_path, file_name + output_format)
+        partial_output_filepath = get_partial_output_path(output_abs_filepath)
+        with sf.SoundFile(partial_output_filepath, 'w', samplerate=sample_rate, channels=2) as output_file:
+            tags_written = set_encode_tags(output_file, metadata, output_format)
+            output_file.write(audio_with_triggers)
+
+        if delay_compensation == 'timestamps':
+            save_decoded_trigger_positions(file_name, file_paths.trigger_pos_path, encoder_delay / sample_rate)
+
+    # Tags the encoder couldn't write
+    if not tags_written:
+        with profile_stage('metadata'):
+            add_audio_metadata(partial_output_filepath, metadata)
+
+    os.replace(partial_output_filepath, output_abs_filepath)
+    print("Saving newly created stim file:", output_abs_filepath)
+    if describe:
+        return describe_stimulus(output_abs_filepath, metadata, audio_with_triggers.shape[0], sample_rate)
+    return None
+
+
+def add_triggers_to_audio_streaming(file_name: str, extension: str, file_paths: namedtuple,
+                                    sample_rate, metadata: dict, use_existing_txt_file=True,
+                                    block_size=STREAM_BLOCK_SIZE, dtype=SAMPLE_DTYPE, output_format=OUTPUT_FORMAT,
+                                    delay_compensation='none', res_type=RESAMPLE_TYPE, describe=False):
+    """
+    Process an audio file block by block, add triggers and save it with metadata.
+
+    Same output as `add_triggers_to_audio`, but the silence, the audio and the trigger channel are written to the
+    output file one block at a time, so memory use doesn't depend on the length of the file.
+    Resampling needs the whole file: if the file isn't already at `sample_rate`, `add_triggers_to_audio` is used.
+
+    :param file_name: (str) Name of the audio file.
+    :param extension: (str) Extension of the audio file (mp3 or wav)
+    :param file_paths: (namedtuple FilePaths) Contains paths:
+        `media_file_path`: Path to the source audio without triggers.
+        `stimuli_file_path`: Path where the new stimulus file with triggers will be saved.
+        `trigger_file_path`: Path to save the trigger positions.
+    :param sample_rate: (int) Sample rate of the audio.
+    :param metadata: (dict) Metadata information.
+    :param use_existing_txt_file: (bool) If true and a .txt file exists in the output dir,
+        use the saved positions to recreate the trigger signal
+    :param block_size: (int) Number of time samples read and written at once.
+    :param dtype: (numpy.dtype) Sample type of the audio buffers (np.float32 or np.int16).
+    :param output_format: (str) Format of the stimulus, one of `OUTPUT_FORMATS`. Defaults to `OUTPUT_FORMAT`.
+    :param delay_compensation: (str) How the encoder delay is handled, one of `DELAY_COMPENSATION_MODES`.
+    :param res_type: (str) Resampler used if the file isn't at `sample_rate`, one of `RESAMPLE_TYPES`.
+    :param describe: (bool) If True, return the description of the stimulus.
+
+    :return: (dict) Description of the stimulus (see `describe_stimulus`), None if `describe` is False.
+    """
+
+    source_file = os.path.join(file_paths.source_media_path, file_name + extension)
+    info = sf.info(source_file)
+
+    if info.samplerate != sample_rate:
+        print(f"{file_name}: sample rate is {info.samplerate} Hz, resampling to {sample_rate} Hz "
+              f"requires loading the whole file.")
+        return add_triggers_to_audio(file_name, extension, file_paths, sample_rate, metadata, use_existing_txt_file,
+                                     dtype=dtype, output_format=output_format, delay_compensation=delay_compensation,
+                                     res_type=res_type, describe=describe)
+
+    num_silence_samples = int(SILENCE_DURATION * sample_rate)
+    num_samples = num_silence_samples + info.frames
+
+    # Get the trigger pulses (only their positions are kept in memory)
+    with profile_stage('triggers'):
+        if use_existing_txt_file:
+            pulse_bounds = read_trigger_pulse_bounds(file_name, sample_rate, file_paths.trigger_pos_path)
+        else:
+            _, pulse_bounds = generate_new_trigger_positions(file_name, num_samples, sample_rate,
+                                                             file_paths.trigger_pos_path, PARAMS)
+
+    # Decoding, trigger rendering and encoding are interleaved block by block
+    with profile_stage('decode_triggers_encode'):
+        encoder_delay = 0
+        if delay_compensation != 'none':
+            encoder_delay = get_encoder_delay(output_format, sample_rate, file_paths.trigger_pos_path)
+
+        output_abs_filepath = os.path.join(file_paths.stim_with_trigs_path, file_name + output_format)
+        partial_output_filepath = get_partial_output_path(output_abs_filepath)
+        with sf.SoundFile(partial_output_filepath, 'w', samplerate=sample_rate, channels=2) as output_file:
+            tags_written = set_encode_tags(output_file, metadata, output_format)
+
+            def write_block(audio_block, block_start):
+                block = np.zeros((len(audio_block), 2), dtype=dtype)
+                write_samples(block[:, 0], audio_block)
+                render_trigger_pulses(pulse_bounds, len(audio_block), PARAMS.trigger_amplitude, block_start,
+                                      out=block[:, 1])
+                output_file.write(block)
+                return block_start + len(audio_block)
+
+            # Silence at the start of the audio, shortened by the encoder delay if it is compensated
+            position = 0
+            if delay_compensation == 'preshift':
+                position = max(encoder_delay, 0)
+                output_file.write(np.zeros((max(-encoder_delay, 0), 2), dtype=dtype))
+            while position < num_silence_samples:
+                position = write_block(np.zeros(min(block_size, num_silence_samples - position), dtype=np.float32),
+                                       position)
+
+            # Audio, converted to mono block by block
+            for audio_block in sf.blocks(source_file, blocksize=block_size, dtype='float32', always_2d=True):
+                position = write_block(audio_block.mean(axis=1), position)
+
+            # The decoded length can differ slightly from the length announced in the header (e.g. mp3),
+            # make sure the file still ends with its last trigger
+            while position < num_samples:
+                position = write_block(np.zeros(min(block_size, num_samples - position), dtype=np.float32), position)
+            if position > num_samples:
+                print(f"{file_name}: decoded {position - num_samples} more samples than expected, "
+                      f"the last trigger is not at the end of the file.")
+            num_written_samples = output_file.frames
+
+        if delay_compensation == 'timestamps':
+            save_decoded_trigger_positions(file_name, file_paths.trigger_pos_path, encoder_delay / sample_rate)
+
+    # Tags the encoder couldn't write
+    if not tags_written:
+        with profile_stage('metadata'):
+            add_audio_metadata(partial_output_filepath, metadata)
+
+    os.replace(partial_output_filepath, output_abs_filepath)
     print("Saving newly created stim file:", output_abs_filepath)
+    if describe:
+        return describe_stimulus(output_abs_filepath, metadata, num_written_samples, sample_rate)
+    return None
+
+
+def probe_video_stream(video_path):
+    """
+    Reads the parameters of the first video stream of a file with ffprobe (no decoding).
+
+    :param video_path: (str) Path to the video file.
+
+    :return: (dict) The ffprobe stream fields (codec_name, profile, level, pix_fmt, width, height, r_frame_rate,
+        time_base, sample_aspect_ratio, index), plus the `duration` of the file in seconds.
+    """
+
+    ffprobe_args = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                    '-show_entries', 'stream=index,codec_name,profile,level,pix_fmt,width,height,r_frame_rate,'
+                                     'time_base,sample_aspect_ratio:format=duration',
+                    '-of', 'json', video_path]
+    probe = json.loads(subprocess.check_output(ffprobe_args))
+
+    if not probe.get('streams'):
+        return None
+
+    video_stream = probe['streams'][0]
+    video_stream['duration'] = float(probe['format']['duration'])
+    return video_stream
+
+
+def can_concatenate_lead_in(video_stream):
+    """
+    Checks whether a black lead-in matching the video stream can be encoded and joined to it without re-encoding.
+
+    :param video_stream: (dict) Video stream parameters, as returned by `probe_video_stream`.
+
+    :return: (bool) True if the lead-in can be joined with a stream copy.
+    """
+
+    return (video_stream is not None
+            # the concat demuxer matches streams by index
+            and video_stream['index'] == 0
+            and video_stream['codec_name'] in LEAD_IN_ENCODERS
+            and str(video_stream.get('profile', '')).lower() in LEAD_IN_PROFILES
+            and video_stream.get('pix_fmt') is not None)
+
+
+def create_black_lead_in(video_stream, output_path, duration=SILENCE_DURATION):
+    """
+    Encodes a black video segment with the same codec parameters as the given video stream, so both can be joined
+    with the ffmpeg concat demuxer without re-encoding.
+
+    :param video_stream: (dict) Video stream parameters, as returned by `probe_video_stream`.
+    :param output_path: (str) Path of the black segment to create (mp4).
+    :param duration: (float) Duration of the black segment in seconds. Defaults to `SILENCE_DURATION`.
+    """
 
-    # Add the metadata to the new audio file (mp3)
-    add_audio_metadata(output_abs_filepath, metadata)
+    sample_aspect_ratio = video_stream.get('sample_aspect_ratio', '1:1')
+    if sample_aspect_ratio in ('0:1', 'N/A'):
+        sample_aspect_ratio = '1:1'
+
+    ffmpeg_args = ['ffmpeg', '-v', 'error', '-y',
+                   '-f', 'lavfi', '-i', f"color=c=black:s={video_stream['width']}x{video_stream['height']}"
+                                        f":r={video_stream['r_frame_rate']}:d={duration}",
+                   '-vf', f"setsar={sample_aspect_ratio.replace(':', '/')}",
+                   '-c:v', LEAD_IN_ENCODERS[video_stream['codec_name']],
+                   '-profile:v', LEAD_IN_PROFILES[video_stream['profile'].lower()],
+                   '-pix_fmt', video_stream['pix_fmt'],
+                   '-video_track_timescale', video_stream['time_base'].split('/')[1],
+                   '-an', output_path]
+
+    # h264 levels are reported as e.g. 40 for level 4.0
+    if video_stream['codec_name'] == 'h264' and int(video_stream.get('level', -99)) > 0:
+        ffmpeg_args[-2:-2] = ['-level:v', f"{int(video_stream['level']) / 10:.1f}"]
+
+    subprocess.check_call(ffmpeg_args)
+
+
+def decode_video_audio(video_path, sample_rate):
+    """
+    Decodes the audio track of a video file to a mono signal with ffmpeg.
+
+    :param video_path: (str) Path to the video file.
+    :param sample_rate: (int) Sample rate of the decoded audio in Hz.
+
+    :return: (numpy.ndarray) The mono audio as a 1D NumPy array.
+    """
+
+    ffmpeg_args = ['ffmpeg', '-v', 'error', '-i', video_path, '-vn', '-ac', '1', '-ar', str(sample_rate),
+                   '-f', 'f32le', '-']
+    return np.frombuffer(subprocess.check_output(ffmpeg_args), dtype=np.float32)
+
+
+def add_triggers_to_video_stream_copy(file_name: str, extension: str, file_paths: namedtuple,
+                                      sample_rate, video_thumbnails_path: str, use_existing_txt_file=True,
+                                      plot=False, dtype=SAMPLE_DTYPE):
+    """
+    Process a video file without re-encoding its video stream: a black lead-in is encoded with the same codec
+    parameters as the source and joined to the original video with a stream copy, and the new audio (with triggers)
+    and the original metadata are muxed in the same ffmpeg call.
+
+    The joined video is decoded with the parameter sets (SPS/PPS, and VPS for HEVC) of the lead-in, so the lead-in is
+    only used if its decoder configuration is the same as the one of the source (see
+    `media_probe.read_mp4_video_config`). The source starts exactly `SILENCE_DURATION` after the start of the video,
+    like the audio after the silence, even when the lead-in can't be a whole number of frames long (e.g. 30000/1001 fps).
+
+    :param file_name: (str) Name of the video file.
+    :param extension: (str) Extension of the video file (mp4)
+    :param file_paths: (namedtuple FilePaths) Contains paths:
+        - `media_file_path`: Path to the source video without triggers.
+        - `stimuli_file_path`: Path where the new stimulus file with triggers will be saved.
+        - `trigger_file_path`: Path to save the trigger positions.
+    :param sample_rate: (int) Sample rate of the audio in the video.
+    :param video_thumbnails_path: (str) Path to save the video thumbnail.
+    :param use_existing_txt_file: (bool) If true and a .txt file exists in the output dir, use the saved positions to
+        recreate the trigger signal
+    :param plot: (bool) If True, plots the audio data.
+    :param dtype: (numpy.dtype) Sample type of the audio buffers (np.float32 or np.int16).
+
+    :return: (int) Number of time samples of the audio of the stimulus, None if the source can't be joined to a
+        lead-in without re-encoding (different codec parameters or parameter sets, nothing is done in this case).
+    """
+
+    source_file = os.path.join(file_paths.source_media_path, file_name + extension)
+    output_file = os.path.join(file_paths.stim_with_trigs_path, f"{file_name}.mp4")
+    partial_output_file = get_partial_output_path(output_file)
+
+    with profile_stage('probe'):
+        video_stream = probe_video_stream(source_file)
+    if not can_concatenate_lead_in(video_stream):
+        return None
+
+    with tempfile.TemporaryDirectory(dir=file_paths.stim_with_trigs_path) as temp_dir:
+
+        # Black screen as long as the added silence, with the parameter sets of the source
+        lead_in_file = os.path.join(temp_dir, 'lead_in.mp4')
+        with profile_stage('lead_in'):
+            create_black_lead_in(video_stream, lead_in_file)
+            source_config = read_mp4_video_config(source_file)
+            same_config = source_config is not None and source_config == read_mp4_video_config(lead_in_file)
+        if not same_config:
+            print(f"{file_name}: the parameter sets of the lead-in differ from the ones of the source.")
+            return None
+
+        # Load audio and add triggers
+        with profile_stage('decode'):
+            audio = decode_video_audio(source_file, sample_rate)
+        with profile_stage('triggers'):
+            audio_with_triggers = create_trigger_signal(use_existing_txt_file, audio, sample_rate,
+                                                        file_name, file_paths.trigger_pos_path, dtype)
+
+        # Plot the stereo sound if requested
+        if plot:
+            plot_stereo_audio(audio_with_triggers.T, sample_rate, file_name)
+
+        # Audio with triggers and muxing
+        with profile_stage('encode'):
+            # The source starts after exactly SILENCE_DURATION (the last frame of the lead-in is shortened if needed)
+            concat_list_file = os.path.join(temp_dir, 'concat.txt')
+            with open(concat_list_file, 'w', encoding='utf-8') as f:
+                for video_file in (lead_in_file, source_file):
+                    f.write("file '{}'\n".format(os.path.abspath(video_file).replace("'", "'\\''")))
+                    if video_file == lead_in_file:
+                        f.write(f"duration {SILENCE_DURATION}\n")
+
+            audio_file = os.path.join(temp_dir, 'audio_with_triggers.wav')
+            sf.write(audio_file, audio_with_triggers, sample_rate,
+                     subtype='PCM_16' if np.issubdtype(dtype, np.integer) else 'FLOAT')
+
+            # Join the videos, add the audio with triggers and copy the metadata of the source in one go
+            ffmpeg_args = ['ffmpeg', '-v', 'error', '-y',
+                           '-f', 'concat', '-safe', '0', '-i', concat_list_file,
+                           '-i', audio_file,
+                           '-i', source_file,
+                           '-map', '0:v:0', '-map', '1:a:0', '-map_metadata', '2',
+                           '-c:v', 'copy', '-c:a', 'aac',
+                           partial_output_file]
+            subprocess.check_call(ffmpeg_args)
+
+    # Generate and save thumbnail (at a tenth of the new video, taken from the source)
+    with profile_stage('thumbnail'):
+        create_thumbnails(source_file, video_thumbnails_path, lead_in=SILENCE_DURATION,
+                          duration=video_stream['duration'])
+
+    os.replace(partial_output_file, output_file)
+    print("Saving newly created stim file:", output_file)
+    return audio_with_triggers.shape[0]
 
 
 def add_triggers_to_video(file_name: str, extension: str, file_paths: namedtuple,
-                          sample_rate, video_thumbnails_path: str, use_existing_txt_file=True, plot=False):
+                          sample_rate, video_thumbnails_path: str, use_existing_txt_file=True, plot=False,
+                          stream_copy=True, dtype=SAMPLE_DTYPE, metadata=None, describe=False):
     """
     Process a video file, add triggers to its audio, save the video with metadata, and generate a thumbnail.
 
+    By default the video stream is not re-encoded (see `add_triggers_to_video_stream_copy`). If the codec parameters
+    of the source don't allow it, the whole video is re-encoded with moviepy.
+
     :param file_name: (str) Name of the video file.
     :param file_paths: (namedtuple FilePaths) Contains paths:
         - `media_file_path`: Path to the source video without triggers.
@@ -236,21 +1002,49 @@ def add_triggers_to_video(file_name: str, extension: str, file_paths: namedtuple
     :param use_existing_txt_file: (bool) If true and a .txt file exists in the output dir, use the saved positions to
         recreate the trigger signal
     :param plot: (bool) If True, plots the audio data.
+    :param stream_copy: (bool) If True, try to add the lead-in and the new audio without re-encoding the video.
+    :param dtype: (numpy.dtype) Sample type of the audio buffers (np.float32 or np.int16). The moviepy path always
+        uses np.float32.
+    :param metadata: (dict, optional) Tags of the source, written while the video is re-encoded by moviepy (read from
+        the source if None). The stream copy path copies all the metadata of the source in the same ffmpeg call.
+    :param describe: (bool) If True, return the description of the stimulus.
+
+    :return: (dict) Description of the stimulus (see `describe_stimulus`), None if `describe` is False.
     """
 
+    if metadata is None:
+        metadata = read_source_tags(os.path.join(file_paths.source_media_path, file_name + extension))
+    output_file = os.path.join(file_paths.stim_with_trigs_path, f"{file_name}.mp4")
+
+    if stream_copy:
+        num_samples = add_triggers_to_video_stream_copy(file_name, extension, file_paths, sample_rate,
+                                                        video_thumbnails_path, use_existing_txt_file, plot, dtype)
+        if num_samples is not None:
+            return describe_stimulus(output_file, metadata, num_samples, sample_rate) if describe else None
+        print(f"{file_name}: codec parameters don't allow joining the lead-in without re-encoding, "
+              f"re-encoding the whole video.")
+
+    import librosa
+    from moviepy.audio import AudioClip
+    from moviepy.video.VideoClip import ColorClip
+    from moviepy.video.compositing.concatenate import concatenate_videoclips
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+
     # Load video and audio
-    video_clip = VideoFileClip(os.path.join(file_paths.source_media_path, file_name + extension))
-    audio = video_clip.audio.to_soundarray(fps=sample_rate)
+    with profile_stage('decode'):
+        video_clip = VideoFileClip(os.path.join(file_paths.source_media_path, file_name + extension))
+        audio = video_clip.audio.to_soundarray(fps=sample_rate)
 
-    # If stereo, convert to mono
-    if audio.ndim > 1:
-        audio = librosa.to_mono(audio.T)
-    else:
-        audio = audio.T
+        # If stereo, convert to mono
+        if audio.ndim > 1:
+            audio = librosa.to_mono(audio.T)
+        else:
+            audio = audio.T
 
-    # Add triggers
-    audio_with_triggers = create_trigger_signal(use_existing_txt_file, audio, sample_rate,
-                                                file_name, file_paths.trigger_pos_path)
+    # Add triggers (moviepy expects float samples)
+    with profile_stage('triggers'):
+        audio_with_triggers = create_trigger_signal(use_existing_txt_file, audio, sample_rate,
+                                                    file_name, file_paths.trigger_pos_path, np.float32)
 
     # Plot the stereo sound if requested
     if plot:
@@ -260,75 +1054,50 @@ def add_triggers_to_video(file_name: str, extension: str, file_paths: namedtuple
     black_screen = ColorClip((video_clip.size), col=(0, 0, 0), duration=SILENCE_DURATION)
     video_clip = concatenate_videoclips([black_screen, video_clip])
 
-    # generate and save thumbnail
+    # generate and save thumbnail (from the source, without going through the composited clip)
     video = video_clip.set_audio(AudioClip.AudioArrayClip(audio_with_triggers, fps=sample_rate))
-    thumbnail_time = video.duration / 10
-    video.save_frame(os.path.join(video_thumbnails_path, f"{file_name}.jpg"), t=thumbnail_time)
-
-    # Save video
-    video.write_videofile(os.path.join(file_paths.stim_with_trigs_path, f"{file_name}.mp4"),
-                          bitrate='5000k',
-                          write_logfile=False,
-                          codec='libx264',
-                          audio_codec='aac',
-                          temp_audiofile=f'{file_name}-temp-audio.m4a',
-                          remove_temp=True,
-                          preset='veryfast',
-                          logger="bar")
-
-    # Add the metadata to the new video file (mp4)
-    add_video_metadata(os.path.join(file_paths.source_media_path, file_name + extension),
-                       os.path.join(file_paths.stim_with_trigs_path, f"{file_name}.mp4"),)  # source_media_path, stim_with_trigs_path
+    with profile_stage('thumbnail'):
+        create_thumbnails(os.path.join(file_paths.source_media_path, file_name + extension), video_thumbnails_path,
+                          lead_in=SILENCE_DURATION, duration=video.duration - SILENCE_DURATION)
+
+    # Save video, with its tags
+    partial_output_file = get_partial_output_path(output_file)
+    with profile_stage('encode'):
+        video.write_videofile(partial_output_file,
+                              bitrate='5000k',
+                              write_logfile=False,
+                              codec='libx264',
+                              audio_codec='aac',
+                              temp_audiofile=f'{file_name}-temp-audio.m4a',
+                              remove_temp=True,
+                              preset='veryfast',
+                              ffmpeg_params=ffmpeg_metadata_args(metadata),
+                              logger="bar")
+
+    os.replace(partial_output_file, output_file)
+    if describe:
+        return describe_stimulus(output_file, metadata, audio_with_triggers.shape[0], sample_rate)
+    return None
 
 
 def add_audio_metadata(stim_with_trigs_path: str, metadata: dict):
     """
-    Add or update the metadata of a media file using the provided metadata information.
+    Add or update the metadata of a media file using the provided metadata information, without re-encoding it.
+    Only used when the tags couldn't be written while encoding the stimulus (see `media_tags.py`).
 
     The metadata dictionary can have the following keys: 'title', 'artist', 'album', and 'genre'.
-    If a key is not present, its corresponding metadata in the media file will be set to an empty string.
+    If a key is not present, its corresponding metadata in the media file is removed.
 
     :param stim_with_trigs_path: Path to the media file for which metadata needs to be updated.
     :param metadata: Dictionary containing the metadata information.
     """
 
-    # Load the stim file with triggers
-    stimulus_file = eyed3.load(stim_with_trigs_path)
-
-    # Check if the media file has existing metadata tags
-    # If not, initialize a new tag for it
-    if stimulus_file.tag is None:
-        stimulus_file.initTag()
-
-    # Update the  metadata or set fields to an empty string if not provided
-    stimulus_file.tag.title = metadata.get('title', '')
-    stimulus_file.tag.artist = metadata.get('artist', '')
-    stimulus_file.tag.album = metadata.get('album', '')
-    stimulus_file.tag.genre = metadata.get('genre', '')
-
-    # Save the changes made to the metadata
-    stimulus_file.tag.save()
-
-
-def add_video_metadata(abspath_to_original_video_w_metadata, abspath_to_new_video_w_triggers):
-    """
-    Copies metadata from an original video file to a new video file.
-
-    :param abspath_to_original_video_w_metadata: (str) Path to the original video file with metadata.
-    :param abspath_to_new_video_w_triggers: (str) Path to the new video file with triggers.
-    """
-
-    # Copy over the metadata from the original video file to a new 'temp' video file
-    ffmpeg_args = ['ffmpeg', '-i', abspath_to_original_video_w_metadata, '-i', abspath_to_new_video_w_triggers, '-map_metadata', '0', '-c', 'copy',
-                   '-map', '1:v:0', '-map', '1:a:0', '-y', os.path.splitext(abspath_to_new_video_w_triggers)[0] + '_temp' + '.mp4']
-    subprocess.check_call(ffmpeg_args)
-
-    # Replace the 'temp' file with the final output file
-    os.remove(abspath_to_new_video_w_triggers)
-    os.rename(os.path.splitext(abspath_to_new_video_w_triggers)[0] + '_temp' + '.mp4', abspath_to_new_video_w_triggers)
+    write_tags_in_place(stim_with_trigs_path, metadata)
 
 
 def plot_stereo_audio(stereo_sound, sr, filename):
+    import matplotlib.pyplot as plt
+
     fig, (ax1, ax2) = plt.subplots(nrows=2, sharex='all', figsize=[12, 3])
     ax1.plot(np.arange(len(stereo_sound[0])) / sr, stereo_sound[0])
     ax1.set_ylabel('ch1')
@@ -341,56 +1110,327 @@ def plot_stereo_audio(stereo_sound, sr, filename):
     plt.show()
 
 
+def check_processing_options(output_format=OUTPUT_FORMAT, delay_compensation='none', res_type=RESAMPLE_TYPE):
+    """
+    Raises a ValueError if one of the processing options is unknown.
+
+    :param output_format: (str) Format of the audio stimuli, one of `OUTPUT_FORMATS`.
+    :param delay_compensation: (str) How the encoder delay is handled, one of `DELAY_COMPENSATION_MODES`.
+    :param res_type: (str) Resampler, one of `RESAMPLE_TYPES`.
+    """
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}")
+    if delay_compensation not in DELAY_COMPENSATION_MODES:
+        raise ValueError(f"Unknown delay compensation '{delay_compensation}', "
+                         f"expected one of {DELAY_COMPENSATION_MODES}")
+    if res_type not in RESAMPLE_TYPES:
+        raise ValueError(f"Unknown resampler '{res_type}', expected one of {RESAMPLE_TYPES}")
+
+
 def process_media_file(file_name, file_paths, video_thumbnails_path,
-                 sample_rate=44100, use_existing_txt_file: bool = True, plot: bool = False):
+                 sample_rate=SAMPLE_RATE, use_existing_txt_file: bool = True, plot: bool = False, streaming: bool = False,
+                 dtype=SAMPLE_DTYPE, output_format=OUTPUT_FORMAT, delay_compensation='none', res_type=RESAMPLE_TYPE,
+                 profile_log=None, describe=False):
     """
     Process an audio or video file based on its extension.
 
+    The wall time, CPU time, bytes read and written and peak memory of each stage (decoding, triggers, encoding,
+    metadata, ...) are recorded and printed, and appended to `profile_log` (see `stage_profiler.py` for the
+    environment variables that enable cProfile / tracemalloc captures).
+
     :param file_name: (str) Name of the file.
     :param file_paths: (namedtuple FilePaths) Contains paths:
         `media_file_path`: Path to the source media without triggers.
         `stimuli_file_path`: Path where the new stimulus file with triggers will be saved.
         `trigger_file_path`: Path to save the trigger positions.
     :param video_thumbnails_path: (str) Path to save the video thumbnail if the file is a video.
-    :param sample_rate: (int, optional) Sample rate for the audio. Default is 44100.
+    :param sample_rate: (int, optional) Sample rate for the audio. Default is `SAMPLE_RATE` (44100).
     :param use_existing_txt_file: (bool, optional) If True and a .txt file already exists in the output dir,
         recreate the trigger signal using the saved positions.
     :param plot: (bool, optional) If True, plots the audio data. Defaults to False.
+    :param streaming: (bool, optional) If True, audio files are processed block by block with constant memory use
+        (see `add_triggers_to_audio_streaming`). Plotting is not available in this mode. Defaults to False.
+    :param dtype: (numpy.dtype, optional) Sample type of the audio buffers, np.float32 or np.int16.
+        Defaults to `SAMPLE_DTYPE`.
+    :param output_format: (str, optional) Format of the audio stimuli, one of `OUTPUT_FORMATS`. Videos are always
+        saved as mp4. Defaults to `OUTPUT_FORMAT` ('.mp3').
+    :param delay_compensation: (str, optional) How the encoder delay of lossy audio formats is handled, one of
+        `DELAY_COMPENSATION_MODES`. Defaults to 'none'.
+    :param res_type: (str, optional) Resampler used for audio files that aren't at `sample_rate`, one of
+        `RESAMPLE_TYPES`. Defaults to `RESAMPLE_TYPE` ('soxr_hq').
+    :param profile_log: (str, optional) JSON-lines file the stage timings are appended to. Defaults to None (timings
+        are only printed, unless the CORTIFY_PROFILE_LOG environment variable is set).
+    :param describe: (bool, optional) If True, return the description of the stimulus (used by the ingest pipeline).
+        Defaults to False.
+
+    :return: (dict) Playlist metadata and genre of the stimulus (see `describe_stimulus`), None if `describe` is
+        False.
     """
 
+    check_processing_options(output_format, delay_compensation, res_type)
+
     # Extract the file extension to determine if it's audio or video
     file_name, extension = os.path.splitext(file_name)
     print(file_name)
 
-    # Check metadata
+    with StageProfiler(file_name + extension, profile_log) as profiler:
+
+        # Read the tags of the source once, they are written to the stimulus while it is encoded
+        with profile_stage('read_tags'):
+            metadata = read_source_tags(os.path.join(file_paths.source_media_path, file_name + extension))
+
+        # Process audio file
+        if extension in ('.mp3', '.wav') and streaming:
+            stimulus = add_triggers_to_audio_streaming(file_name, extension, file_paths,
+                                                       sample_rate, metadata, use_existing_txt_file, dtype=dtype,
+                                                       output_format=output_format,
+                                                       delay_compensation=delay_compensation, res_type=res_type,
+                                                       describe=describe)
+
+        elif extension in ('.mp3', '.wav'):
+            stimulus = add_triggers_to_audio(file_name, extension, file_paths,
+                                             sample_rate, metadata, use_existing_txt_file, plot=plot, dtype=dtype,
+                                             output_format=output_format, delay_compensation=delay_compensation,
+                                             res_type=res_type, describe=describe)
+
+        # Process video file
+        elif extension == '.mp4':
+            stimulus = add_triggers_to_video(file_name, extension, file_paths,
+                                             sample_rate, video_thumbnails_path, use_existing_txt_file, plot=plot,
+                                             dtype=dtype, metadata=metadata, describe=describe)
+
+        else:
+            raise ValueError(f'Currently unsupported file extension: {extension}')
+
+    print(f"{file_name}{extension}: {profiler.summary()}")
+    return stimulus
+
+
+def get_output_file_name(file_name, output_format=OUTPUT_FORMAT):
+    """
+    Returns the name of the stimulus built from a source media file.
+
+    :param file_name: (str) Name of the source file (with extension).
+    :param output_format: (str) Format of the audio stimuli (see `OUTPUT_FORMATS`).
+
+    :return: (str) Name of the stimulus file with triggers.
+    """
+
+    file_name, extension = os.path.splitext(file_name)
+    return file_name + ('.mp4' if extension == '.mp4' else output_format)
+
+
+def get_build_params():
+    """
+    Returns the parameters that define the generated stimuli, as recorded in the build manifest.
+
+    :return: (dict) Trigger parameters, duration of the added silence and sample rate.
+    """
+
+    return {'trigger_params': PARAMS._asdict(),
+            'silence_duration': SILENCE_DURATION,
+            'sample_rate': SAMPLE_RATE}
+
+
+def get_output_options(file_name, delay_compensation='none', res_type=RESAMPLE_TYPE):
+    """
+    Returns the encoding options of a stimulus, as recorded in the build manifest. They change the output file but
+    not the trigger positions.
+
+    :param file_name: (str) Name of the source file (with extension).
+    :param delay_compensation: (str) How the encoder delay is handled (see `DELAY_COMPENSATION_MODES`).
+    :param res_type: (str) Resampler used for audio files that aren't at the target sample rate.
+
+    :return: (dict) The encoding options (empty for videos).
+    """
+
+    if os.path.splitext(file_name)[-1] == '.mp4':
+        return {}
+    options = {'delay_compensation': delay_compensation, 'res_type': res_type}
+    if delay_compensation != 'none':
+        options['delay_method'] = ENCODER_DELAY_METHOD
+    return options
+
+
+def run_media_job(file_name, file_paths, video_thumbnails_path, **kwargs):
+    """
+    Process a single media file and report the outcome instead of raising, so that one failing file doesn't stop
+    a batch. Used as the unit of work by `find_new_stim_and_add_triggers`, both sequentially and in worker processes.
+
+    :param file_name: (str) Name of the file (with extension).
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param video_thumbnails_path: (str) Path to save the video thumbnail if the file is a video.
+    :param kwargs: Keyword arguments forwarded to `process_media_file`.
+
+    :return: (MediaJobResult) File name, wall time in seconds, the error message (None on success) and the description
+        of the stimulus (None on failure).
+    """
+
+    start_time = time.perf_counter()
+    stimulus = None
     try:
-        tag = taglib.File(os.path.join(file_paths.source_media_path, file_name + extension))
-        artist_list = tag.tags.get("ARTIST")
-        metadata = {"title": tag.tags.get("TITLE")[0],
-                    "artist": ', '.join(artist_list) if len(artist_list) > 1 else (
-                        tag.tags.get("ARTIST")[0] if len(artist_list) == 1 else None),
-                    "album": tag.tags.get("ALBUM")[0],
-                    "genre": tag.tags.get("GENRE")[0]}
+        stimulus = process_media_file(file_name, file_paths, video_thumbnails_path, **kwargs)
+        error = None
     except Exception as e:
-        print(f"Failed to read metadata from {file_paths.source_media_path}: {e}")
-        metadata = {}
+        error = f"{type(e).__name__}: {e}"
 
-    # Process audio file
-    if extension in ('.mp3', '.wav'):
-        add_triggers_to_audio(file_name, extension, file_paths,
-                              sample_rate, metadata, use_existing_txt_file, plot=plot)
+    return MediaJobResult(file_name, time.perf_counter() - start_time, error, stimulus)
 
-    # Process video file
-    elif extension == '.mp4':
-        add_triggers_to_video(file_name, extension, file_paths,
-                              sample_rate, video_thumbnails_path, use_existing_txt_file, plot=plot)
 
-    else:
-        raise ValueError(f'Currently unsupported file extension: {extension}')
+def run_isolated_job(job, file_name):
+    """
+    Runs the job of a media file in its own worker process, so that a crash of the process (e.g. killed when out of
+    memory) is reported as the failure of this file.
+
+    :param job: (callable) Picklable job returning a MediaJobResult, e.g. a `functools.partial` of `run_media_job`.
+    :param file_name: (str) Name of the source file (with extension).
+
+    :return: (MediaJobResult) Outcome of the file.
+    """
 
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(job).result()
+        except BrokenProcessPool as e:
+            return MediaJobResult(file_name, time.perf_counter() - start_time,
+                                  f"{type(e).__name__}: the worker process crashed (e.g. out of memory)")
 
-def find_new_stim_and_add_triggers(cortify_media_dir, accepted_formats=('.wav', '.mp3', 'mp4'),
-                                   plot=False, overwrite_existing_triggers=False):
+
+def run_media_jobs_in_processes(jobs, file_paths, video_thumbnails_path, n_workers, report_result, **kwargs):
+    """
+    Processes media files in `n_workers` worker processes (see `run_media_job`), reporting each file as soon as its
+    worker is done.
+
+    A worker process that crashes (e.g. killed when out of memory) breaks the whole pool, and every unfinished file
+    fails with it. The files are sent to the workers in order, so the crash comes from one of the first `n_workers`
+    unfinished files: they are processed again one at a time in their own process (see `run_isolated_job`), so
+    that only the file that crashes is reported as failed, and the other files are processed in a fresh pool.
+
+    :param jobs: (list) The files to process, as (file name, use_existing_txt_file, rebuild reason) tuples (see
+        `find_media_to_process`).
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param video_thumbnails_path: (str) Path to save the video thumbnails.
+    :param n_workers: (int) Number of worker processes.
+    :param report_result: (callable) Called with the MediaJobResult of each file as soon as it is done.
+    :param kwargs: Keyword arguments forwarded to `process_media_file`.
+    """
+
+    while jobs:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(run_media_job, file_name, file_paths, video_thumbnails_path,
+                                       use_existing_txt_file=use_existing_txt_file, **kwargs)
+                       for file_name, use_existing_txt_file, _ in jobs]
+
+            for future in as_completed(futures):
+                if not isinstance(future.exception(), BrokenProcessPool):
+                    report_result(future.result())
+
+        unfinished = [job for job, future in zip(jobs, futures) if isinstance(future.exception(), BrokenProcessPool)]
+        suspects, jobs = unfinished[:n_workers], unfinished[n_workers:]
+
+        if suspects:
+            print(f"A worker process crashed, processing {len(suspects)} file(s) one at a time to find which one.")
+        for file_name, use_existing_txt_file, _ in suspects:
+            report_result(run_isolated_job(partial(run_media_job, file_name, file_paths, video_thumbnails_path,
+                                                   use_existing_txt_file=use_existing_txt_file, **kwargs), file_name))
+
+
+def print_batch_summary(results):
+    """
+    Print the wall time of every processed file, followed by the failed files and their errors.
+
+    :param results: (list of MediaJobResult) Outcomes of the processed files.
+    """
+
+    print("\nBatch summary:")
+    for result in sorted(results, key=lambda r: r.file_name):
+        status = "FAILED" if result.error else "ok"
+        print(f"  {result.wall_time:9.1f} s  {status:6}  {result.file_name}")
+
+    failed = [result for result in results if result.error]
+    print(f"{len(results) - len(failed)} file(s) processed, {len(failed)} failed, "
+          f"{sum(result.wall_time for result in results):.1f} s of processing in total.")
+    for result in failed:
+        print(f"  - {result.file_name}: {result.error}")
+
+
+def find_media_to_process(file_paths, accepted_formats, manifest, overwrite_existing_triggers=False,
+                          output_format=OUTPUT_FORMAT, delay_compensation='none', res_type=RESAMPLE_TYPE):
+    """
+    Lists the source media files whose stimulus must be (re)built, using the build manifest to tell which ones
+    changed since the last run (see `build_manifest.py`).
+
+    Stimuli built before the manifest existed are added to it as they are, without being rebuilt.
+
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param accepted_formats: (tuple) which filename extensions to look for
+    :param manifest: (dict) The build manifest (updated in place for stimuli added to it without being rebuilt).
+    :param overwrite_existing_triggers: (bool) if True, rebuild every stimulus and draw new trigger positions.
+    :param output_format: (str) Format of the audio stimuli (see `OUTPUT_FORMATS`).
+    :param delay_compensation: (str) How the encoder delay is handled (see `DELAY_COMPENSATION_MODES`).
+    :param res_type: (str) Resampler used for audio files that aren't at the target sample rate.
+
+    :return: (tuple) The jobs to run, as a list of (file name, use_existing_txt_file, rebuild reason) tuples,
+        and the fingerprints of the source files, keyed by file name.
+    """
+
+    build_params = get_build_params()
+    jobs = []
+    source_fingerprints = {}
+
+    # Loop over all files in the input folder ('Cortify_Media > Add_Triggers > original_stimuli')
+    for file_name in sorted(os.listdir(file_paths.source_media_path)):
+        original_file = os.path.join(file_paths.source_media_path, file_name)
+        if not (os.path.isfile(original_file) and file_name.endswith(accepted_formats)):
+            continue
+
+        output_file = os.path.join(file_paths.stim_with_trigs_path, get_output_file_name(file_name, output_format))
+        output_options = get_output_options(file_name, delay_compensation, res_type)
+        trigger_file = os.path.join(file_paths.trigger_pos_path, os.path.splitext(file_name)[0] + '_trigger.txt')
+
+        entry = manifest.get(file_name)
+        source_fingerprints[file_name] = file_fingerprint(original_file, entry['source'] if entry else None)
+
+        if overwrite_existing_triggers:
+            reason = "overwrite requested"
+
+        elif entry is None and os.path.isfile(output_file):
+            # Stimulus built before the build manifest existed, keep it as it is
+            manifest[file_name] = make_build_entry(source_fingerprints[file_name], output_file, build_params,
+                                                   PIPELINE_VERSION, output_options=output_options)
+            print("File already exists in destination folder, added to the build manifest:", file_name)
+            continue
+
+        else:
+            reason = rebuild_reason(entry, source_fingerprints[file_name], output_file, build_params,
+                                    PIPELINE_VERSION, output_options)
+
+        if reason is None:
+            print("File already exists in destination folder and is up to date:", file_name)
+            continue
+
+        # check if a .txt (trigger positions) with the same base name exists in output folder
+        # ('Cortify_Media > Add_Triggers > triggers')
+        # If the .txt file exists and the positions are still valid for this source and these parameters:
+        #     use the trigger positions saved in the existing file to recreate the stim
+        # Otherwise (or if you want to overwrite the existing .txt file):
+        #     create a new trigger signal
+        use_existing_txt_file = (os.path.isfile(trigger_file) and not overwrite_existing_triggers
+                                 and reason not in (SOURCE_CHANGED, PARAMS_CHANGED))
+
+        print(f"{file_name}: {reason}, " + ("recreating the stim from the saved trigger positions"
+                                             if use_existing_txt_file else "creating a new trigger signal"))
+        jobs.append((file_name, use_existing_txt_file, reason))
+
+    return jobs, source_fingerprints
+
+
+def find_new_stim_and_add_triggers(cortify_media_dir, accepted_formats=('.wav', '.mp3', '.mp4'),
+                                   plot=False, overwrite_existing_triggers=False, n_workers=1, streaming=False,
+                                   output_format=OUTPUT_FORMAT, delay_compensation='none', res_type=RESAMPLE_TYPE,
+                                   pipelined=False, n_decoders=1, queue_size=2, describe_stimuli=False):
     """
     Processes media files in the specified directory, adding trigger signals to them. Depending on whether trigger
     position files (i.e., .txt files) exist or the `overwrite_existing_triggers` flag is set, the function either
@@ -399,28 +1439,58 @@ def find_new_stim_and_add_triggers(cortify_media_dir, accepted_formats=('.wav',
     The function saves the processed media files to a specified output directory and optionally
     plots the audio with triggers.
 
+    A record of the built stimuli is kept in 'Cortify_Media > Add_Triggers > build_manifest.json' (source hash,
+    trigger parameters, pipeline version, output hash): only the files whose source, parameters or output changed
+    since the last run are processed again, and the reason is printed for each of them. A stimulus rebuilt under
+    another name (e.g. in another `output_format`) replaces the one recorded in the manifest.
 
         **Logic for overwriting trigger positions:**
 
     * If the .txt file exists, and you don't want to overwrite it (`overwrite_existing_triggers` = **False**):
-        use the trigger positions saved in the existing file to recreate the stim.
+        use the trigger positions saved in the existing file to recreate the stim, unless the source file or the
+        trigger parameters changed.
 
     * If the .txt file doesn't exist, or you want to overwrite the existing .txt (`overwrite_existing_triggers` = **True**):
         create a new trigger signal from scratch.
 
+    A file that fails to process is reported and skipped, the rest of the batch carries on. A summary with the wall
+    time of each file is printed at the end.
+
     :param cortify_media_dir: path to the Cortify Media directory
     :param accepted_formats: (tuple) which filename extensions to look for
-    :param plot: (bool) if True, plot the audio on ch1 and trigger signal on ch2
+    :param plot: (bool) if True, plot the audio on ch1 and trigger signal on ch2 (ignored when `n_workers` > 1)
     :param overwrite_existing_triggers: (bool) if True and a stim file with triggers already exists in the output dir
         ('Cortify_Media > Add_Triggers > stimuli_with_triggers'), overwrite the existing stim by recreating a trigger
         signal. If True and a .txt file with trigger positions already exists in the output dir
         ('Cortify_Media > Add_Triggers > triggers'), overwrite the saved positions (!) and create a new trigger signal.
         USE WITH CAUTION!
+    :param n_workers: (int) number of worker processes used to process the files in parallel.
+        Defaults to 1 (files are processed one after the other in the current process).
+    :param streaming: (bool) if True, audio files are read and written block by block, so that long audiobooks are
+        never fully loaded in memory.
+    :param output_format: (str) format of the audio stimuli: '.mp3' (default), or '.flac' / '.wav' (lossless, no
+        encoder delay) for precision-sensitive stimuli. Videos are always saved as mp4.
+    :param delay_compensation: (str) how the encoder delay of mp3 stimuli is handled: 'none' (default), 'preshift'
+        (the signal is shifted so the decoded triggers are at the saved positions) or 'timestamps' (the decoded
+        positions are saved to '<name>_trigger_decoded.txt'). The delay is measured once per format and sample rate
+        and cached in 'Add_Triggers > triggers > encoder_delays.json'.
+    :param res_type: (str) resampler for the audio files that aren't at 44.1 kHz: 'soxr_hq' (default), 'soxr_lq',
+        'polyphase' or 'kaiser_fast' (see `RESAMPLE_TYPES`). Files already at 44.1 kHz are never resampled.
+    :param pipelined: (bool) if True, the audio files are decoded in threads while the previous ones are being
+        encoded in `n_workers` worker processes (see `pipeline_orchestrator.py`). Plotting is disabled.
+    :param n_decoders: (int) number of audio files decoded at the same time when `pipelined` is True.
+    :param queue_size: (int) number of decoded audio files waiting to be encoded when `pipelined` is True. Bounds the
+        memory used by the decoded audio.
+    :param describe_stimuli: (bool) if True, each result carries the description of its stimulus (see
+        `describe_stimulus`), so that the next steps don't read the stimuli again (see `ingest_pipeline.py`).
+
+    The time spent in each stage of each file (decoding, triggers, encoding, metadata) is appended to
+    'Add_Triggers > stage_timings.jsonl' (see `stage_profiler.py` to enable cProfile / tracemalloc captures).
+
+    :return: (list of MediaJobResult) Outcome of each processed file, with the playlist metadata and genre of its
+        stimulus if `describe_stimuli` is True.
     """
 
-    # Define the FilePaths namedtuple within the function
-    FilePaths = namedtuple("FilePaths", ["source_media_path", "stim_with_trigs_path", "trigger_pos_path"])
-
     triggers_dir = os.path.join(cortify_media_dir, 'Add_Triggers')
 
     # Set the paths to the input and output folders
@@ -431,52 +1501,92 @@ def find_new_stim_and_add_triggers(cortify_media_dir, accepted_formats=('.wav',
     )
 
     video_thumbnails_path = os.path.join(cortify_media_dir, 'images', 'Video thumbnails')
+    profile_log = os.path.join(triggers_dir, PROFILE_LOG_FILENAME)
 
     # Create the output folders if they don't exist
     os.makedirs(file_paths.stim_with_trigs_path, exist_ok=True)
     os.makedirs(file_paths.trigger_pos_path, exist_ok=True)
 
-    new_media_found = False
-
-    # Loop over all files in the input folder ('Cortify_Media > Add_Triggers > original_stimuli')
-    print("Starting to process files...")
-    for file_name in os.listdir(file_paths.source_media_path):
-        original_file = os.path.join(file_paths.source_media_path, file_name)
-        if os.path.isfile(original_file) and (file_name.endswith(accepted_formats)):
-
-            stimuli_output_path = os.path.join(file_paths.stim_with_trigs_path, file_name)
-
-            # get the base name of the output file without the extension
-            output_file_basepath = os.path.splitext(stimuli_output_path)[0]
-            trigger_file_basepath = os.path.splitext(file_paths.trigger_pos_path)[0]
-
-            # check if a stim file with the same base name already exists in output folder
-            # ('Cortify_Media > Add_Triggers > stimuli_with_triggers')
-            # if not, or if you want to overwrite the existing file, create a new trigger signal for this file
-            if not glob(output_file_basepath + ".*") or overwrite_existing_triggers:
-
-                process_media_file(file_name, file_paths, video_thumbnails_path, plot=plot,
-                                   # check if a .txt (trigger positions) with the same base name exists in output folder
-                                   # ('Cortify_Media > Add_Triggers > triggers')
-                                   # If the .txt file exists and you don't want to overwrite it:
-                                   #     use the trigger positions saved in the existing file to recreate the stim
-                                   # If the .txt file doesn't exist, or you want to overwrite the existing .txt file:
-                                   #     create a new trigger signal
-                             use_existing_txt_file=True if (glob(trigger_file_basepath + "_triggers.txt")
-                                                            and not overwrite_existing_triggers) else False)
+    # Load the record of the stimuli built by previous runs
+    manifest_path = os.path.join(triggers_dir, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path)
+
+    # List the files that need to be processed
+    jobs, source_fingerprints = find_media_to_process(file_paths, accepted_formats, manifest,
+                                                      overwrite_existing_triggers, output_format, delay_compensation,
+                                                      res_type)
+    save_manifest(manifest, manifest_path)
+
+    def record_result(result):
+        # Record each stimulus in the manifest as soon as it is built, so an interrupted batch resumes where it stopped
+        if result.error is None:
+            output_file = os.path.join(file_paths.stim_with_trigs_path,
+                                       get_output_file_name(result.file_name, output_format))
+            remove_replaced_output(manifest.get(result.file_name), output_file)
+            manifest[result.file_name] = make_build_entry(source_fingerprints[result.file_name], output_file,
+                                                          get_build_params(), PIPELINE_VERSION,
+                                                          output_options=get_output_options(result.file_name,
+                                                                                            delay_compensation,
+                                                                                            res_type))
+            save_manifest(manifest, manifest_path)
+
+    remove_partial_outputs(file_paths.stim_with_trigs_path)
+
+    if not jobs:
+        print("No new or changed media found.")
+        return []
+
+    print(f"Starting to process {len(jobs)} file(s)...")
+    results = []
 
-                new_media_found = True
-
-            else:
-                print("File already exists in destination folder:", file_name)
-
-    if not new_media_found:
-        print("No new media found.")
+    try:
+        if pipelined:
+            if plot:
+                print("Plotting is disabled when processing files in a pipeline.")
+
+            # Imported here, the orchestrator imports this module
+            from pipeline_orchestrator import run_pipeline
+
+            results = run_pipeline(jobs, file_paths, video_thumbnails_path, record_result, n_workers=n_workers,
+                                   n_decoders=n_decoders, queue_size=queue_size, streaming=streaming,
+                                   output_format=output_format, delay_compensation=delay_compensation,
+                                   res_type=res_type, profile_log=profile_log, describe=describe_stimuli)
+
+        elif n_workers > 1:
+            if plot:
+                print("Plotting is disabled when processing files in parallel.")
+
+            def report_result(result):
+                results.append(result)
+                record_result(result)
+                status = f"failed ({result.error})" if result.error else f"done in {result.wall_time:.1f} s"
+                print(f"[{len(results)}/{len(jobs)}] {result.file_name}: {status}")
+
+            run_media_jobs_in_processes(jobs, file_paths, video_thumbnails_path, n_workers, report_result,
+                                        streaming=streaming, output_format=output_format,
+                                        delay_compensation=delay_compensation, res_type=res_type,
+                                        profile_log=profile_log, describe=describe_stimuli)
+
+        else:
+            for file_name, use_existing_txt_file, _ in jobs:
+                result = run_media_job(file_name, file_paths, video_thumbnails_path,
+                                       use_existing_txt_file=use_existing_txt_file, plot=plot,
+                                       streaming=streaming, output_format=output_format,
+                                       delay_compensation=delay_compensation, res_type=res_type,
+                                       profile_log=profile_log, describe=describe_stimuli)
+                results.append(result)
+                record_result(result)
+                if result.error:
+                    print(f"Failed to process {file_name}: {result.error}")
+    finally:
+        # A file that failed, or an interrupted run, can leave a partial stimulus
+        remove_partial_outputs(file_paths.stim_with_trigs_path)
+
+    print_batch_summary(results)
+    return results
 
 
 if __name__ == '__main__':
-    find_new_stim_and_add_triggers(cortify_media_dir=r"C:\Users\nadege\Data\CORTIFY\Cortify_Media",
-                                   accepted_formats=('.wav', '.mp3', '.mp4'),
-                                   plot=True,
-                                   overwrite_existing_triggers=False
-                                   )
+    from cortify_addmedia import main
+
+    main(['triggers'] + sys.argv[1:])
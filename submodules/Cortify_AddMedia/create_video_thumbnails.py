@@ -1,27 +1,206 @@
-from moviepy.editor import VideoFileClip
 import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-# Directory where the videos are stored
-video_dir = r"C:\Users\nadege\Data\CORTIFY\Cortify_Media\Create_Playlists\Vidéos"
+from media_probe import probe_media
 
-# Directory where the thumbnails will be saved
-thumbnail_dir = r"C:\Users\nadege\Data\CORTIFY\Cortify_Media\images\Video thumbnails"
+"""
+Creates the thumbnails of the videos ('Cortify_Media > images > Video thumbnails'), used as covers in the playlists.
 
-# Loop through each file in the video directory
-for filename in ["Metropolis (1927).mp4"]:  # os.listdir(video_dir):
-    if filename.endswith(".mp4"):  # Ensure we're working with MP4 files
-        video_path = os.path.join(video_dir, filename)
-        video = VideoFileClip(video_path)
+Each thumbnail is taken from a single frame: ffmpeg seeks to the keyframe closest before the chosen time and only
+decodes that frame (instead of decoding the video from its start), and all the sizes are written from it in one
+ffmpeg call. Thumbnails newer than their video are up to date and skipped, and the videos of a whole folder are
+processed in parallel.
+"""
 
-        # Resize the clip
-        video = video.resize(height=400)
+# Height in pixels of the thumbnails, keyed by the suffix added to the name of the video ('' for '<name>.jpg').
+# The app only looks up '<name>.jpg' (see lib/playlist_screen.dart), so only that size is made by default, at the
+# height of the old standalone script; other sizes can be added here and are written in the same ffmpeg call.
+THUMBNAIL_SIZES = {'': 400}
 
-        # Generate and save thumbnail
-        thumbnail_time = video.duration / 5  # You can adjust this as needed
-        thumbnail_path = os.path.join(thumbnail_dir, f"{os.path.splitext(filename)[0]}.jpg")
-        video.save_frame(thumbnail_path, t=thumbnail_time)
+# Thumbnails are taken at this fraction of the duration of the video (with the lead-in of the stimulus, see
+# `get_thumbnail_time`)
+THUMBNAIL_TIME_FRACTION = 0.1
 
-        # Close the clip to free up system resources
-        video.close()
+# Extensions of the videos
+VIDEO_EXTENSIONS = ('.mp4',)
 
-print("Thumbnail generation completed.")
+
+def get_thumbnail_paths(video_path, thumbnail_dir, sizes=THUMBNAIL_SIZES):
+    """
+    Returns the paths of the thumbnails of a video.
+    Args:
+        video_path: string, path to the video file
+        thumbnail_dir: string, directory of the thumbnails
+        sizes: dict, height of the thumbnails keyed by their suffix (see THUMBNAIL_SIZES)
+    Returns:
+        thumbnail_paths: dict, path of each thumbnail keyed by its suffix
+    """
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    return {suffix: os.path.join(thumbnail_dir, f"{name}{suffix}.jpg") for suffix in sizes}
+
+
+def is_up_to_date(video_path, thumbnail_paths):
+    """
+    Tells whether all the thumbnails of a video exist and are newer than the video.
+    The videos of the playlists keep the modification time of their stimulus when they are sorted (see
+    `genre_categorizer.transfer_file`), so the thumbnails made when adding the triggers stay up to date.
+    Args:
+        video_path: string, path to the video file
+        thumbnail_paths: iterable, paths to the thumbnails
+    Returns:
+        up_to_date: bool
+    """
+    video_mtime = os.path.getmtime(video_path)
+    return all(os.path.isfile(path) and os.path.getmtime(path) >= video_mtime for path in thumbnail_paths)
+
+
+def get_thumbnail_time(duration, time_fraction=THUMBNAIL_TIME_FRACTION, lead_in=0.0):
+    """
+    Returns the time of the video the thumbnail is taken at.
+    Args:
+        duration: float, duration of the video in seconds
+        time_fraction: float, position of the thumbnail as a fraction of the duration
+        lead_in: float, duration in seconds of the lead-in added before the video in the stimulus (black screen, see
+            create_triggers.SILENCE_DURATION). The thumbnail of a source video is taken at the same frame as the one
+            of its stimulus, or at the start of the video if that frame is in the lead-in.
+    Returns:
+        time: float, time in seconds in the video
+    """
+    return max((lead_in + duration) * time_fraction - lead_in, 0.0)
+
+
+def extract_thumbnails(video_path, thumbnail_paths, time, sizes=THUMBNAIL_SIZES):
+    """
+    Writes the thumbnails of a video from the keyframe at (or closest before) the given time, in one ffmpeg call that
+    decodes only that frame. The thumbnails are written to temporary files and renamed once complete.
+    Args:
+        video_path: string, path to the video file
+        thumbnail_paths: dict, path of each thumbnail keyed by its suffix (see get_thumbnail_paths)
+        time: float, time of the frame in seconds
+        sizes: dict, height of the thumbnails keyed by their suffix
+    """
+    suffixes = list(thumbnail_paths)
+    filters = [f"[0:v]split={len(suffixes)}" + ''.join(f"[in{i}]" for i in range(len(suffixes)))]
+    filters += [f"[in{i}]scale=-2:{sizes[suffix]}[out{i}]" for i, suffix in enumerate(suffixes)]
+
+    # Seek to the keyframe before `time` and only decode keyframes: the first decoded frame is the thumbnail
+    ffmpeg_args = ['ffmpeg', '-v', 'error', '-y', '-noaccurate_seek', '-ss', f"{time:.3f}", '-skip_frame', 'nokey',
+                   '-i', video_path, '-filter_complex', ';'.join(filters)]
+
+    temp_paths = []
+    for i, suffix in enumerate(suffixes):
+        temp_path = os.path.splitext(thumbnail_paths[suffix])[0] + '.tmp.jpg'
+        temp_paths.append(temp_path)
+        ffmpeg_args += ['-map', f"[out{i}]", '-frames:v', '1', '-update', '1', '-q:v', '2', temp_path]
+
+    try:
+        subprocess.run(ffmpeg_args, check=True, stdin=subprocess.DEVNULL)
+        for suffix, temp_path in zip(suffixes, temp_paths):
+            os.replace(temp_path, thumbnail_paths[suffix])
+    finally:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def create_thumbnails(video_path, thumbnail_dir, sizes=THUMBNAIL_SIZES, time_fraction=THUMBNAIL_TIME_FRACTION,
+                      lead_in=0.0, overwrite=False, duration=None):
+    """
+    Creates the thumbnails of a video, unless they are up to date.
+    Args:
+        video_path: string, path to the video file
+        thumbnail_dir: string, directory of the thumbnails
+        sizes: dict, height of the thumbnails keyed by their suffix (see THUMBNAIL_SIZES)
+        time_fraction: float, position of the thumbnail as a fraction of the duration
+        lead_in: float, duration in seconds of the lead-in added before the video in the stimulus (see
+            get_thumbnail_time)
+        overwrite: bool, if True, create the thumbnails even if they are up to date
+        duration: float, duration of the video in seconds, probed from the file if None
+    Returns:
+        created: bool, False if the thumbnails were up to date
+    """
+    thumbnail_paths = get_thumbnail_paths(video_path, thumbnail_dir, sizes)
+    if not overwrite and is_up_to_date(video_path, thumbnail_paths.values()):
+        return False
+
+    if duration is None:
+        duration = probe_media(video_path)["duration"]
+
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    extract_thumbnails(video_path, thumbnail_paths, get_thumbnail_time(duration, time_fraction, lead_in), sizes)
+    return True
+
+
+def list_videos(video_dir):
+    """
+    Lists the videos of a folder and its subfolders.
+    Args:
+        video_dir: string, path to the folder
+    Returns:
+        video_paths: list, paths to the videos, sorted
+    """
+    video_paths = []
+    for root, _, files in os.walk(video_dir):
+        video_paths += [os.path.join(root, file) for file in files if file.lower().endswith(VIDEO_EXTENSIONS)]
+    return sorted(video_paths)
+
+
+def create_thumbnails_for_folder(video_dir, thumbnail_dir, sizes=THUMBNAIL_SIZES,
+                                 time_fraction=THUMBNAIL_TIME_FRACTION, overwrite=False, max_workers=4):
+    """
+    Creates the thumbnails of all the videos of a folder and its subfolders. The videos are processed in parallel
+    (each one by an ffmpeg process), the ones with up-to-date thumbnails are skipped.
+    Args:
+        video_dir: string, path to the folder of the videos
+        thumbnail_dir: string, directory of the thumbnails
+        sizes: dict, height of the thumbnails keyed by their suffix (see THUMBNAIL_SIZES)
+        time_fraction: float, position of the thumbnail as a fraction of the duration
+        overwrite: bool, if True, create all the thumbnails again
+        max_workers: int, number of videos processed at the same time
+    Returns:
+        counts: dict, number of videos whose thumbnails were 'created', 'up_to_date' or 'failed'
+    """
+    counts = {'created': 0, 'up_to_date': 0, 'failed': 0}
+    video_paths = list_videos(video_dir)
+
+    def create_or_report(video_path):
+        try:
+            created = create_thumbnails(video_path, thumbnail_dir, sizes, time_fraction, overwrite=overwrite)
+            return 'created' if created else 'up_to_date'
+        except Exception as e:
+            print(f"Failed to create the thumbnails of {video_path}: {e}")
+            return 'failed'
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for video_path, status in zip(video_paths, executor.map(create_or_report, video_paths)):
+            counts[status] += 1
+            if status == 'created':
+                print("Created the thumbnails of", os.path.basename(video_path))
+
+    print(f"Thumbnails: {counts['created']} created, {counts['up_to_date']} up to date, {counts['failed']} failed.")
+    return counts
+
+
+def create_video_thumbnails(cortify_media_path, sizes=THUMBNAIL_SIZES, overwrite=False, max_workers=4):
+    """
+    Creates the thumbnails of the videos of the playlists ('Cortify_Media > Create_Playlists > media > Vidéos') in
+    'Cortify_Media > images > Video thumbnails'.
+    Args:
+        cortify_media_path: string, path to the 'Cortify_Media' directory
+        sizes: dict, height of the thumbnails keyed by their suffix (see THUMBNAIL_SIZES)
+        overwrite: bool, if True, create all the thumbnails again
+        max_workers: int, number of videos processed at the same time
+    Returns:
+        counts: dict, number of videos whose thumbnails were 'created', 'up_to_date' or 'failed'
+    """
+    return create_thumbnails_for_folder(os.path.join(cortify_media_path, 'Create_Playlists', 'media', 'Vidéos'),
+                                        os.path.join(cortify_media_path, 'images', 'Video thumbnails'),
+                                        sizes, overwrite=overwrite, max_workers=max_workers)
+
+
+if __name__ == '__main__':
+    from cortify_addmedia import main
+
+    main(['thumbnails'] + sys.argv[1:])
@@ -1,12 +1,20 @@
 import os
 import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from tinytag import TinyTag
 
+from build_manifest import file_sha256
+from processing_options import TRANSFER_MODES
+
 """
 This script collects metadata from audio and video files stored in "Add_Triggers/stimuli_with_triggers",
 sorts them by genre, and copies them to the appropriate directory under "Create_Playlists".
 """
 
+# ioctl request to clone a file on Linux
+FICLONE = 0x40049409
+
 
 def collect_genre_metadata(file):
     """
@@ -20,39 +28,154 @@ def collect_genre_metadata(file):
     return tag.genre
 
 
-def copy_files_by_genre(filepath, destination_folder_mapping: dict, overwrite: bool =False):
+def files_are_identical(file_path, other_file_path):
+    """
+    Checks whether two files have the same content: same file on disk, or same size and same hash.
+    Args:
+        file_path: path to the first file
+        other_file_path: path to the second file
+    Returns:
+        (bool): whether the files are identical
+    """
+    if os.path.samefile(file_path, other_file_path):
+        return True
+    if os.path.getsize(file_path) != os.path.getsize(other_file_path):
+        return False
+    return file_sha256(file_path) == file_sha256(other_file_path)
+
+
+def reflink_file(file_path, destination_file_path):
     """
-    Copies files to the appropriate directory based on their genre.
-    If a file with the same name exists in the destination directory,
-    it will be overwritten if the 'overwrite' parameter is True.
+    Creates a copy-on-write clone of a file. Raises OSError if the platform or the filesystem doesn't support it.
+    Args:
+        file_path: path to the source file
+        destination_file_path: path to the clone
+    """
+    if not sys.platform.startswith('linux'):
+        raise OSError("reflinks are only supported on Linux")
+
+    import fcntl
+
+    with open(file_path, 'rb') as source, open(destination_file_path, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(destination_file_path)
+            raise
+
+
+def transfer_file(file_path, destination_file_path, mode='copy'):
+    """
+    Puts a file at its destination by copying or linking it (see TRANSFER_MODES).
+    An existing destination file is only replaced once the new file is ready. Copies keep the modification time of
+    the source, so that the destination isn't seen as newer than what was made from the source (e.g. the thumbnails
+    of the videos, see `create_video_thumbnails.is_up_to_date`).
+    Args:
+        file_path: path to the source file
+        destination_file_path: path to the destination file
+        mode (str): one of TRANSFER_MODES, falls back to a copy if the link can't be made
+    Returns:
+        (str): the mode that was actually used
+    """
+    temp_file_path = destination_file_path + '.tmp'
+    if os.path.lexists(temp_file_path):
+        os.remove(temp_file_path)
+
+    try:
+        if mode == 'hardlink':
+            os.link(file_path, temp_file_path)
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(file_path), temp_file_path)
+        elif mode == 'reflink':
+            reflink_file(file_path, temp_file_path)
+            shutil.copystat(file_path, temp_file_path)
+        else:
+            mode = 'copy'
+            shutil.copy2(file_path, temp_file_path)
+    except OSError as e:
+        print(f"Could not {mode} {os.path.basename(file_path)} ({e}), copying it instead")
+        mode = 'copy'
+        shutil.copy2(file_path, temp_file_path)
+
+    os.replace(temp_file_path, destination_file_path)
+    return mode
+
+
+def copy_files_by_genre(filepath, destination_folder_mapping: dict, overwrite: bool = False, mode: str = 'copy',
+                        max_workers: int = 1, files=None, genres=None):
+    """
+    Copies (or links) files to the appropriate directory based on their genre.
+    If an identical file (same size and hash) already exists in the destination directory, it is skipped, unless the
+    'overwrite' parameter is True. A different file with the same name is replaced.
     Args:
         filepath: path to the directory with media files
         destination_folder_mapping (dict): mapping from genre to the destination folder
-        overwrite (bool): whether to overwrite existing files
+        overwrite (bool): whether to copy files again even if they are identical to the existing ones
+        mode (str): how files are put in the destination folders, one of TRANSFER_MODES
+        max_workers (int): number of files handled at the same time
+        files (list): names of the files to sort, all the files of the directory if None
+        genres (dict): genre of the files keyed by name, when already known (the tags of the other files are read)
+    Returns:
+        (dict): 'destinations', the path of each sorted file in its destination folder (copied, linked or already
+            identical) keyed by name, and 'transferred', the names of the files that were copied or linked
     """
-    for file in os.listdir(filepath):
-        print(file)
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f"Unknown transfer mode '{mode}', expected one of {TRANSFER_MODES}")
+
+    genres = genres or {}
+
+    def sort_file(file):
         file_path = os.path.join(filepath, file)
-        if os.path.isfile(file_path):
-            genre = collect_genre_metadata(file_path)
+        genre = genres[file] if file in genres else collect_genre_metadata(file_path)
+
+        if genre not in destination_folder_mapping:
+            return f"Skipped {file}: no destination folder for genre {genre}", None, False
+
+        destination_folder = destination_folder_mapping[genre]
 
-            if genre in destination_folder_mapping:
-                destination_folder = destination_folder_mapping[genre]
+        # Check if the destination folder exists and create it if necessary
+        os.makedirs(destination_folder, exist_ok=True)
 
-                # Check if the destination folder exists and create it if necessary
-                os.makedirs(destination_folder, exist_ok=True)
+        destination_file_path = os.path.join(destination_folder, file)
 
-                destination_file_path = os.path.join(destination_folder, file)
+        if os.path.exists(destination_file_path) and not overwrite:
+            if files_are_identical(file_path, destination_file_path):
+                return (f"Skipped {file} as it already exists in destination folder {destination_folder}",
+                        destination_file_path, False)
+            print(f"Replacing {file} in {destination_folder}, it differs from the new stimulus")
 
-                if not os.path.exists(destination_file_path) or overwrite:
-                    shutil.copy(file_path, destination_file_path)
-                    print(f"Copied {file} to {destination_folder}")
-                else:
-                    print(f"Skipped {file} as it already exists in destination folder {destination_folder}")
+        used_mode = transfer_file(file_path, destination_file_path, mode)
+        return (f"{'Copied' if used_mode == 'copy' else used_mode.capitalize() + 'ed'} {file} to {destination_folder}",
+                destination_file_path, True)
 
+    if files is None:
+        files = [file for file in sorted(os.listdir(filepath)) if os.path.isfile(os.path.join(filepath, file))]
 
+    sorted_files = {'destinations': {}, 'transferred': []}
 
-def sort_stim_with_triggers_to_genre_subfolders(cortify_media_path, overwrite=False):
+    def record(file, outcome):
+        message, destination_file_path, transferred = outcome
+        print(message)
+        if destination_file_path is not None:
+            sorted_files['destinations'][file] = destination_file_path
+        if transferred:
+            sorted_files['transferred'].append(file)
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for file, outcome in zip(files, executor.map(sort_file, files)):
+                record(file, outcome)
+    else:
+        for file in files:
+            print(file)
+            record(file, sort_file(file))
+
+    return sorted_files
+
+
+def sort_stim_with_triggers_to_genre_subfolders(cortify_media_path, overwrite=False, mode='copy', max_workers=1,
+                                                files=None, genres=None):
     """
     Checks for files in `Cortify_Media > Add_Triggers > stimuli_with_triggers`.
 
@@ -60,12 +183,23 @@ def sort_stim_with_triggers_to_genre_subfolders(cortify_media_path, overwrite=Fa
     respective subfolders under `Cortify_Media > Create_Playlists > Audiobooks`, `Music`, `Podcasts`
     & `Vidéos`.
 
-    The arg `overwrite` determines whether existing files in the destination folders should be overwritten.
+    Files identical to the ones already in the destination folders are skipped. The arg `overwrite` determines
+    whether they should be copied again anyway.
 
     Args:
         cortify_media_path (Union[str, Path]): Path to the 'Cortify_Media' directory.
         overwrite (bool, optional): A flag to determine whether to overwrite existing files in the
-            destination directory. Defaults to False.
+            destination directory even if they are identical. Defaults to False.
+        mode (str, optional): How files are put in the destination folders: 'copy', 'hardlink', 'reflink'
+            or 'symlink' (see TRANSFER_MODES). Links avoid duplicating the media on disk. Defaults to 'copy'.
+        max_workers (int, optional): Number of files copied at the same time. Defaults to 1.
+        files (list, optional): Names of the stimuli to sort. Defaults to None (all the stimuli).
+        genres (dict, optional): Genre of the stimuli keyed by name, when already known (e.g. from the tags written
+            by `create_triggers.py`), so their tags aren't read again. Defaults to None.
+
+    Returns:
+        dict: The destination of the sorted stimuli and the ones that were copied or linked (see
+            `copy_files_by_genre`).
     """
 
     input_path = os.path.join(cortify_media_path, 'Add_Triggers', 'stimuli_with_triggers')
@@ -79,8 +213,10 @@ def sort_stim_with_triggers_to_genre_subfolders(cortify_media_path, overwrite=Fa
         'Vidéos': os.path.join(media_path, 'Vidéos')
     }
 
-    copy_files_by_genre(input_path, destination_folder_mapping, overwrite)
+    return copy_files_by_genre(input_path, destination_folder_mapping, overwrite, mode, max_workers, files, genres)
 
 
 if __name__ == '__main__':
-    sort_stim_with_triggers_to_genre_subfolders(cortify_media_path=r"C:\Users\nadege\Data\CORTIFY\Cortify_Media")
+    from cortify_addmedia import main
+
+    main(['sort'] + sys.argv[1:])
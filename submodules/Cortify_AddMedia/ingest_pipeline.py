@@ -0,0 +1,141 @@
+import os
+import sys
+
+from create_JSON_playlist import (METADATA_CACHE_FILENAME, PLAYLIST_MANIFEST_FILENAME, SHARDED_PLAYLIST_DIRNAME,
+                                  create_json_playlist, load_metadata_cache, save_metadata_cache)
+from create_triggers import OUTPUT_FORMAT, RESAMPLE_TYPE, find_new_stim_and_add_triggers, get_output_file_name
+from genre_categorizer import sort_stim_with_triggers_to_genre_subfolders
+
+"""
+Ingests new media from start to finish: adds the triggers, sorts the stimuli by genre and builds the playlist.
+
+Run one by one, each step reads the tags of every file again (taglib when adding the triggers, TinyTag when sorting,
+TinyTag and ffprobe for the playlist) and rescans its folders. Here, each stimulus is described by the worker that
+builds it, from the tags, number of samples and sample rate it encoded (see `create_triggers.describe_stimulus`), and
+the description is carried to the next steps:
+
+- only the stimuli built by this run are sorted, with the genre they were tagged with;
+- their playlist metadata is put in the metadata cache of the playlist, so the playlist doesn't read them again (their
+  duration is the exact one of the encoded audio, and their bitrate and audio offset, which the encoder doesn't know,
+  are left empty);
+- the playlist is only built again if a stimulus was copied (or linked) to Create_Playlists.
+
+Changes made by hand in Create_Playlists (deleted files, priority files, covers) aren't seen, run with `full=True`
+(or run the steps separately) to sort all the stimuli and build the playlist anyway.
+"""
+
+
+def seed_playlist_cache(cache_path, stimuli, destinations):
+    """
+    Puts the metadata of sorted stimuli in the metadata cache of the playlist (see
+    `create_JSON_playlist.get_file_metadata`), keyed by their path in Create_Playlists with their current size and
+    modification time, so that the playlist takes them from the cache instead of reading the files.
+
+    :param cache_path: (str) Path to the metadata cache of the playlist.
+    :param stimuli: (dict) Description of each stimulus keyed by name (see `create_triggers.describe_stimulus`), None
+        if it couldn't be read.
+    :param destinations: (dict) Path of each sorted stimulus in Create_Playlists keyed by name.
+
+    :return: (int) Number of cache entries written.
+    """
+
+    cache = load_metadata_cache(cache_path)
+    num_entries = 0
+    for name, destination_file_path in destinations.items():
+        if stimuli.get(name) is None:
+            continue
+        stat = os.stat(destination_file_path)
+        metadata = {key: value for key, value in stimuli[name].items() if key != "genre"}
+        cache[destination_file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "metadata": metadata}
+        num_entries += 1
+
+    if num_entries:
+        save_metadata_cache(cache, cache_path)
+    return num_entries
+
+
+def playlist_exists(metadata_path, output='single'):
+    """
+    Tells whether the playlist was already built (see `create_JSON_playlist.save_to_json`).
+
+    :param metadata_path: (str) Path to 'Create_Playlists > metadata'.
+    :param output: (str) 'single', 'sharded' or 'both'.
+
+    :return: (bool) True if all the files of the output exist.
+    """
+
+    paths = []
+    if output in ('single', 'both'):
+        paths.append(os.path.join(metadata_path, 'metadata.json'))
+    if output in ('sharded', 'both'):
+        paths.append(os.path.join(metadata_path, SHARDED_PLAYLIST_DIRNAME, PLAYLIST_MANIFEST_FILENAME))
+    return all(os.path.isfile(path) for path in paths)
+
+
+def run_ingest(cortify_media_path, accepted_formats=('.wav', '.mp3', '.mp4'), overwrite_existing_triggers=False,
+               n_workers=1, streaming=False, output_format=OUTPUT_FORMAT, delay_compensation='none',
+               res_type=RESAMPLE_TYPE, pipelined=False, n_decoders=1, queue_size=2, sort_mode='copy',
+               playlist_output='single', priority_file=None, full=False):
+    """
+    Adds the triggers to the new or changed media, sorts the new stimuli by genre and builds the playlist, carrying
+    the metadata of the stimuli from one step to the next (see the module docstring).
+
+    :param cortify_media_path: (str) Path to the 'Cortify_Media' directory.
+    :param accepted_formats: (tuple) Extensions of the source files to process.
+    :param overwrite_existing_triggers: (bool) If True, rebuild every stimulus and draw new trigger positions (see
+        `create_triggers.find_new_stim_and_add_triggers`). USE WITH CAUTION!
+    :param n_workers: (int) Number of worker processes adding the triggers.
+    :param streaming: (bool) If True, the audio files are processed block by block.
+    :param output_format: (str) Format of the audio stimuli.
+    :param delay_compensation: (str) How the encoder delay of mp3 stimuli is handled.
+    :param res_type: (str) Resampler for the audio files that aren't at 44.1 kHz.
+    :param pipelined: (bool) If True, the audio files are decoded while the previous ones are encoded.
+    :param n_decoders: (int) Number of audio files decoded at the same time when `pipelined` is True.
+    :param queue_size: (int) Number of decoded audio files waiting to be encoded when `pipelined` is True.
+    :param sort_mode: (str) How the stimuli are put in the genre folders (see `genre_categorizer.TRANSFER_MODES`).
+    :param playlist_output: (str) 'single', 'sharded' or 'both' (see `create_JSON_playlist.PLAYLIST_OUTPUTS`).
+    :param priority_file: (str, optional) Path to the priority files (see `create_JSON_playlist.create_json_playlist`).
+    :param full: (bool) If True, sort all the stimuli and build the playlist even if no stimulus changed.
+
+    :return: (list of MediaJobResult) Outcome of each source file processed by this run.
+    """
+
+    print("=== Adding triggers ===")
+    results = find_new_stim_and_add_triggers(cortify_media_path, accepted_formats=accepted_formats,
+                                             overwrite_existing_triggers=overwrite_existing_triggers,
+                                             n_workers=n_workers, streaming=streaming, output_format=output_format,
+                                             delay_compensation=delay_compensation, res_type=res_type,
+                                             pipelined=pipelined, n_decoders=n_decoders, queue_size=queue_size,
+                                             describe_stimuli=True)
+
+    stimuli = {get_output_file_name(result.file_name, output_format): result.stimulus for result in results
+               if not result.error}
+
+    print("=== Sorting the stimuli by genre ===")
+    if stimuli or full:
+        # The genre of the stimuli that couldn't be described is read from their tags
+        sorted_files = sort_stim_with_triggers_to_genre_subfolders(
+            cortify_media_path, mode=sort_mode, files=None if full else sorted(stimuli),
+            genres={name: stimulus["genre"] for name, stimulus in stimuli.items() if stimulus is not None})
+    else:
+        sorted_files = {'destinations': {}, 'transferred': []}
+        print("No new stimulus to sort.")
+
+    metadata_path = os.path.join(cortify_media_path, 'Create_Playlists', 'metadata')
+    seeded = seed_playlist_cache(os.path.join(metadata_path, METADATA_CACHE_FILENAME), stimuli,
+                                 sorted_files['destinations'])
+
+    print("=== Building the playlist ===")
+    if full or sorted_files['transferred'] or not playlist_exists(metadata_path, playlist_output):
+        print(f"Metadata of {seeded} new stimulus file(s) taken from this run.")
+        create_json_playlist(cortify_media_path, output=playlist_output, priority_file=priority_file)
+    else:
+        print("No stimulus was added to Create_Playlists, the playlist is up to date.")
+
+    return results
+
+
+if __name__ == '__main__':
+    from cortify_addmedia import main
+
+    main(['pipeline'] + sys.argv[1:])
@@ -0,0 +1,293 @@
+import json
+import os
+import struct
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Reads the duration and stream layout of media files without decoding them.
+
+MP4 files are probed by reading the container atoms directly (moov > mvhd, and trak > mdia > mdhd / hdlr / stsd for each
+stream), which only needs a few small reads per file. Other files, or MP4 files that can't be parsed that way
+(e.g. fragmented MP4), are probed with a single ffprobe call.
+
+The decoder configuration of the video of MP4 files (see `read_mp4_video_config`) and the encoder delay of MP3 files
+(see `read_lame_encoder_delay`) are read the same way.
+"""
+
+# Extensions of the files probed by reading the container atoms
+MP4_EXTENSIONS = ('.mp4', '.m4a', '.m4v', '.mov')
+
+# Stream types of the MP4 handler types
+MP4_HANDLER_TYPES = {b'vide': 'video', b'soun': 'audio'}
+
+# Boxes of the decoder configuration (profile, level and parameter sets) in the video sample entries
+MP4_VIDEO_CONFIG_BOXES = (b'avcC', b'hvcC')
+
+# Size of the fields of a visual sample entry before its child boxes (box header included)
+VISUAL_SAMPLE_ENTRY_SIZE = 86
+
+# Encoders whose Xing/Info header is followed by a LAME extension (with the encoder delay and padding)
+LAME_ENCODER_TAGS = (b'LAME', b'Lavc', b'Lavf')
+
+# Number of bytes searched for the Xing/Info header at the start of the first MP3 frame
+XING_SEARCH_SIZE = 4096
+
+
+def _iter_boxes(f, start, end):
+    """
+    Iterates over the MP4 boxes between two offsets of a file.
+    Args:
+        f: binary file object
+        start: int, offset of the first box
+        end: int, offset of the end of the parent box
+    Yields:
+        (box_type, content_start, box_end): bytes, int, int
+    """
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            raise ValueError(f"Invalid MP4 box size at offset {position}")
+        yield box_type, position + header_size, position + size
+        position += size
+
+
+def _find_box(f, start, end, *path):
+    """
+    Finds a box from its path of box types, e.g. (b'mdia', b'minf', b'stbl').
+    Returns:
+        (content_start, box_end): int, int, or None if the box doesn't exist
+    """
+    for box_type, content_start, box_end in _iter_boxes(f, start, end):
+        if box_type == path[0]:
+            return (content_start, box_end) if len(path) == 1 else _find_box(f, content_start, box_end, *path[1:])
+    return None
+
+
+def _read_timescale_and_duration(f, content_start):
+    """
+    Reads the timescale and duration of a mvhd or mdhd box (both versions of the box have them at different offsets).
+    """
+    f.seek(content_start)
+    version = f.read(4)[0]
+    if version == 1:
+        f.seek(content_start + 4 + 16)
+        return struct.unpack('>IQ', f.read(12))
+    f.seek(content_start + 4 + 8)
+    return struct.unpack('>II', f.read(8))
+
+
+def probe_mp4(file_path):
+    """
+    Reads the duration and streams of an MP4 file from its container atoms.
+    Args:
+        file_path: string, path to the MP4 file
+    Returns:
+        probe: dict, `duration` of the file in seconds and `streams`, a list of dicts with the `type` (video or audio),
+            `codec` and `duration` of each stream, plus `width` and `height` (video) or `samplerate` and `channels`
+            (audio)
+    """
+    with open(file_path, 'rb') as f:
+        moov = _find_box(f, 0, os.fstat(f.fileno()).st_size, b'moov')
+        if moov is None:
+            raise ValueError(f"No moov box in {file_path}")
+
+        mvhd = _find_box(f, *moov, b'mvhd')
+        timescale, duration = _read_timescale_and_duration(f, mvhd[0])
+        if duration == 0:
+            raise ValueError(f"No duration in the movie header of {file_path} (fragmented MP4?)")
+
+        streams = []
+        for box_type, trak_start, trak_end in _iter_boxes(f, *moov):
+            if box_type != b'trak':
+                continue
+
+            hdlr = _find_box(f, trak_start, trak_end, b'mdia', b'hdlr')
+            f.seek(hdlr[0] + 8)
+            stream_type = MP4_HANDLER_TYPES.get(f.read(4))
+            if stream_type is None:
+                continue
+
+            mdhd = _find_box(f, trak_start, trak_end, b'mdia', b'mdhd')
+            stream_timescale, stream_duration = _read_timescale_and_duration(f, mdhd[0])
+            stream = {"type": stream_type, "duration": stream_duration / stream_timescale}
+
+            # First sample entry of the sample description box
+            stsd = _find_box(f, trak_start, trak_end, b'mdia', b'minf', b'stbl', b'stsd')
+            entry_start = stsd[0] + 8
+            f.seek(entry_start)
+            entry = f.read(36)
+            stream["codec"] = entry[4:8].decode('latin-1')
+
+            if stream_type == 'video':
+                stream["width"], stream["height"] = struct.unpack('>HH', entry[32:36])
+            else:
+                stream["channels"] = struct.unpack('>H', entry[24:26])[0]
+                # 16.16 fixed point, not set in QuickTime v2 sound descriptions: the track timescale is the sample rate
+                stream["samplerate"] = struct.unpack('>I', entry[32:36])[0] >> 16 or stream_timescale
+
+            streams.append(stream)
+
+    return {"duration": duration / timescale, "streams": streams}
+
+
+def read_mp4_video_config(file_path):
+    """
+    Reads the decoder configuration of the first video track of an MP4 file (avcC or hvcC box of its sample entry:
+    profile, level and parameter sets). Two H.264/HEVC streams can only be joined without re-encoding if it is the
+    same, the frames of the second one are decoded with the parameter sets of the first one.
+    Args:
+        file_path: string, path to the MP4 file
+    Returns:
+        config: bytes, content of the configuration box, or None if the file has no such box or can't be parsed
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            moov = _find_box(f, 0, os.fstat(f.fileno()).st_size, b'moov')
+            if moov is None:
+                return None
+
+            for box_type, trak_start, trak_end in _iter_boxes(f, *moov):
+                if box_type != b'trak':
+                    continue
+                hdlr = _find_box(f, trak_start, trak_end, b'mdia', b'hdlr')
+                f.seek(hdlr[0] + 8)
+                if MP4_HANDLER_TYPES.get(f.read(4)) != 'video':
+                    continue
+
+                stsd = _find_box(f, trak_start, trak_end, b'mdia', b'minf', b'stbl', b'stsd')
+                entry_start = stsd[0] + 8
+                f.seek(entry_start)
+                entry_size = struct.unpack('>I', f.read(4))[0]
+                for config_type, config_start, config_end in _iter_boxes(f, entry_start + VISUAL_SAMPLE_ENTRY_SIZE,
+                                                                         entry_start + entry_size):
+                    if config_type in MP4_VIDEO_CONFIG_BOXES:
+                        f.seek(config_start)
+                        return f.read(config_end - config_start)
+                return None
+    except (ValueError, TypeError, struct.error, IndexError):
+        return None
+    return None
+
+
+def probe_ffprobe(file_path):
+    """
+    Reads the duration and streams of a media file with a single ffprobe call (no decoding).
+    Args:
+        file_path: string, path to the media file
+    Returns:
+        probe: dict, same layout as probe_mp4
+    """
+    ffprobe_args = ['ffprobe', '-v', 'error', '-show_entries',
+                    'format=duration:stream=codec_type,codec_name,duration,width,height,sample_rate,channels',
+                    '-of', 'json', file_path]
+    ffprobe_output = json.loads(subprocess.check_output(ffprobe_args))
+
+    streams = []
+    for ffprobe_stream in ffprobe_output.get('streams', []):
+        if ffprobe_stream.get('codec_type') not in ('video', 'audio'):
+            continue
+        stream = {"type": ffprobe_stream['codec_type'],
+                  "codec": ffprobe_stream.get('codec_name'),
+                  "duration": float(ffprobe_stream['duration']) if 'duration' in ffprobe_stream else None}
+        if stream["type"] == 'video':
+            stream["width"], stream["height"] = ffprobe_stream.get('width'), ffprobe_stream.get('height')
+        else:
+            stream["channels"] = ffprobe_stream.get('channels')
+            stream["samplerate"] = int(ffprobe_stream['sample_rate']) if 'sample_rate' in ffprobe_stream else None
+        streams.append(stream)
+
+    return {"duration": float(ffprobe_output['format']['duration']), "streams": streams}
+
+
+def probe_media(file_path):
+    """
+    Reads the duration and streams of a media file, from the container atoms for MP4 files, with ffprobe otherwise
+    or if the MP4 atoms can't be parsed.
+    Args:
+        file_path: string, path to the media file
+    Returns:
+        probe: dict, same layout as probe_mp4
+    """
+    if os.path.splitext(file_path)[-1].lower() in MP4_EXTENSIONS:
+        try:
+            return probe_mp4(file_path)
+        except (ValueError, TypeError, struct.error, IndexError) as e:
+            print(f"Falling back to ffprobe for {file_path}: {e}")
+    return probe_ffprobe(file_path)
+
+
+def read_lame_encoder_delay(file_path):
+    """
+    Reads the encoder delay and padding of an MP3 file from the LAME extension of its Xing/Info header (first frame).
+    Gapless decoders use them to drop the priming and padding samples, other decoders play them.
+    Args:
+        file_path: string, path to the MP3 file
+    Returns:
+        (encoder_delay, padding): int, int, in time samples, or None if the file has no LAME header
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(10)
+        start = 0
+        if header[:3] == b'ID3' and len(header) == 10:
+            # ID3v2 tag before the first frame: 4 syncsafe bytes of size, plus a footer if flagged
+            start = 10 + sum((byte & 0x7f) << (7 * (3 - i)) for i, byte in enumerate(header[6:10]))
+            if header[5] & 0x10:
+                start += 10
+        f.seek(start)
+        data = f.read(XING_SEARCH_SIZE)
+
+    positions = [position for position in (data.find(b'Xing'), data.find(b'Info')) if position >= 0]
+    if not positions:
+        return None
+    position = min(positions)
+    if position + 8 > len(data):
+        return None
+
+    # The optional fields of the Xing header (frames, bytes, TOC, quality) come before the LAME extension
+    flags = struct.unpack('>I', data[position + 4:position + 8])[0]
+    lame_start = position + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+    lame = data[lame_start:lame_start + 24]
+    if len(lame) < 24 or lame[:4] not in LAME_ENCODER_TAGS:
+        return None
+
+    # 12 bits of encoder delay then 12 bits of padding, after the encoder version, gains and flags
+    encoder_delay = (lame[21] << 4) | (lame[22] >> 4)
+    padding = ((lame[22] & 0x0f) << 8) | lame[23]
+    return encoder_delay, padding
+
+
+def probe_media_files(file_paths, max_workers=8):
+    """
+    Probes many media files at once. The probes only do small reads, so they run concurrently on a thread pool.
+    Args:
+        file_paths: list, paths to the media files
+        max_workers: int, number of files probed at the same time
+    Returns:
+        probes: dict, probe of each file (see probe_mp4), keyed by path. Files that couldn't be probed are left out.
+    """
+    probes = {}
+    if not file_paths:
+        return probes
+
+    def probe_or_none(file_path):
+        try:
+            return probe_media(file_path)
+        except Exception as e:
+            print(f"Failed to probe {file_path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for file_path, probe in zip(file_paths, executor.map(probe_or_none, file_paths)):
+            if probe is not None:
+                probes[file_path] = probe
+
+    return probes
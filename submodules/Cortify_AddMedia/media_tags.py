@@ -0,0 +1,115 @@
+import taglib
+
+"""
+Tags (title, artist, album, genre) of the stimuli.
+
+The tags of a source file are read once, and written to the stimulus while it is encoded (libsndfile string fields
+for audio, ffmpeg -metadata options for videos), so that the stimulus file isn't opened and saved a second time just
+for its tags. When the encoder can't store a tag correctly, the tags are updated afterwards with taglib, which only
+rewrites the tag part of the file.
+"""
+
+# Tags copied from the source files to the stimuli
+TAG_KEYS = ('title', 'artist', 'album', 'genre')
+
+# Formats whose tags libsndfile stores as UTF-8 (Vorbis comments, RIFF INFO)
+UTF8_TAG_FORMATS = ('.flac', '.wav')
+
+
+def read_source_tags(file_path):
+    """
+    Reads the tags of a source media file.
+
+    :param file_path: (str) Path to the media file.
+
+    :return: (dict) The tags of `TAG_KEYS` that are set, several artists are joined with ', '. Empty if the tags
+        can't be read.
+    """
+
+    try:
+        media_file = taglib.File(file_path)
+        file_tags = media_file.tags
+        media_file.close()
+    except Exception as e:
+        print(f"Failed to read metadata from {file_path}: {e}")
+        return {}
+
+    tags = {}
+    for key in TAG_KEYS:
+        values = [value for value in file_tags.get(key.upper(), []) if value]
+        if values:
+            tags[key] = ', '.join(values)
+
+    return tags
+
+
+def can_encode_tags(output_format, tags):
+    """
+    Tells whether libsndfile stores the tags correctly when encoding a file. MP3 tags are written by LAME as
+    Latin-1 from the raw bytes libsndfile gives it, so they are only correct for ASCII text.
+
+    :param output_format: (str) Extension of the encoded file ('.mp3', '.flac', '.wav').
+    :param tags: (dict) The tags to write.
+
+    :return: (bool) Whether the tags can be written while encoding.
+    """
+
+    if output_format.lower() in UTF8_TAG_FORMATS:
+        return True
+    return output_format.lower() == '.mp3' and all(str(tags.get(key) or '').isascii() for key in TAG_KEYS)
+
+
+def set_encode_tags(sound_file, tags, output_format):
+    """
+    Sets the tags of a file being encoded with soundfile. Must be called before the audio is written.
+
+    :param sound_file: (soundfile.SoundFile) The file open for writing.
+    :param tags: (dict) The tags to write (see `TAG_KEYS`).
+    :param output_format: (str) Extension of the encoded file.
+
+    :return: (bool) True if the tags were set, False if they must be written afterwards (see `write_tags_in_place`).
+    """
+
+    if not can_encode_tags(output_format, tags):
+        return False
+
+    for key in TAG_KEYS:
+        if tags.get(key):
+            setattr(sound_file, key, tags[key])
+
+    return True
+
+
+def write_tags_in_place(file_path, tags):
+    """
+    Updates the tags of an existing media file with taglib, without re-encoding it. Tags of `TAG_KEYS` that aren't
+    given are removed.
+
+    :param file_path: (str) Path to the media file.
+    :param tags: (dict) The tags to write.
+    """
+
+    media_file = taglib.File(file_path)
+    for key in TAG_KEYS:
+        if tags.get(key):
+            media_file.tags[key.upper()] = [tags[key]]
+        else:
+            media_file.tags.pop(key.upper(), None)
+    media_file.save()
+    media_file.close()
+
+
+def ffmpeg_metadata_args(tags):
+    """
+    Returns the ffmpeg options that write the tags while encoding a file.
+
+    :param tags: (dict) The tags to write (see `TAG_KEYS`).
+
+    :return: (list) '-metadata key=value' options.
+    """
+
+    args = []
+    for key in TAG_KEYS:
+        if tags.get(key):
+            args += ['-metadata', f"{key}={tags[key]}"]
+    return args
@@ -0,0 +1,283 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from create_triggers import (OUTPUT_FORMAT, RESAMPLE_TYPE, SAMPLE_DTYPE, SAMPLE_RATE, MediaJobResult,
+                             check_processing_options, encode_audio_with_triggers, load_audio, remove_partial_outputs,
+                             run_isolated_job, run_media_job)
+from media_tags import read_source_tags
+from stage_profiler import StageProfiler, profile_stage
+
+"""
+Pipelined processing of a batch of media files (see `find_new_stim_and_add_triggers(pipelined=True)`).
+
+Without it, each file is decoded, given triggers, encoded and tagged before the next one is started. Decoding is mostly
+waiting on the disk, while rendering the triggers and encoding are CPU-bound, so the stages are run concurrently with
+asyncio, with a bounded queue between them:
+
+    decode (threads) --[decoded queue, `queue_size`]--> triggers + encode (worker processes) --> record (one task)
+
+- Decoding (tags and audio) runs in `n_decoders` threads. When the decoded queue is full, the decoders wait: at most
+  `n_decoders` + `queue_size` + `n_workers` decoded files are in memory at the same time. The decode stages of each
+  file are profiled in its thread, and the other stages in the worker (see `stage_profiler.py`).
+- Rendering the triggers, encoding and tagging run in `n_workers` worker processes. The decoded audio is sent to the
+  worker (pickled), so use `streaming=True` for very long files: streaming audio files and videos skip the decode
+  stage and are processed whole in a worker.
+- Each finished file is recorded (build manifest) by a single task, one at a time, as soon as it is done.
+
+A worker process that crashes (e.g. killed when out of memory) breaks the pool, and the files being encoded fail with
+it: the pool is replaced, and each of these files is encoded again alone in its own process (see
+`create_triggers.run_isolated_job`), so that only the file that crashes is reported as failed.
+
+Cancelling the run (Ctrl+C) drops the files that haven't started encoding, waits for the ones being encoded and removes
+the partial outputs they may leave. The files already recorded are skipped by the next run, so it resumes where the
+cancelled one stopped.
+"""
+
+# Marks the end of a queue
+_END = None
+
+
+def decode_audio_file(file_name, file_paths, sample_rate=SAMPLE_RATE, res_type=RESAMPLE_TYPE, profile_log=None,
+                      per_stage_rss=True):
+    """
+    Decode stage: reads the tags and the audio of a source audio file. Runs in a decoder thread.
+
+    :param file_name: (str) Name of the source file (with extension).
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param sample_rate: (int) Sample rate of the stimuli.
+    :param res_type: (str) Resampler used if the file isn't at `sample_rate`.
+    :param profile_log: (str, optional) JSON-lines file the stage timings are appended to.
+    :param per_stage_rss: (bool) Whether the peak RSS of each stage is recorded, False when several files are decoded
+        at the same time (the peak is the one of the whole process).
+
+    :return: (tuple) The tags (dict) and the mono audio (numpy.ndarray).
+    """
+
+    source_file = os.path.join(file_paths.source_media_path, file_name)
+
+    # The 'total' of the file is recorded by the worker encoding it. cProfile and tracemalloc are only used in the
+    # workers, they can't tell apart the decoder threads
+    with StageProfiler(file_name, profile_log, captures=(), per_stage_rss=per_stage_rss, record_total=False):
+        with profile_stage('read_tags'):
+            metadata = read_source_tags(source_file)
+        return metadata, load_audio(source_file, sample_rate, res_type)
+
+
+def encode_decoded_audio(file_name, audio, metadata, file_paths, decode_time=0.0, use_existing_txt_file=True,
+                         sample_rate=SAMPLE_RATE, dtype=SAMPLE_DTYPE, output_format=OUTPUT_FORMAT,
+                         delay_compensation='none', profile_log=None, describe=False):
+    """
+    Encode stage: adds triggers to a decoded audio file, encodes and tags the stimulus. Runs in a worker process, and
+    reports the outcome instead of raising (see `run_media_job`).
+
+    :param file_name: (str) Name of the source file (with extension).
+    :param audio: (numpy.ndarray) The decoded mono audio (see `decode_audio_file`).
+    :param metadata: (dict) Tags of the source file.
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param decode_time: (float) Time spent decoding the file, added to the wall time of the result.
+    :param use_existing_txt_file: (bool) If True, recreate the trigger signal from the saved positions.
+    :param sample_rate: (int) Sample rate of the audio.
+    :param dtype: (numpy.dtype) Sample type of the audio buffers.
+    :param output_format: (str) Format of the stimulus.
+    :param delay_compensation: (str) How the encoder delay is handled.
+    :param profile_log: (str, optional) JSON-lines file the stage timings are appended to.
+    :param describe: (bool) If True, the result carries the description of the stimulus.
+
+    :return: (MediaJobResult) File name, wall time in seconds (decoding included), the error message (None on
+        success) and the description of the stimulus (None unless `describe` is True).
+    """
+
+    start_time = time.perf_counter()
+    stimulus = None
+    try:
+        with StageProfiler(file_name, profile_log) as profiler:
+            stimulus = encode_audio_with_triggers(os.path.splitext(file_name)[0], audio, file_paths, sample_rate,
+                                                  metadata, use_existing_txt_file, dtype=dtype,
+                                                  output_format=output_format, delay_compensation=delay_compensation,
+                                                  describe=describe)
+        print(f"{file_name}: decode {decode_time:.2f} s, {profiler.summary()}")
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    return MediaJobResult(file_name, decode_time + time.perf_counter() - start_time, error, stimulus)
+
+
+def needs_decode_stage(file_name, streaming=False):
+    """
+    Tells whether a file goes through the decode stage, or is processed whole in a worker (videos, and audio files
+    processed block by block).
+
+    :param file_name: (str) Name of the source file (with extension).
+    :param streaming: (bool) Whether audio files are processed block by block.
+
+    :return: (bool) True for audio files that are decoded in a thread before being encoded.
+    """
+
+    return not streaming and os.path.splitext(file_name)[-1] in ('.mp3', '.wav')
+
+
+async def run_pipeline_async(jobs, file_paths, video_thumbnails_path, record_result, n_workers=2, n_decoders=1,
+                             queue_size=2, sample_rate=SAMPLE_RATE, streaming=False, dtype=SAMPLE_DTYPE,
+                             output_format=OUTPUT_FORMAT, delay_compensation='none', res_type=RESAMPLE_TYPE,
+                             profile_log=None, describe=False):
+    """
+    Processes a batch of media files with the decode and encode stages running concurrently (see the module
+    docstring). Use `run_pipeline` to call it from synchronous code.
+
+    :param jobs: (list) The files to process, as (file name, use_existing_txt_file, rebuild reason) tuples (see
+        `find_media_to_process`).
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param video_thumbnails_path: (str) Path to save the video thumbnails.
+    :param record_result: (callable) Called with the MediaJobResult of each file as soon as it is done, one file at a
+        time (e.g. to update the build manifest).
+    :param n_workers: (int) Number of worker processes (trigger rendering and encoding).
+    :param n_decoders: (int) Number of decoder threads.
+    :param queue_size: (int) Maximum number of decoded files waiting for a worker.
+    :param sample_rate: (int) Sample rate of the stimuli.
+    :param streaming: (bool) If True, audio files are processed block by block in the workers, without a decode stage.
+    :param dtype: (numpy.dtype) Sample type of the audio buffers.
+    :param output_format: (str) Format of the audio stimuli.
+    :param delay_compensation: (str) How the encoder delay is handled.
+    :param res_type: (str) Resampler used for audio files that aren't at `sample_rate`.
+    :param profile_log: (str, optional) JSON-lines file the stage timings are appended to.
+    :param describe: (bool) If True, the results carry the description of the stimuli (see
+        `create_triggers.describe_stimulus`).
+
+    :return: (list of MediaJobResult) Outcomes of the processed files, in the order they finished.
+    """
+
+    check_processing_options(output_format, delay_compensation, res_type)
+    if min(n_workers, n_decoders, queue_size) < 1:
+        raise ValueError("n_workers, n_decoders and queue_size must be at least 1")
+
+    loop = asyncio.get_running_loop()
+    pending_jobs = asyncio.Queue()
+    decoded_jobs = asyncio.Queue(maxsize=queue_size)
+    finished_jobs = asyncio.Queue()
+    results = []
+
+    for job in jobs:
+        pending_jobs.put_nowait(job)
+
+    job_options = dict(sample_rate=sample_rate, dtype=dtype, output_format=output_format,
+                       delay_compensation=delay_compensation, profile_log=profile_log, describe=describe)
+
+    async def decode():
+        while not pending_jobs.empty():
+            file_name, use_existing_txt_file, _ = pending_jobs.get_nowait()
+            decoded = None
+
+            if needs_decode_stage(file_name, streaming):
+                start_time = time.perf_counter()
+                try:
+                    metadata, audio = await loop.run_in_executor(decoder_pool, decode_audio_file, file_name,
+                                                                 file_paths, sample_rate, res_type, profile_log,
+                                                                 n_decoders == 1)
+                    decoded = (metadata, audio, time.perf_counter() - start_time)
+                except Exception as e:
+                    await finished_jobs.put(MediaJobResult(file_name, time.perf_counter() - start_time,
+                                                           f"{type(e).__name__}: {e}"))
+                    continue
+
+            # Waits for a free place in the queue (backpressure)
+            await decoded_jobs.put((file_name, use_existing_txt_file, decoded))
+
+    async def encode():
+        nonlocal worker_pool
+
+        while (job := await decoded_jobs.get()) is not _END:
+            file_name, use_existing_txt_file, decoded = job
+
+            if decoded is None:
+                job = partial(run_media_job, file_name, file_paths, video_thumbnails_path, streaming=streaming,
+                              use_existing_txt_file=use_existing_txt_file, res_type=res_type, **job_options)
+            else:
+                metadata, audio, decode_time = decoded
+                job = partial(encode_decoded_audio, file_name, audio, metadata, file_paths, decode_time=decode_time,
+                              use_existing_txt_file=use_existing_txt_file, **job_options)
+                # Only the job keeps the audio, so it is freed as soon as the job is done
+                decoded = audio = None
+
+            pool = worker_pool
+            try:
+                result = await loop.run_in_executor(pool, job)
+            except BrokenProcessPool:
+                # A worker crashed: replace the pool (once), and encode this file alone to know if it is the culprit
+                if pool is worker_pool:
+                    print("A worker process crashed, replacing the worker pool.")
+                    worker_pool = ProcessPoolExecutor(max_workers=n_workers)
+                    pool.shutdown(wait=False, cancel_futures=True)
+                result = await asyncio.to_thread(run_isolated_job, job, file_name)
+            job = None
+
+            await finished_jobs.put(result)
+
+    async def record():
+        while (result := await finished_jobs.get()) is not _END:
+            results.append(result)
+            await asyncio.to_thread(record_result, result)
+            status = f"failed ({result.error})" if result.error else f"done in {result.wall_time:.1f} s"
+            print(f"[{len(results)}/{len(jobs)}] {result.file_name}: {status}")
+
+    decoder_pool = ThreadPoolExecutor(max_workers=n_decoders, thread_name_prefix='decoder')
+    worker_pool = ProcessPoolExecutor(max_workers=n_workers)
+    decoders = [asyncio.create_task(decode()) for _ in range(n_decoders)]
+    encoders = [asyncio.create_task(encode()) for _ in range(n_workers)]
+    recorder = asyncio.create_task(record())
+    cancelled = True
+
+    try:
+        await asyncio.gather(*decoders)
+        for _ in encoders:
+            await decoded_jobs.put(_END)
+        await asyncio.gather(*encoders)
+        await finished_jobs.put(_END)
+        await recorder
+        cancelled = False
+
+    finally:
+        for task in decoders + encoders + [recorder]:
+            task.cancel()
+
+        # Drop the files that haven't started, let the running ones finish
+        decoder_pool.shutdown(wait=True, cancel_futures=True)
+        worker_pool.shutdown(wait=True, cancel_futures=True)
+
+        if cancelled:
+            remove_partial_outputs(file_paths.stim_with_trigs_path)
+            print(f"Cancelled after {len(results)} of {len(jobs)} file(s), run again to process the others.")
+
+    return results
+
+
+def run_pipeline(jobs, file_paths, video_thumbnails_path, record_result, **kwargs):
+    """
+    Runs `run_pipeline_async` from synchronous code. On Ctrl+C, the run is cancelled (see the module docstring) and
+    the results of the files finished so far are returned.
+
+    :param jobs: (list) The files to process (see `find_media_to_process`).
+    :param file_paths: (namedtuple FilePaths) Source, output and trigger position paths.
+    :param video_thumbnails_path: (str) Path to save the video thumbnails.
+    :param record_result: (callable) Called with the MediaJobResult of each file as soon as it is done.
+    :param kwargs: Keyword arguments forwarded to `run_pipeline_async` (n_workers, n_decoders, queue_size, ...).
+
+    :return: (list of MediaJobResult) Outcomes of the processed files.
+    """
+
+    results = []
+
+    def record(result):
+        results.append(result)
+        record_result(result)
+
+    try:
+        asyncio.run(run_pipeline_async(jobs, file_paths, video_thumbnails_path, record, **kwargs))
+    except KeyboardInterrupt:
+        print("Interrupted.")
+
+    return results
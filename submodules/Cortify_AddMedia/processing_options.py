@@ -0,0 +1,36 @@
+"""
+Choices of the options of the AddMedia tools, defined without importing the tools (numpy, soundfile, tinytag, ...)
+so that the command line can check them when it parses its arguments and still start quickly (see
+`cortify_addmedia.py`). The tools import them from here.
+"""
+
+# Formats of the audio stimuli. MP3 encoders add a delay at the start of the file (encoder priming): it can be
+# compensated (see DELAY_COMPENSATION_MODES), or lossless formats can be used for precision-sensitive stimuli.
+OUTPUT_FORMATS = ('.mp3', '.flac', '.wav')
+LOSSLESS_FORMATS = ('.flac', '.wav')
+OUTPUT_FORMAT = '.mp3'
+
+# How the encoder delay of lossy formats is handled:
+# 'none': the stimulus is encoded as it is
+# 'preshift': the start of the signal is shortened by the encoder delay, so that once decoded the audio and the
+#   triggers are at the positions saved in the _trigger.txt file
+# 'timestamps': the stimulus is encoded as it is, and the trigger positions in the decoded file (saved positions +
+#   encoder delay) are saved to a _trigger_decoded.txt file next to the _trigger.txt file
+DELAY_COMPENSATION_MODES = ('none', 'preshift', 'timestamps')
+
+# Resamplers of librosa.resample for files that aren't at the target sample rate, from the best quality to the
+# fastest: 'soxr_hq' (librosa's default), 'soxr_lq', 'polyphase' (exact for 48 kHz -> 44.1 kHz), 'kaiser_fast'
+RESAMPLE_TYPES = ('soxr_hq', 'soxr_lq', 'polyphase', 'kaiser_fast')
+RESAMPLE_TYPE = 'soxr_hq'
+
+# How files are put in the genre folders:
+# 'copy': full copy of the file
+# 'hardlink': same file on disk under two names (source and destination must be on the same drive)
+# 'reflink': copy-on-write clone, no data is duplicated (only on filesystems that support it, e.g. Btrfs, XFS)
+# 'symlink': link pointing to the source file (needs the right to create symbolic links on Windows)
+# If a link can't be made, the file is copied instead.
+TRANSFER_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+
+# Outputs of the playlist: 'single' (one indented 'metadata.json', read by the app), 'sharded' (one compact file per
+# stimulus type in 'metadata > playlist', see create_JSON_playlist.save_sharded_playlist), or 'both'
+PLAYLIST_OUTPUTS = ('single', 'sharded', 'both')
@@ -0,0 +1,332 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+"""
+Records how long each stage of the processing of a media file takes (decoding, trigger generation, encoding, metadata,
+...), so that a slow batch can be diagnosed without editing the code.
+
+For each stage, the wall time, the CPU time (including the ffmpeg subprocesses), the bytes read and written by the
+process and its peak RSS during the stage are recorded, and written as one JSON object per line to a log file:
+
+    {"time": "...", "pid": 1234, "file": "song.mp3", "stage": "encode", "wall_s": 1.52, "cpu_s": 1.49, ...}
+
+The stages are marked in the code with `profile_stage`, which does nothing when no file is being profiled.
+
+Switches (environment variables, also seen by the worker processes):
+    CORTIFY_PROFILE_LOG: path of the JSON-lines log, overrides the one given in the code
+    CORTIFY_PROFILE: comma-separated captures, 'cprofile' (one .prof file per media file, open it with snakeviz or
+        pstats) and/or 'tracemalloc' (peak memory allocated by Python and NumPy in each stage)
+    CORTIFY_PROFILE_DIR: directory of the .prof files, defaults to the directory of the log
+"""
+
+PROFILE_LOG_ENV = 'CORTIFY_PROFILE_LOG'
+PROFILE_CAPTURE_ENV = 'CORTIFY_PROFILE'
+PROFILE_DIR_ENV = 'CORTIFY_PROFILE_DIR'
+
+# Captures that can be switched on with CORTIFY_PROFILE
+PROFILE_CAPTURES = ('cprofile', 'tracemalloc')
+
+# Profiler of the file being processed in each thread (`_local.profiler`, unset when nothing is profiled), so that
+# files decoded in threads (see `pipeline_orchestrator.py`) are profiled separately
+_local = threading.local()
+
+
+def get_profile_captures():
+    """
+    Reads the captures switched on with the CORTIFY_PROFILE environment variable.
+
+    :return: (set) The enabled captures (see `PROFILE_CAPTURES`).
+    """
+
+    captures = {capture.strip().lower() for capture in os.environ.get(PROFILE_CAPTURE_ENV, '').split(',')}
+    unknown = captures - set(PROFILE_CAPTURES) - {''}
+    if unknown:
+        print(f"Ignoring unknown {PROFILE_CAPTURE_ENV} capture(s): {', '.join(sorted(unknown))}")
+    return captures & set(PROFILE_CAPTURES)
+
+
+def read_io_counters():
+    """
+    Reads the number of bytes read and written by this process so far (from psutil, or /proc on Linux).
+
+    :return: (tuple) Bytes read and bytes written, (None, None) if the platform doesn't report them.
+    """
+
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return getattr(counters, 'read_chars', counters.read_bytes), \
+                getattr(counters, 'write_chars', counters.write_bytes)
+        except (psutil.Error, AttributeError):
+            pass
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def read_cpu_time():
+    """
+    Returns the CPU time used so far by this process and its finished subprocesses (e.g. ffmpeg).
+
+    :return: (float) CPU time in seconds.
+    """
+
+    if resource is None:
+        return time.process_time()
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of this process to its current resident memory (Linux only, by writing 5 to
+    /proc/self/clear_refs), so that `read_peak_rss` gives the peak since then.
+
+    :return: (bool) Whether the peak could be reset.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss():
+    """
+    Returns the peak resident memory of this process since the last `reset_peak_rss` (VmHWM of /proc/self/status).
+
+    :return: (float) Peak RSS in MB, None if the platform doesn't report it.
+    """
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def read_process_peak_rss():
+    """
+    Returns the peak resident memory of this process since it started. In a worker process that handles several files,
+    it is the peak of all the files processed so far, not of the current one.
+
+    :return: (float) Peak RSS in MB, None if the platform doesn't report it.
+    """
+
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on Linux, bytes on macOS
+        return peak_rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss) / 2 ** 20
+
+    return None
+
+
+class StageProfiler:
+    """
+    Profiles the stages of the processing of one media file. Use it as a context manager around the processing:
+    while it is active, the stages marked with `profile_stage` are recorded.
+
+    :param file_name: (str) Name of the media file.
+    :param log_path: (str, optional) JSON-lines log the records are appended to. The CORTIFY_PROFILE_LOG environment
+        variable overrides it. If there is neither, the records are only kept in `records`.
+    :param captures: (set, optional) Captures to enable (see `PROFILE_CAPTURES`). Defaults to the ones switched on
+        with the CORTIFY_PROFILE environment variable.
+    :param per_stage_rss: (bool) Whether to reset the peak RSS at each stage. Use False when other files are processed
+        by other threads of the process at the same time.
+    :param record_total: (bool) Whether to record a 'total' stage, False when only a part of the processing of the file
+        is profiled (e.g. its decoding in a thread).
+
+    Where the peak resident memory can be reset (Linux, see `reset_peak_rss`), each record has the peak RSS during its
+    stage ('peak_rss_mb'). Elsewhere, only the peak since the process started is known, and it is recorded as
+    'process_peak_rss_mb' instead: in a worker process, it includes the files processed before.
+    """
+
+    def __init__(self, file_name, log_path=None, captures=None, per_stage_rss=True, record_total=True):
+        self.file_name = file_name
+        self.log_path = os.environ.get(PROFILE_LOG_ENV) or log_path
+        self.captures = get_profile_captures() if captures is None else set(captures)
+        self.per_stage_rss = per_stage_rss
+        self.record_total = record_total
+        self.records = []
+        self._profile = None
+        self._start = None
+        self._per_stage_rss = False
+        self._started_tracemalloc = False
+        self._open_stages = []
+
+    def __enter__(self):
+        _local.profiler = self
+
+        # tracemalloc is shared by the whole process: only stop it on exit if it was started here
+        if 'tracemalloc' in self.captures and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if 'cprofile' in self.captures:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+        self._per_stage_rss = self.per_stage_rss and reset_peak_rss() and read_peak_rss() is not None
+        self._start = self._snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.profiler = None
+
+        if self.record_total:
+            self._record('total', self._start, exc_value)
+        else:
+            self._open_stages.remove(self._start)
+
+        if self._profile is not None:
+            self._profile.disable()
+            self._save_cprofile()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+        return False
+
+    def _fold_peak_rss(self):
+        # Peak RSS since the last reset, counted in the peak of every stage that is still open
+        peak_rss = read_peak_rss()
+        for start in self._open_stages:
+            start['peak_rss'] = max(start['peak_rss'], peak_rss)
+        return peak_rss
+
+    def _fold_traced_peak(self):
+        # Same as `_fold_peak_rss` for the memory traced by tracemalloc, whose peak is also reset at each stage
+        traced_peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        for start in self._open_stages:
+            if start['traced_peak'] is not None:
+                start['traced_peak'] = max(start['traced_peak'], traced_peak)
+
+    def _snapshot(self):
+        read_bytes, written_bytes = read_io_counters()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            self._fold_traced_peak()
+            tracemalloc.reset_peak()
+        if self._per_stage_rss:
+            self._fold_peak_rss()
+            reset_peak_rss()
+        start = {'wall': time.perf_counter(), 'cpu': read_cpu_time(), 'read': read_bytes, 'written': written_bytes,
+                 'peak_rss': 0.0, 'traced_peak': 0.0 if tracing else None}
+        self._open_stages.append(start)
+        return start
+
+    def _end_snapshot(self, start):
+        read_bytes, written_bytes = read_io_counters()
+        if tracemalloc.is_tracing():
+            self._fold_traced_peak()
+        if self._per_stage_rss:
+            self._fold_peak_rss()
+        self._open_stages.remove(start)
+        return {'wall': time.perf_counter(), 'cpu': read_cpu_time(), 'read': read_bytes, 'written': written_bytes}
+
+    def _record(self, stage, start, error=None):
+        end = self._end_snapshot(start)
+
+        record = {"time": datetime.now().isoformat(timespec='milliseconds'),
+                  "pid": os.getpid(),
+                  "file": self.file_name,
+                  "stage": stage,
+                  "wall_s": round(end['wall'] - start['wall'], 6),
+                  "cpu_s": round(end['cpu'] - start['cpu'], 6),
+                  "read_bytes": end['read'] - start['read'] if start['read'] is not None else None,
+                  "written_bytes": end['written'] - start['written'] if start['written'] is not None else None}
+
+        if self._per_stage_rss:
+            record["peak_rss_mb"] = start['peak_rss']
+        else:
+            record["process_peak_rss_mb"] = read_process_peak_rss()
+
+        if start['traced_peak'] is not None:
+            record["traced_peak_mb"] = start['traced_peak']
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+
+        self.records.append(record)
+
+        if self.log_path:
+            # One write per line, so that the lines of parallel workers don't get mixed
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _save_cprofile(self):
+        profile_dir = os.environ.get(PROFILE_DIR_ENV) or (os.path.dirname(self.log_path) if self.log_path else '.')
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_path = os.path.join(profile_dir, f"{self.file_name}.prof")
+        self._profile.dump_stats(profile_path)
+        print("Saved profile as", profile_path)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Records one stage.
+
+        :param name: (str) Name of the stage.
+        """
+
+        start = self._snapshot()
+        try:
+            yield
+        except BaseException as e:
+            self._record(name, start, e)
+            raise
+        self._record(name, start)
+
+    def summary(self):
+        """
+        :return: (str) Wall time of each stage on one line, e.g. 'decode 1.20 s, triggers 0.05 s, ...'.
+        """
+
+        return ', '.join(f"{record['stage']} {record['wall_s']:.2f} s" for record in self.records)
+
+
+@contextmanager
+def profile_stage(name):
+    """
+    Marks a stage of the processing of a media file. The stage is recorded by the active `StageProfiler`, if any.
+
+    :param name: (str) Name of the stage, e.g. 'decode', 'triggers', 'encode', 'metadata'.
+    """
+
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        yield
+        return
+
+    with profiler.stage(name):
+        yield
@@ -0,0 +1,68 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+create_triggers = pytest.importorskip("create_triggers")
+sf = create_triggers.sf
+
+mp3_support = pytest.mark.skipif('MP3' not in sf.available_formats(), reason="libsndfile can't write mp3")
+
+
+def decode_without_gapless(file_path):
+    # ffmpeg keeps the priming samples with skip_manual, like a decoder that ignores the LAME header
+    output = subprocess.run(['ffmpeg', '-v', 'error', '-flags2', 'skip_manual', '-i', file_path,
+                             '-f', 'f32le', '-ac', '2', '-'], check=True, capture_output=True).stdout
+    return np.frombuffer(output, dtype=np.float32).reshape(-1, 2)
+
+
+@mp3_support
+@pytest.mark.parametrize("sample_rate", [22050, 44100, 48000])
+def test_mp3_delay_is_measured(sample_rate):
+    assert create_triggers.measure_encoder_delay('.mp3', sample_rate) > 0
+
+
+@mp3_support
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg isn't installed")
+@pytest.mark.parametrize("sample_rate", [22050, 44100, 48000])
+def test_mp3_delay_matches_decoded_click(tmp_path, sample_rate):
+    click_start = sample_rate // 2
+    click = np.zeros((2 * sample_rate, 2), dtype=np.float32)
+    click[click_start:click_start + int(create_triggers.PARAMS.trigger_duration * sample_rate)] = 0.9
+    click_file = str(tmp_path / 'click.mp3')
+    sf.write(click_file, click, sample_rate)
+
+    decoded = decode_without_gapless(click_file)
+    decoded_start = int(np.argmax(np.abs(decoded[:, 1]) > 0.45))
+
+    assert decoded_start - click_start == create_triggers.measure_encoder_delay('.mp3', sample_rate)
+
+
+def test_id3_tag_is_skipped(tmp_path):
+    frame = bytearray(417)
+    frame[:4] = b'\xff\xfb\x90\x64'
+    frame[36:44] = b'Info\x00\x00\x00\x0f'
+    frame[156:160] = b'LAME'
+    frame[177:180] = bytes([0x24, 0x04, 0x38])  # 576 samples of delay, 1080 of padding
+    tag = b'ID3\x04\x00\x00\x00\x00\x01\x00' + bytes(128)
+    mp3_file = tmp_path / 'tagged.mp3'
+    mp3_file.write_bytes(tag + bytes(frame))
+
+    assert create_triggers.read_lame_encoder_delay(str(mp3_file)) == (576, 1080)
+
+
+@pytest.fixture
+def no_lame_header(monkeypatch):
+    monkeypatch.setattr(create_triggers, 'read_lame_encoder_delay', lambda file_path: None)
+
+
+def test_missing_header_raises(no_lame_header):
+    with pytest.raises(ValueError):
+        create_triggers.measure_encoder_delay('.mp3', 44100)
+
+
+def test_failed_measurement_is_not_cached(tmp_path, no_lame_header):
+    assert create_triggers.get_encoder_delay('.mp3', 44100, str(tmp_path)) == 0
+    assert not os.path.exists(tmp_path / create_triggers.ENCODER_DELAY_CACHE_FILENAME)
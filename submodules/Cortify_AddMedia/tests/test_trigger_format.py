@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import trigger_format
+
+SAMPLE_RATE = 44100
+TRIGGER_DURATION = 0.002
+TRIGGER_DURATION_SAMPLES = int(TRIGGER_DURATION * SAMPLE_RATE)
+NUM_SAMPLES = 10 * SAMPLE_RATE
+
+
+def write_baseline_text_file(trigger_pos_path):
+    # As saved by the original generator: unquantized onsets, offset = onset + duration, and a last random trigger
+    # after the end of the file saved before the trigger that ends the file
+    end = NUM_SAMPLES / SAMPLE_RATE
+    onsets = [3.0, 3.2, 3.4, 4.567891, 9.123457, 10.301234]
+    positions = [[onset, onset + TRIGGER_DURATION] for onset in onsets]
+    positions.append([(NUM_SAMPLES - TRIGGER_DURATION_SAMPLES) / SAMPLE_RATE, end])
+    text_file = trigger_pos_path / ('stim' + trigger_format.TEXT_TRIGGER_FILE_SUFFIX)
+    np.savetxt(text_file, positions, delimiter=',', fmt='%0.6f')
+    return text_file
+
+
+def test_converted_baseline_file_is_sorted(tmp_path):
+    write_baseline_text_file(tmp_path)
+
+    converted = trigger_format.convert_trigger_folder(str(tmp_path), SAMPLE_RATE)
+    header, pulse_bounds = trigger_format.load_trigger_file(converted[0])
+
+    assert header["version"] == trigger_format.TRIGGER_FILE_VERSION
+    assert np.all(np.diff(pulse_bounds[:, 0]) >= 0)
+    assert [NUM_SAMPLES - TRIGGER_DURATION_SAMPLES, NUM_SAMPLES] in pulse_bounds.tolist()
+    assert np.all(pulse_bounds[:, 1] - pulse_bounds[:, 0] == TRIGGER_DURATION_SAMPLES)
+
+
+def test_converted_baseline_file_renders_like_the_text_file(tmp_path):
+    create_triggers = pytest.importorskip("create_triggers")
+    write_baseline_text_file(tmp_path)
+
+    from_text = create_triggers.generate_trigger_signal_from_txt('stim', NUM_SAMPLES, SAMPLE_RATE, str(tmp_path))
+    trigger_format.convert_trigger_folder(str(tmp_path), SAMPLE_RATE)
+    from_binary = create_triggers.generate_trigger_signal_from_txt('stim', NUM_SAMPLES, SAMPLE_RATE, str(tmp_path))
+
+    assert np.array_equal(from_text, from_binary)
+    assert np.all(from_binary[-TRIGGER_DURATION_SAMPLES:] != 0)
+    assert np.count_nonzero(from_binary) == 6 * TRIGGER_DURATION_SAMPLES
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+create_triggers = pytest.importorskip("create_triggers")
+
+SAMPLE_RATE = create_triggers.SAMPLE_RATE
+TRIGGER_DURATION_SAMPLES = int(create_triggers.PARAMS.trigger_duration * SAMPLE_RATE)
+
+
+def render_new_triggers(tmp_path, num_samples, seed):
+    return create_triggers.generate_new_trigger_signal('stim', num_samples, SAMPLE_RATE, str(tmp_path),
+                                                       create_triggers.PARAMS, seed=seed)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_new_triggers_end_with_a_trigger(tmp_path, seed):
+    num_samples = np.random.default_rng(seed).integers(5 * SAMPLE_RATE, 60 * SAMPLE_RATE)
+    trigger_signal = render_new_triggers(tmp_path, num_samples, seed)
+
+    assert np.all(trigger_signal[-TRIGGER_DURATION_SAMPLES:] != 0)
+
+
+def test_last_random_trigger_after_the_end_is_dropped(tmp_path):
+    num_samples = 1746368
+    _, pulse_bounds = create_triggers.generate_new_trigger_positions('stim', num_samples, SAMPLE_RATE, str(tmp_path),
+                                                                     create_triggers.PARAMS, seed=8)
+
+    assert np.all(np.diff(pulse_bounds[:, 0]) > 0)
+    assert pulse_bounds[-1, 1] == num_samples
+    assert np.all(render_new_triggers(tmp_path, num_samples, 8)[-TRIGGER_DURATION_SAMPLES:] != 0)
+
+
+def test_saved_triggers_render_like_new_ones(tmp_path):
+    num_samples = 1746368
+    new_signal = render_new_triggers(tmp_path, num_samples, 8)
+    saved_signal = create_triggers.generate_trigger_signal_from_txt('stim', num_samples, SAMPLE_RATE, str(tmp_path))
+
+    assert np.array_equal(new_signal, saved_signal)
+
+
+def test_unsorted_saved_positions_keep_the_end_trigger(tmp_path):
+    # Positions saved before the last random trigger was kept within the file: it is after the end of the file and
+    # saved before the end trigger
+    num_samples = 10 * SAMPLE_RATE
+    onsets = np.array([3.0, 3.2, 3.4, 9.5, 10.3]) * SAMPLE_RATE
+    starts = np.append(onsets.astype(np.int64), num_samples - TRIGGER_DURATION_SAMPLES)
+    positions = np.column_stack((starts, starts + TRIGGER_DURATION_SAMPLES)) / SAMPLE_RATE
+    np.savetxt(tmp_path / 'stim_trigger.txt', positions, delimiter=',', fmt='%0.6f')
+
+    trigger_signal = create_triggers.generate_trigger_signal_from_txt('stim', num_samples, SAMPLE_RATE, str(tmp_path))
+
+    assert np.all(trigger_signal[-TRIGGER_DURATION_SAMPLES:] != 0)
+    assert np.count_nonzero(trigger_signal) == 5 * TRIGGER_DURATION_SAMPLES
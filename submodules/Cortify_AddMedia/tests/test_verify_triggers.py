@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+
+verify_triggers = pytest.importorskip("verify_triggers")
+
+
+@pytest.mark.parametrize("duration_ms, expected_class", [
+    (2, 2), (5.9, 5), (8, 8), (75, 75), (100, 100), (101, 100), (102, 0),
+    (125, 125), (150, 150), (151, 150),
+    (174, 175), (175, 175), (180, 175), (181, 0), (300, 0), (50, 0),
+])
+def test_durations_are_classified_like_the_syncbox(duration_ms, expected_class):
+    assert verify_triggers.classify_pulse_durations(np.array([duration_ms]))[0] == expected_class
@@ -0,0 +1,269 @@
+import glob
+import math
+import os
+import struct
+import sys
+
+import numpy as np
+
+"""
+Binary format of the trigger positions ('<name>_trigger.ctrg', next to the '<name>_trigger.txt' files in
+'Add_Triggers > triggers').
+
+The text files store the onset and offset of each pulse in seconds, which have to be parsed and rounded back to time
+samples every time they are read. The binary files store the pulses directly in time samples, so they can be
+memory-mapped and used without parsing or copying:
+
+    header (64 bytes, little-endian):
+        magic             4s   b'CTRG'
+        version           u16  1
+        header size       u16  64
+        sample rate       u32  Hz
+        number of pulses  u64
+        trigger duration  f64  s      \
+        min spacing       f64  s       | trigger parameters used to draw the positions,
+        max spacing       f64  s       | NaN if unknown (files converted from text)
+        trigger amplitude f64         /
+        padding           12 bytes of zeros
+    pulses: int64 array of shape (number of pulses, 2), first sample and end sample (excluded) of each pulse
+
+The text files store the exact time samples divided by the sample rate (6 decimals, i.e. 1 µs), so that they can be
+converted back to the same time samples (see `positions_to_pulse_bounds`).
+
+The text files are still written for humans, `export_text` recreates one from a binary file, and
+`convert_trigger_folder` creates the binary files of the existing text files.
+"""
+
+TRIGGER_FILE_MAGIC = b'CTRG'
+TRIGGER_FILE_VERSION = 1
+TRIGGER_FILE_SUFFIX = '_trigger.ctrg'
+TEXT_TRIGGER_FILE_SUFFIX = '_trigger.txt'
+
+_HEADER = struct.Struct('<4sHHIQdddd')
+HEADER_SIZE = 64
+
+# Sample type of the pulse bounds
+PULSE_DTYPE = np.dtype('<i8')
+
+# Positions in the text files are rounded to the µs: this margin (in seconds) is added before truncating them to time
+# samples, so that a position saved from a time sample is converted back to the same time sample
+TEXT_POSITION_MARGIN = 6e-7
+
+
+def positions_to_pulse_bounds(trigger_positions, sample_rate):
+    """
+    Converts trigger positions in seconds (as saved in the text files) to pulses in time samples.
+
+    Onsets are truncated to time samples like when the pulses are generated (`int(onset * sample_rate)`), and the
+    duration of each pulse is rounded to a whole number of time samples. The pulses are sorted by onset (see
+    `sort_pulse_bounds`). Positions saved from time samples give back
+    exactly the same pulses, and positions saved before they were (unquantized onsets, offset = onset + duration)
+    give the pulses they were generated with, unless an onset was within 1 µs of the next time sample.
+
+    :param trigger_positions: (numpy.ndarray) Onset and offset of each pulse in seconds, shape (n, 2).
+    :param sample_rate: (int) Sample rate in Hz.
+
+    :return: (numpy.ndarray) Pulses in time samples (int64), shape (n, 2): first sample and end sample (excluded).
+    """
+
+    trigger_positions = np.asarray(trigger_positions, dtype=float).reshape(-1, 2)
+    starts = np.floor((trigger_positions[:, 0] + TEXT_POSITION_MARGIN) * sample_rate).astype(np.int64)
+    lengths = np.round((trigger_positions[:, 1] - trigger_positions[:, 0]) * sample_rate).astype(np.int64)
+    return sort_pulse_bounds(np.column_stack((starts, starts + lengths)))
+
+
+def sort_pulse_bounds(pulse_bounds):
+    """
+    Sorts pulses by onset. The positions drawn before the last random trigger was kept within the file can end with
+    a random trigger after the end of the file, saved before the trigger that ends the file.
+
+    :param pulse_bounds: (numpy.ndarray) Pulses in time samples, shape (n, 2).
+
+    :return: (numpy.ndarray) The pulses sorted by onset (the same array if they already are).
+    """
+
+    if np.all(pulse_bounds[1:, 0] >= pulse_bounds[:-1, 0]):
+        return pulse_bounds
+    return pulse_bounds[np.argsort(pulse_bounds[:, 0], kind='stable')]
+
+
+def read_text_positions(text_file):
+    """
+    Reads the trigger positions saved in a text file.
+
+    :param text_file: (str) Path to the '_trigger.txt' file.
+
+    :return: (numpy.ndarray) Onset and offset of each pulse in seconds, shape (n, 2).
+    """
+
+    return np.loadtxt(text_file, delimiter=',', ndmin=2).reshape(-1, 2)
+
+
+def save_trigger_file(trigger_file, pulse_bounds, sample_rate, trigger_params=None):
+    """
+    Saves pulses in the binary trigger format. The file is replaced only once it is complete.
+
+    :param trigger_file: (str) Path to the '.ctrg' file.
+    :param pulse_bounds: (numpy.ndarray) Pulses in time samples, shape (n, 2): first sample and end sample (excluded).
+    :param sample_rate: (int) Sample rate in Hz.
+    :param trigger_params: (TriggerParams, optional) Parameters used to draw the positions, None if unknown.
+    """
+
+    pulse_bounds = np.ascontiguousarray(pulse_bounds, dtype=PULSE_DTYPE).reshape(-1, 2)
+
+    params = [math.nan] * 4
+    if trigger_params is not None:
+        params = [trigger_params.trigger_duration, trigger_params.min_trigger_spacing,
+                  trigger_params.max_trigger_spacing, trigger_params.trigger_amplitude]
+
+    header = _HEADER.pack(TRIGGER_FILE_MAGIC, TRIGGER_FILE_VERSION, HEADER_SIZE, int(sample_rate), len(pulse_bounds),
+                          *params)
+
+    temp_file = trigger_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(pulse_bounds.tobytes())
+    os.replace(temp_file, trigger_file)
+
+
+def read_trigger_header(trigger_file):
+    """
+    Reads the header of a binary trigger file.
+
+    :param trigger_file: (str) Path to the '.ctrg' file.
+
+    :return: (dict) `version`, `sample_rate`, `n_pulses`, and the trigger parameters `trigger_duration`,
+        `min_trigger_spacing`, `max_trigger_spacing` and `trigger_amplitude` (None if unknown).
+    """
+
+    with open(trigger_file, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+
+    if len(header) < _HEADER.size or header[:4] != TRIGGER_FILE_MAGIC:
+        raise ValueError(f"{trigger_file} is not a trigger file")
+
+    (_, version, header_size, sample_rate, n_pulses,
+     trigger_duration, min_spacing, max_spacing, amplitude) = _HEADER.unpack_from(header)
+    if version > TRIGGER_FILE_VERSION or header_size != HEADER_SIZE:
+        raise ValueError(f"Unsupported trigger file version {version} ({trigger_file})")
+
+    def known(value):
+        return None if math.isnan(value) else value
+
+    return {"version": version,
+            "sample_rate": sample_rate,
+            "n_pulses": n_pulses,
+            "trigger_duration": known(trigger_duration),
+            "min_trigger_spacing": known(min_spacing),
+            "max_trigger_spacing": known(max_spacing),
+            "trigger_amplitude": known(amplitude)}
+
+
+def load_trigger_file(trigger_file, mmap=True):
+    """
+    Loads a binary trigger file.
+
+    :param trigger_file: (str) Path to the '.ctrg' file.
+    :param mmap: (bool) If True, the pulses are memory-mapped (read-only, nothing is read until used), otherwise they
+        are read into memory.
+
+    :return: (tuple) The header (see `read_trigger_header`) and the pulses in time samples (int64, shape (n, 2)).
+    """
+
+    header = read_trigger_header(trigger_file)
+    shape = (header["n_pulses"], 2)
+
+    # An empty array can't be memory-mapped
+    if header["n_pulses"] == 0:
+        return header, np.empty(shape, dtype=PULSE_DTYPE)
+
+    if mmap:
+        return header, np.memmap(trigger_file, dtype=PULSE_DTYPE, mode='r', offset=HEADER_SIZE, shape=shape)
+
+    with open(trigger_file, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        return header, np.fromfile(f, dtype=PULSE_DTYPE, count=shape[0] * 2).reshape(shape)
+
+
+def load_trigger_positions(trigger_file):
+    """
+    Loads the trigger positions of a binary trigger file in seconds, as in the text files.
+
+    :param trigger_file: (str) Path to the '.ctrg' file.
+
+    :return: (numpy.ndarray) Onset and offset of each pulse in seconds, shape (n, 2).
+    """
+
+    header, pulse_bounds = load_trigger_file(trigger_file)
+    return pulse_bounds / header["sample_rate"]
+
+
+def export_text(trigger_file, text_file=None):
+    """
+    Writes the positions of a binary trigger file to a text file (onset and offset in seconds, one pulse per line).
+
+    :param trigger_file: (str) Path to the '.ctrg' file.
+    :param text_file: (str, optional) Path to the text file. Defaults to the '_trigger.txt' file next to it.
+
+    :return: (str) Path to the text file.
+    """
+
+    if text_file is None:
+        text_file = trigger_file[:-len(TRIGGER_FILE_SUFFIX)] + TEXT_TRIGGER_FILE_SUFFIX
+
+    np.savetxt(text_file, load_trigger_positions(trigger_file), delimiter=',', fmt='%0.6f')
+    return text_file
+
+
+def convert_text_file(text_file, sample_rate, trigger_file=None):
+    """
+    Creates the binary trigger file of a text file. The pulses are rounded to time samples the same way as when the
+    text file is used to recreate a stimulus (see `positions_to_pulse_bounds`).
+
+    :param text_file: (str) Path to the '_trigger.txt' file.
+    :param sample_rate: (int) Sample rate of the stimulus in Hz.
+    :param trigger_file: (str, optional) Path to the binary file. Defaults to the '.ctrg' file next to the text file.
+
+    :return: (str) Path to the binary file.
+    """
+
+    if trigger_file is None:
+        trigger_file = text_file[:-len(TEXT_TRIGGER_FILE_SUFFIX)] + TRIGGER_FILE_SUFFIX
+
+    pulse_bounds = positions_to_pulse_bounds(read_text_positions(text_file), sample_rate)
+    save_trigger_file(trigger_file, pulse_bounds, sample_rate)
+    return trigger_file
+
+
+def convert_trigger_folder(trigger_pos_path, sample_rate=44100, overwrite=False):
+    """
+    Creates the binary trigger files of all the text files of a triggers folder. Text files that already have an
+    up-to-date binary file (newer than the text file) are skipped, unless `overwrite` is True.
+
+    :param trigger_pos_path: (str) Path to the triggers folder ('Cortify_Media > Add_Triggers > triggers').
+    :param sample_rate: (int) Sample rate of the stimuli in Hz.
+    :param overwrite: (bool) If True, recreate all the binary files.
+
+    :return: (list) Paths to the binary files created.
+    """
+
+    converted = []
+    for text_file in sorted(glob.glob(os.path.join(trigger_pos_path, '*' + TEXT_TRIGGER_FILE_SUFFIX))):
+        trigger_file = text_file[:-len(TEXT_TRIGGER_FILE_SUFFIX)] + TRIGGER_FILE_SUFFIX
+        if (not overwrite and os.path.isfile(trigger_file)
+                and os.path.getmtime(trigger_file) >= os.path.getmtime(text_file)):
+            continue
+
+        try:
+            converted.append(convert_text_file(text_file, sample_rate, trigger_file))
+        except ValueError as e:
+            print(f"Could not convert {os.path.basename(text_file)}: {e}")
+
+    print(f"Converted {len(converted)} trigger file(s) in {trigger_pos_path}")
+    return converted
+
+
+if __name__ == '__main__':
+    from cortify_addmedia import main
+
+    main(['convert-triggers'] + sys.argv[1:])
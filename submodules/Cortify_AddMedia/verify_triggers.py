@@ -0,0 +1,257 @@
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import soundfile as sf
+
+from media_probe import probe_media
+
+"""
+Checks that the triggers in the rendered stimuli ('Add_Triggers > stimuli_with_triggers') still match the positions saved
+in 'Add_Triggers > triggers' once the files are encoded (MP3/AAC encoders add their own delay).
+
+The trigger channel of each stimulus is decoded, the pulses are detected and classified with the same duration classes
+as the Arduino syncbox, and they are compared with the saved positions: codec offset, jitter, missing and extra pulses.
+"""
+
+# Minimum expected trigger durations of the syncbox, in ms (dur_trig_1 to dur_trig_8 in arduino/syncbox_audio_*.ino)
+SYNCBOX_TRIGGER_DURATIONS_MS = (2, 5, 8, 75, 100, 125, 150, 175)
+
+# Tolerance of the syncbox when classifying a pulse duration, in ms
+SYNCBOX_TOLERANCE_MS = 1
+
+# Pulses longer than the longest class by more than this are ignored by the syncbox, in ms
+SYNCBOX_MAX_EXCESS_MS = 5
+
+# Fraction of the trigger amplitude above which the trigger channel is considered high
+DETECTION_THRESHOLD = 0.5
+
+# Largest codec offset searched for, in seconds (triggers are at least 0.5 s apart)
+MAX_CODEC_OFFSET = 0.2
+
+# A detected pulse matches a saved position if it is within this distance once the codec offset is removed, in seconds
+MATCH_TOLERANCE = 0.005
+
+
+def decode_trigger_channel(stim_file):
+    """
+    Decodes the trigger channel (second audio channel) of a rendered stimulus.
+
+    :param stim_file: (str) Path to the stimulus (mp3, wav, flac, or mp4).
+
+    :return: (tuple) The trigger channel (numpy.ndarray, float32) and its sample rate in Hz.
+    """
+
+    if os.path.splitext(stim_file)[-1].lower() == '.mp4':
+        audio_stream = next(stream for stream in probe_media(stim_file)['streams'] if stream['type'] == 'audio')
+        sample_rate = audio_stream['samplerate']
+        ffmpeg_args = ['ffmpeg', '-v', 'error', '-i', stim_file, '-map', '0:a:0', '-ac', '2', '-ar', str(sample_rate),
+                       '-f', 'f32le', '-']
+        audio = np.frombuffer(subprocess.check_output(ffmpeg_args), dtype=np.float32).reshape(-1, 2)
+        return audio[:, 1], sample_rate
+
+    audio, sample_rate = sf.read(stim_file, dtype='float32', always_2d=True)
+    if audio.shape[1] < 2:
+        raise ValueError(f"{stim_file} has no trigger channel")
+    return np.ascontiguousarray(audio[:, 1]), sample_rate
+
+
+def detect_pulses(trigger_channel, threshold=DETECTION_THRESHOLD):
+    """
+    Detects the pulses of a trigger channel by thresholding.
+
+    :param trigger_channel: (numpy.ndarray) The decoded trigger channel.
+    :param threshold: (float) Level above which the channel is considered high, as a fraction of the highest sample.
+
+    :return: (tuple) Onsets and offsets (first sample after the pulse) of the pulses, in time samples.
+    """
+
+    peak = np.abs(trigger_channel).max(initial=0)
+    if peak == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    high = (np.abs(trigger_channel) > threshold * peak).astype(np.int8)
+    edges = np.diff(high, prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def classify_pulse_durations(durations_ms, trigger_durations_ms=SYNCBOX_TRIGGER_DURATIONS_MS,
+                             tolerance_ms=SYNCBOX_TOLERANCE_MS, max_excess_ms=SYNCBOX_MAX_EXCESS_MS):
+    """
+    Classifies pulse durations the way the syncbox does (`find_trigger_code`): a pulse belongs to a class if its
+    duration is within the tolerance of the class duration. Only the longest class is open-ended, up to
+    `max_excess_ms` past its duration, longer pulses are ignored.
+
+    :param durations_ms: (numpy.ndarray) Pulse durations in ms.
+    :param trigger_durations_ms: (tuple) Duration classes in ms.
+    :param tolerance_ms: (float) Tolerance in ms.
+    :param max_excess_ms: (float) Largest duration past the longest class that is still classified, in ms.
+
+    :return: (numpy.ndarray) The class of each pulse in ms, 0 for pulses that don't match any class.
+    """
+
+    durations_ms = np.asarray(durations_ms, dtype=float)
+    classes = np.zeros(durations_ms.shape)
+
+    # Same order as the syncbox: longest class first
+    longest_ms = max(trigger_durations_ms)
+    for class_ms in sorted(trigger_durations_ms, reverse=True):
+        if class_ms == longest_ms:
+            in_class = (durations_ms >= class_ms - tolerance_ms) & (durations_ms <= class_ms + max_excess_ms)
+        else:
+            in_class = np.abs(durations_ms - class_ms) <= tolerance_ms
+        classes[(classes == 0) & in_class] = class_ms
+
+    return classes
+
+
+def match_pulses(expected_onsets, detected_onsets, max_offset=MAX_CODEC_OFFSET, tolerance=MATCH_TOLERANCE):
+    """
+    Matches the detected pulses with the expected ones, after estimating the constant offset between them.
+
+    :param expected_onsets: (numpy.ndarray) Saved onsets in seconds, sorted.
+    :param detected_onsets: (numpy.ndarray) Detected onsets in seconds, sorted.
+    :param max_offset: (float) Largest offset searched for, in seconds.
+    :param tolerance: (float) Largest distance between a matched pair once the offset is removed, in seconds.
+
+    :return: (tuple) The offset in seconds (detected - expected), and for each expected pulse the index of the
+        matched detected pulse (-1 if missing).
+    """
+
+    matches = np.full(len(expected_onsets), -1)
+    if len(expected_onsets) == 0 or len(detected_onsets) == 0:
+        return 0.0, matches
+
+    def nearest(onsets):
+        # Index of the nearest detected onset for each onset
+        right = np.clip(np.searchsorted(detected_onsets, onsets), 0, len(detected_onsets) - 1)
+        left = np.clip(right - 1, 0, len(detected_onsets) - 1)
+        use_left = np.abs(detected_onsets[left] - onsets) < np.abs(detected_onsets[right] - onsets)
+        return np.where(use_left, left, right)
+
+    # The codec offset is the same for all the pulses: take the median of the nearest distances
+    distances = detected_onsets[nearest(expected_onsets)] - expected_onsets
+    distances = distances[np.abs(distances) <= max_offset]
+    offset = float(np.median(distances)) if len(distances) else 0.0
+
+    nearest_indices = nearest(expected_onsets + offset)
+    matched = np.abs(detected_onsets[nearest_indices] - (expected_onsets + offset)) <= tolerance
+    matches[matched] = nearest_indices[matched]
+
+    return offset, matches
+
+
+def verify_stimulus(stim_file, trigger_file):
+    """
+    Compares the triggers of a rendered stimulus with the positions saved in its trigger file.
+
+    :param stim_file: (str) Path to the stimulus with triggers.
+    :param trigger_file: (str) Path to the saved trigger positions (_trigger.txt, onset and offset in seconds).
+
+    :return: (dict) Report with the number of expected and detected pulses, the codec offset and the jitter (ms),
+        the missing and extra pulses (onsets in seconds), and the pulses whose duration class doesn't match.
+    """
+
+    trigger_channel, sample_rate = decode_trigger_channel(stim_file)
+    onsets, offsets = detect_pulses(trigger_channel)
+
+    expected = np.loadtxt(trigger_file, delimiter=',', ndmin=2)
+    detected_onsets = onsets / sample_rate
+
+    offset, matches = match_pulses(expected[:, 0], detected_onsets)
+    matched = matches >= 0
+
+    # Jitter once the constant codec offset is removed
+    jitter = detected_onsets[matches[matched]] - expected[matched, 0] - offset
+
+    # Duration classes of the matched pulses, as seen by the syncbox
+    expected_classes = classify_pulse_durations((expected[matched, 1] - expected[matched, 0]) * 1000)
+    detected_classes = classify_pulse_durations((offsets - onsets)[matches[matched]] / sample_rate * 1000)
+    wrong_class = expected_classes != detected_classes
+
+    extra = np.ones(len(detected_onsets), dtype=bool)
+    extra[matches[matched]] = False
+
+    return {
+        "file": os.path.basename(stim_file),
+        "sample_rate": sample_rate,
+        "expected": len(expected),
+        "detected": len(detected_onsets),
+        "codec_offset_ms": offset * 1000,
+        "jitter_std_ms": float(jitter.std() * 1000) if len(jitter) else None,
+        "jitter_max_ms": float(np.abs(jitter).max() * 1000) if len(jitter) else None,
+        "missing": expected[~matched, 0].tolist(),
+        "extra": detected_onsets[extra].tolist(),
+        "wrong_duration_class": expected[matched, 0][wrong_class].tolist(),
+    }
+
+
+def _verify_or_report_error(stim_file, trigger_file):
+    try:
+        return verify_stimulus(stim_file, trigger_file)
+    except Exception as e:
+        return {"file": os.path.basename(stim_file), "error": f"{type(e).__name__}: {e}"}
+
+
+def verify_stimuli_folder(cortify_media_dir, n_workers=os.cpu_count(), report_file='trigger_verification.json'):
+    """
+    Checks the triggers of every stimulus in 'Cortify_Media > Add_Triggers > stimuli_with_triggers' against the
+    positions saved in 'Cortify_Media > Add_Triggers > triggers', in parallel, and saves a JSON report in
+    'Cortify_Media > Add_Triggers'.
+
+    :param cortify_media_dir: path to the Cortify Media directory
+    :param n_workers: (int) number of files checked at the same time. Defaults to the number of CPUs.
+    :param report_file: (str) name of the JSON report, None to only print the summary.
+
+    :return: (list) The report of each stimulus (see `verify_stimulus`), sorted by file name.
+    """
+
+    triggers_dir = os.path.join(cortify_media_dir, 'Add_Triggers')
+    stim_with_trigs_path = os.path.join(triggers_dir, 'stimuli_with_triggers')
+    trigger_pos_path = os.path.join(triggers_dir, 'triggers')
+
+    jobs = []
+    for file_name in sorted(os.listdir(stim_with_trigs_path)):
+        trigger_file = os.path.join(trigger_pos_path, os.path.splitext(file_name)[0] + '_trigger.txt')
+        if not os.path.isfile(trigger_file):
+            print("No trigger positions saved for", file_name)
+            continue
+        jobs.append((os.path.join(stim_with_trigs_path, file_name), trigger_file))
+
+    reports = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_verify_or_report_error, *job) for job in jobs]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            print(f"[{len(reports)}/{len(jobs)}] {report['file']}")
+
+    reports.sort(key=lambda r: r["file"])
+
+    print("\nTrigger verification:")
+    for report in reports:
+        if "error" in report:
+            print(f"  FAILED  {report['file']}: {report['error']}")
+            continue
+        status = "ok" if not (report["missing"] or report["extra"] or report["wrong_duration_class"]) else "CHECK"
+        print(f"  {status:6}  {report['file']}: offset {report['codec_offset_ms']:.2f} ms, "
+              f"jitter {report['jitter_std_ms'] or 0:.3f} ms (max {report['jitter_max_ms'] or 0:.3f} ms), "
+              f"{len(report['missing'])} missing, {len(report['extra'])} extra, "
+              f"{len(report['wrong_duration_class'])} with the wrong duration")
+
+    if report_file is not None:
+        report_path = os.path.join(triggers_dir, report_file)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=4, ensure_ascii=False)
+        print("Saved report as", report_path)
+
+    return reports
+
+
+if __name__ == '__main__':
+    from cortify_addmedia import main
+
+    main(['verify'] + sys.argv[1:])